@@ -0,0 +1,53 @@
+"""App factory used by the benchmarks: main.app with a pre-seeded video.
+
+The seeded video's streams point at BENCH_MEDIA_URL, so downloads relay from a
+local media server and no extraction is needed.
+"""
+import os
+import time
+
+import main
+from benchmarks.common import VIDEO_ID
+
+
+def seed_video(media_url, media_size):
+    expire = int(time.time()) + 24 * 60 * 60
+    common = {"title": "Benchmark video", "codecs": [], "is_dash": False, "is_drc": False,
+              "audio_track_name": None, "filesize": media_size}
+    streams = [
+        main.CachedStream(itag=18, url=f"{media_url}/progressive.mp4?expire={expire}", mime_type="video/mp4",
+                          type="video", subtype="mp4", video_codec="avc1.42001E", audio_codec="mp4a.40.2",
+                          resolution="360p", fps=30, abr="96kbps", is_progressive=True, is_adaptive=False,
+                          includes_audio_track=True, includes_video_track=True, **common),
+        main.CachedStream(itag=137, url=f"{media_url}/video.mp4?expire={expire}", mime_type="video/mp4",
+                          type="video", subtype="mp4", video_codec="avc1.640028", audio_codec=None,
+                          resolution="1080p", fps=30, abr=None, is_progressive=False, is_adaptive=True,
+                          includes_audio_track=False, includes_video_track=True, **common),
+        main.CachedStream(itag=140, url=f"{media_url}/audio.m4a?expire={expire}", mime_type="audio/mp4",
+                          type="audio", subtype="mp4", video_codec=None, audio_codec="mp4a.40.2",
+                          resolution=None, fps=None, abr="128kbps", is_progressive=False, is_adaptive=True,
+                          includes_audio_track=True, includes_video_track=False, **common),
+        main.CachedStream(itag=251, url=f"{media_url}/audio.webm?expire={expire}", mime_type="audio/webm",
+                          type="audio", subtype="webm", video_codec=None, audio_codec="opus",
+                          resolution=None, fps=None, abr="128kbps", is_progressive=False, is_adaptive=True,
+                          includes_audio_track=True, includes_video_track=False, **common),
+    ]
+    info = {"title": "Benchmark video", "author": "benchmark", "length": 60, "views": 0,
+            "description": "", "publish_date": None, "thumbnail_url": f"{media_url}/thumbnail.jpg"}
+    main.video_cache.put(main.VideoSnapshot(VIDEO_ID, info, streams, expire - 60))
+
+
+def create_app():
+    seed_video(os.environ['BENCH_MEDIA_URL'], int(os.environ.get('BENCH_MEDIA_SIZE', 0)) or None)
+    return main.app
+
+
+def create_offline_app():
+    """main.app with YouTube requests sent to the fake server at FAKE_YOUTUBE_URL,
+    so videos are really extracted by pytubefix, just not from YouTube. With
+    EGRESS_PROXIES set they still go out through the egress pool.
+    """
+    from benchmarks.fake_youtube import redirect_youtube
+    # Through the egress pool, which replaced the global opener if it is enabled
+    redirect_youtube(os.environ['FAKE_YOUTUBE_URL'], main.egress_pool.connection if main.egress_pool.enabled else None)
+    return main.app
@@ -0,0 +1,230 @@
+"""Offline checks of behaviour that benchmark numbers don't show.
+
+Each check runs against local stand-ins (a fake YouTube, a fake Redis, a
+media server), in process or with the app under gunicorn, and reports the
+values it compared and whether it passed; the exit status is 1 if any check
+failed.
+
+    python -m benchmarks.checks --checks shared_cache,range_cache
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import API_KEY, VIDEO_URL, make_test_media, print_json, run_gunicorn, start_media_server
+from benchmarks.fake_redis import start_fake_redis
+from benchmarks.fake_youtube import redirect_youtube, start_fake_youtube
+
+
+def check_backend(backend):
+    """get/set/expiry and lock/unlock of one shared cache backend."""
+    results = {}
+    results["missing_is_none"] = backend.get('check:missing') is None
+    backend.set('check:value', {"a": 1}, 60)
+    results["get_after_set"] = backend.get('check:value') == {"a": 1}
+    backend.set('check:short', {"a": 1}, 1)
+    time.sleep(1.1)
+    results["expired_is_none"] = backend.get('check:short') is None
+
+    token = backend.acquire_lock('check', 5)
+    results["lock_granted"] = bool(token)
+    results["second_lock_refused"] = backend.acquire_lock('check', 5) is None
+    backend.release_lock('check', 'not-the-owner')
+    results["foreign_release_ignored"] = backend.acquire_lock('check', 5) is None
+    backend.release_lock('check', token)
+    token = backend.acquire_lock('check', 0.2)
+    results["lock_after_release"] = bool(token)
+    time.sleep(0.3)
+    results["lock_after_expiry"] = bool(backend.acquire_lock('check', 5))
+    return {"ok": all(results.values()), **results}
+
+
+def check_shared_cache(context):
+    import main
+    return {
+        "sqlite": check_backend(main.SQLiteCacheBackend(context["cache_dir"])),
+        "redis": check_backend(main.RedisCacheBackend(context["redis_url"], prefix=f'check-{time.time()}:')),
+    }
+
+
+def wait_for_holder(main, video_id, publish_error):
+    """Hold a video's extraction lock like another worker would, while this
+    process loads it; release it after 0.5s, with or without publishing an
+    error. Returns (seconds, snapshot, error) of the load.
+    """
+    token = main.shared_cache.acquire_lock(video_id, main.EXTRACTION_LOCK_TIMEOUT)
+    result = {}
+
+    def load():
+        started = time.perf_counter()
+        snapshot, error = main.load_video(f'https://www.youtube.com/watch?v={video_id}', video_id)
+        result.update(seconds=time.perf_counter() - started, snapshot=snapshot, error=error)
+
+    thread = threading.Thread(target=load)
+    thread.start()
+    time.sleep(0.5)
+    if publish_error:
+        main.put_shared_error(video_id, 'Video unavailable')
+    main.shared_cache.release_lock(video_id, token)
+    thread.join()
+    return round(result["seconds"], 2), result["snapshot"], result["error"]
+
+
+def check_lock_handoff(context):
+    """A worker waiting on another's extraction lock wakes up when the holder
+    fails, instead of sleeping until EXTRACTION_LOCK_TIMEOUT.
+    """
+    import main
+    main.shared_cache = main.RedisCacheBackend(context["redis_url"], prefix=f'check-{time.time()}:')
+    main.EXTRACTION_LOCK_TIMEOUT = 6
+    seconds, snapshot, error = wait_for_holder(main, 'handoff0001', publish_error=False)
+    released = {"seconds": seconds, "extracted": snapshot is not None, "error": error,
+                "ok": snapshot is not None and seconds < main.EXTRACTION_LOCK_TIMEOUT / 2}
+    seconds, snapshot, error = wait_for_holder(main, 'handoff0002', publish_error=True)
+    failed = {"seconds": seconds, "error": error,
+              "ok": error == 'Video unavailable' and seconds < main.EXTRACTION_LOCK_TIMEOUT / 2}
+    return {"lock_timeout": main.EXTRACTION_LOCK_TIMEOUT, "released_without_result": released,
+            "released_with_error": failed}
+
+
+def fetch(base_url, method, path, body=None, headers=None):
+    """Make one request; returns (status, headers, body)."""
+    conn = http.client.HTTPConnection(base_url.split('//')[1], timeout=120)
+    all_headers = {'X-API-Key': API_KEY, 'Content-Type': 'application/json'}
+    all_headers.update(headers or {})
+    try:
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=all_headers)
+        response = conn.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        conn.close()
+
+
+def check_range_cache(context):
+    """A POST with Range gets the same partial response whether the download
+    is relayed or served from the media cache.
+    """
+    size = 1024 * 1024
+    server, media_url = start_media_server(size, files=context["media"])
+    env = {"BENCH_MEDIA_URL": media_url, "BENCH_MEDIA_SIZE": str(size), "MEDIA_CACHE_MAX_BYTES": str(1 << 30),
+           "MEDIA_CACHE_DIR": os.path.join(context["cache_dir"], 'media')}
+    results = {}
+    try:
+        with run_gunicorn('gevent', env=env) as (_, base_url):
+            for name, path in (("progressive", '/download/360p'), ("merged", '/download/1080p')):
+                ranged = {"Range": "bytes=0-1023"}
+                miss = fetch(base_url, 'POST', path, {"url": VIDEO_URL}, ranged)
+                status, _, full = fetch(base_url, 'POST', path, {"url": VIDEO_URL})
+                # The download is stored once its response has been sent
+                time.sleep(0.5)
+                hits = json.loads(fetch(base_url, 'GET', '/stats')[2])["media_cache"]["hits"]
+                hit = fetch(base_url, 'POST', path, {"url": VIDEO_URL}, ranged)
+                served_from_cache = json.loads(fetch(base_url, 'GET', '/stats')[2])["media_cache"]["hits"] > hits
+                expected = f'bytes 0-1023/{len(full)}'
+                result = {
+                    "miss": {"status": miss[0], "content_range": miss[1].get('Content-Range'), "bytes": len(miss[2])},
+                    "hit": {"status": hit[0], "content_range": hit[1].get('Content-Range'), "bytes": len(hit[2])},
+                    "served_from_cache": served_from_cache,
+                }
+                ok = status == 200 and served_from_cache and hit[0] == 206
+                ok = ok and hit[1].get('Content-Range') == expected and hit[2] == full[:1024]
+                if name == "progressive":
+                    # A live merge can't seek, so only relays serve ranges on a miss
+                    ok = ok and (miss[0], miss[1].get('Content-Range'), miss[2]) == (hit[0], expected, hit[2])
+                results[name] = dict(result, ok=ok)
+    finally:
+        server.shutdown()
+    return results
+
+
+def walk_listing(client, api_key, url, limit):
+    """Page through a listing with next_cursor until it is null; returns
+    (video IDs, requests made, error line or None).
+    """
+    cursor, video_ids, requests = None, [], 0
+    while True:
+        response = client.post('/playlist', json={"url": url, "cursor": cursor, "limit": limit},
+                               headers={'X-API-Key': api_key})
+        requests += 1
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        video_ids += [line["id"] for line in lines if "id" in line]
+        if response.status_code != 200 or "error" in lines[-1]:
+            return video_ids, requests, lines[-1] if lines else response.status_code
+        cursor = lines[-1]["next_cursor"]
+        if cursor is None:
+            return video_ids, requests, None
+
+
+def check_long_playlist(context):
+    """A playlist longer than the browse endpoint's continuation limit is
+    listed to its end, read on from the watch panel, in one request and
+    resumed from cursors.
+    """
+    import main
+    youtube = context["youtube"]
+    expected = [f'pl{index:09d}' for index in range(youtube.playlist_length)]
+    client = main.app.test_client()
+    url = 'https://www.youtube.com/playlist?list=PLcheck0001'
+    results = {"length": youtube.playlist_length, "browse_limit": youtube.browse_limit}
+    # Only the paging is checked; the entries aren't extracted
+    get_video_info, main.get_video_info = main.get_video_info, lambda video_url: ({"url": video_url}, None)
+    try:
+        for limit, requests_needed in ((1000, 1), (120, 3)):
+            youtube.counts.clear()
+            video_ids, requests, error = walk_listing(client, main.API_KEY, url, limit)
+            results[f"limit_{limit}"] = {
+                "entries": len(video_ids), "requests": requests, "error": error,
+                "upstream": {name: youtube.counts.get(name, 0) for name in ('playlist', 'browse', 'next')},
+                "ok": error is None and sorted(video_ids) == expected and requests == requests_needed,
+            }
+    finally:
+        main.get_video_info = get_video_info
+    return results
+
+
+CHECKS = {
+    "shared_cache": check_shared_cache,
+    "lock_handoff": check_lock_handoff,
+    "range_cache": check_range_cache,
+    "long_playlist": check_long_playlist,
+}
+
+
+def passed(result):
+    if isinstance(result, dict):
+        return result.get("ok", True) and all(passed(value) for value in result.values())
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--checks', default=','.join(CHECKS), help='comma-separated, from: ' + ', '.join(CHECKS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # main reads its configuration at import
+        os.environ['CACHE_DIR'] = cache_dir
+        youtube, fake_url = start_fake_youtube(1024 * 1024)
+        redis, redis_url = start_fake_redis()
+        import main as app
+        redirect_youtube(fake_url, app.egress_pool.connection if app.egress_pool.enabled else None)
+        media = make_test_media(os.path.join(tempfile.gettempdir(), 'youtube-python-bench-media', '10'), 10)
+        context = {"cache_dir": cache_dir, "fake_url": fake_url, "youtube": youtube, "redis_url": redis_url,
+                   "media": media}
+        try:
+            results = {name: CHECKS[name](context) for name in args.checks.split(',')}
+        finally:
+            youtube.shutdown()
+            redis.shutdown()
+    results = {name: {"ok": passed(result), **result} for name, result in results.items()}
+    print_json({"checks": results})
+    sys.exit(0 if all(result["ok"] for result in results.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Cold-start cost: import time, and time to the first successful /video_info of a new instance.
+
+Measures how long `import main` takes in a fresh interpreter with and without
+FAST_START, then starts gunicorn against a local fake YouTube once per mode and
+times how long it takes to answer /check-connection and to return its first
+/video_info. Every instance gets an empty CACHE_DIR, like a new container; the
+warm modes share a PLAYER_JS_DIR that an earlier instance already filled, like
+a volume mounted into every container.
+
+    python -m benchmarks.coldstart --runs 5 --player-js-size 2500000
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import ROOT, print_json, request, run_gunicorn
+from benchmarks.fake_youtube import start_fake_youtube
+
+APP = 'benchmarks.bench_app:create_offline_app()'
+VIDEO_URL = 'https://www.youtube.com/watch?v=coldstart01'
+IMPORT_SCRIPT = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+
+# name: extra server env, and whether PLAYER_JS_DIR is already filled
+MODES = {
+    "default": ({}, False),
+    "fast_start": ({"FAST_START": "1"}, False),
+    "fast_start_warm_player_js": ({"FAST_START": "1"}, True),
+    "preload_warm_player_js": ({"PRELOAD": "1"}, True),
+}
+
+
+def median(values):
+    return round(statistics.median(values), 3)
+
+
+def measure_import(env, runs):
+    imports, interpreters = [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, env=dict(os.environ, **env),
+                                capture_output=True, text=True, check=True).stdout
+        interpreters.append(time.perf_counter() - started)
+        imports.append(float(output.split()[-1]))
+    return {"import_seconds": median(imports), "process_seconds": median(interpreters)}
+
+
+def measure_start(env, args):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict({"CACHE_DIR": cache_dir, "WORKER_CLASS": args.worker_class}, **env)
+        started = time.perf_counter()
+        with run_gunicorn(args.worker_class, workers=args.workers, env=env, app=APP) as (_, base_url):
+            ready = time.perf_counter() - started
+            status = request(base_url, 'POST', '/video_info', {"url": VIDEO_URL})[0]
+            first = time.perf_counter() - started
+    return status, ready, first
+
+
+def run_mode(name, args, server, fake_url, player_js_dir):
+    env, warm = MODES[name]
+    with tempfile.TemporaryDirectory() as cold_dir:
+        env = dict(env, FAKE_YOUTUBE_URL=fake_url, PLAYER_JS_DIR=player_js_dir if warm else cold_dir)
+        fetches_before = server.counts.get('player_js', 0)
+        readies, firsts, statuses = [], [], []
+        for _ in range(args.runs):
+            if not warm:
+                for entry in os.listdir(cold_dir):
+                    os.remove(os.path.join(cold_dir, entry))
+            status, ready, first = measure_start(env, args)
+            statuses.append(status)
+            readies.append(ready)
+            firsts.append(first)
+    return {
+        "statuses": statuses,
+        "ready_seconds": median(readies),
+        "first_video_info_seconds": median(firsts),
+        "player_js_fetches": server.counts.get('player_js', 0) - fetches_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default=','.join(MODES), help='comma-separated, from: ' + ', '.join(MODES))
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per measurement; medians are reported')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='delay of each fake YouTube API response')
+    parser.add_argument('--player-js-size', type=int, default=2_500_000, help='bytes in the fake base.js')
+    args = parser.parse_args()
+
+    imports = {
+        "default": measure_import({"FAST_START": "0"}, args.runs),
+        "fast_start": measure_import({"FAST_START": "1"}, args.runs),
+    }
+    server, fake_url = start_fake_youtube(0, api_latency=args.api_latency, player_js_size=args.player_js_size)
+    try:
+        with tempfile.TemporaryDirectory() as player_js_dir:
+            # one instance fills the shared player JS cache for the warm modes
+            measure_start({"FAKE_YOUTUBE_URL": fake_url, "PLAYER_JS_DIR": player_js_dir}, args)
+            results = {name: run_mode(name, args, server, fake_url, player_js_dir) for name in args.modes.split(',')}
+    finally:
+        server.shutdown()
+    print_json({"benchmark": "coldstart", "params": vars(args), "import": imports, "results": results})
+
+
+if __name__ == '__main__':
+    main()
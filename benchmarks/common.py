@@ -0,0 +1,275 @@
+"""Shared helpers for the benchmark scripts.
+
+Benchmarks run the real app under gunicorn against local stand-in servers, so
+they never touch YouTube. The app is started through bench_app, which seeds
+the video cache with a video whose streams point at a local media server.
+"""
+import http.client
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = 'benchmark-key'
+VIDEO_ID = 'benchmark01'
+VIDEO_URL = f'https://www.youtube.com/watch?v={VIDEO_ID}'
+
+_BLOCK = bytes(range(256)) * 256  # 64 KiB
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves the files in self.server.files (path -> bytes), and
+    self.server.media_size synthetic bytes for any other path, with Range
+    support.
+
+    Each connection is throttled to self.server.rate bytes/s (if set) and the
+    first byte is delayed by self.server.latency seconds.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _body(self):
+        return self.server.files.get(self.path.split('?')[0])
+
+    def _size(self):
+        body = self._body()
+        return len(body) if body is not None else self.server.media_size
+
+    def _range(self):
+        size = self._size()
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get('Range', ''))
+        if not match:
+            return 0, size - 1, False
+        start = int(match.group(1) or 0)
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        return start, end, True
+
+    def _headers(self):
+        start, end, partial = self._range()
+        time.sleep(self.server.latency)
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if partial:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{self._size()}')
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        start, end = self._headers()
+        body = self._body()
+        remaining = end - start + 1
+        rate = self.server.rate
+        started = time.time()
+        sent = 0
+        try:
+            while remaining > 0:
+                if body is not None:
+                    chunk = body[start + sent:start + sent + min(len(_BLOCK), remaining)]
+                else:
+                    offset = (start + sent) % len(_BLOCK)
+                    chunk = _BLOCK[offset:offset + min(len(_BLOCK) - offset, remaining)]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                remaining -= len(chunk)
+                if rate:
+                    ahead = sent / rate - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def start_media_server(media_size, rate=None, latency=0.0, files=None):
+    """Start a MediaHandler server in a background thread; returns (server, base_url).
+
+    files maps URL paths (e.g. '/video.mp4') to local files to serve.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    server.files = {}
+    for path, filename in (files or {}).items():
+        with open(filename, 'rb') as f:
+            server.files[path] = f.read()
+    server.media_size = media_size
+    server.rate = rate
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def make_test_media(directory, seconds=60):
+    """Generate real media files with ffmpeg, shaped like YouTube's adaptive streams.
+
+    Returns a files mapping for start_media_server: an H.264 video-only MP4,
+    an AAC m4a and an opus WebM audio track, all fragmented for streaming, and
+    a JPEG thumbnail.
+    """
+    os.makedirs(directory, exist_ok=True)
+    outputs = {
+        '/video.mp4': ['-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30', '-c:v', 'libx264', '-preset', 'ultrafast',
+                       '-g', '60', '-movflags', 'frag_keyframe+empty_moov'],
+        '/audio.m4a': ['-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100', '-ac', '2', '-c:a', 'aac', '-b:a', '128k',
+                       '-movflags', 'frag_keyframe+empty_moov'],
+        '/audio.webm': ['-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000', '-ac', '2', '-c:a', 'libopus', '-b:a', '128k'],
+        '/thumbnail.jpg': ['-f', 'lavfi', '-i', 'testsrc2=size=1280x720', '-frames:v', '1'],
+    }
+    files = {}
+    for path, args in outputs.items():
+        filename = os.path.join(directory, path.lstrip('/'))
+        if not os.path.exists(filename):
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error'] + args + ['-t', str(seconds), filename], check=True)
+        files[path] = filename
+    return files
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def run_gunicorn(worker_class='sync', workers=1, env=None, app='benchmarks.bench_app:create_app()'):
+    """Run the app under gunicorn and yield (process, base_url)."""
+    port = free_port()
+    process_env = dict(os.environ, API_KEY=API_KEY, **(env or {}))
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'gunicorn',
+            '-k', worker_class,
+            '-w', str(workers),
+            '-b', f'127.0.0.1:{port}',
+            '--timeout', '600',
+            app,
+        ],
+        cwd=ROOT,
+        env=process_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                if request(base_url, 'GET', '/check-connection')[0] == 200:
+                    break
+            except OSError:
+                pass
+            if time.time() > deadline or process.poll() is not None:
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.1)
+        yield process, base_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def request(base_url, method, path, body=None, headers=None, timeout=600):
+    """Make one request and read the whole body; returns (status, seconds, bytes, ttfb)."""
+    host, port = base_url.split('//')[1].split(':')
+    conn = http.client.HTTPConnection(host, int(port), timeout=timeout)
+    all_headers = {'X-API-Key': API_KEY}
+    if body is not None:
+        body = json.dumps(body)
+        all_headers['Content-Type'] = 'application/json'
+    all_headers.update(headers or {})
+    started = time.perf_counter()
+    try:
+        conn.request(method, path, body=body, headers=all_headers)
+        response = conn.getresponse()
+        first = response.read(1)
+        ttfb = time.perf_counter() - started
+        nbytes = len(first)
+        while True:
+            chunk = response.read(256 * 1024)
+            if not chunk:
+                break
+            nbytes += len(chunk)
+        return response.status, time.perf_counter() - started, nbytes, ttfb
+    finally:
+        conn.close()
+
+
+def run_concurrently(count, fn):
+    """Call fn(i) from count threads at once and return the results in order."""
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = fn(i)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else None,
+    }
+
+
+def process_usage(pid):
+    """CPU seconds (user + system, including reaped children) and RSS bytes of a process on Linux."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = sum(int(v) for v in fields[11:15]) / ticks
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+
+def process_tree(pid):
+    """pid and the pids of all its descendants, e.g. a gunicorn master and its workers."""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents.setdefault(int(f.read().rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+            except OSError:
+                pass
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        pending.extend(parents.get(current, []))
+    return pids
+
+
+def print_json(results):
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
@@ -0,0 +1,93 @@
+"""Egress pool: downloads of new videos with and without a pool of proxies.
+
+Every request downloads a video that hasn't been extracted yet, so it is
+extracted and then relayed (or merged to audio) through the egress it was
+extracted by. The fake googlevideo shares --address-rate bytes/s between all
+downloads to one address, its media URLs only work from the address they were
+issued to, and the fake YouTube bot-detects every extraction through the
+first stand-in proxy. Reports status codes, latency, throughput, bot
+detections, media requests from the wrong address, and how the tunnels were
+spread over the proxies (counted by the stand-ins, so across all workers).
+
+    python -m benchmarks.egress --requests 40 --concurrency 8
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import make_test_media, print_json, request, run_gunicorn, summarize
+from benchmarks.fake_proxy import start_fake_proxy
+from benchmarks.fake_youtube import start_fake_youtube
+
+APP = 'benchmarks.bench_app:create_offline_app()'
+
+# name: (proxy schemes, extra server env); the first proxy's address is flagged
+MODES = {
+    "direct": ((), {}),
+    "pool": (('http', 'http', 'socks5h', 'http'), {}),
+    "pool_no_quarantine": (('http', 'http', 'socks5h', 'http'), {"EGRESS_QUARANTINE": "0"}),
+}
+
+
+def download(base_url, mode, n):
+    # Every fourth download is an audio merge, fed to ffmpeg through the egress
+    path = '/download/audio' if n % 4 == 3 else '/download/360p'
+    return request(base_url, 'POST', path, {"url": f'https://www.youtube.com/watch?v={mode[:3]}{n:08d}'})
+
+
+def run_mode(name, args, files):
+    schemes, env = MODES[name]
+    server, fake_url = start_fake_youtube(args.size, files=files, api_latency=args.api_latency, bot_addresses={'127.0.0.2'},
+                                          check_ip=True, address_rate=args.address_rate)
+    proxies = [start_fake_proxy(f'127.0.0.{i + 2}', scheme) for i, scheme in enumerate(schemes)]
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env = dict(env, CACHE_DIR=cache_dir, FAKE_YOUTUBE_URL=fake_url, WORKER_CLASS=args.worker_class,
+                       EGRESS_PROXIES=','.join(url for _, url in proxies))
+            with run_gunicorn(args.worker_class, workers=args.workers, env=env, app=APP) as (_, base_url):
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                    results = list(pool.map(lambda n: download(base_url, name, n), range(args.requests)))
+                elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+        for proxy, _ in proxies:
+            proxy.shutdown()
+    statuses = {}
+    for status, _, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "statuses": statuses,
+        "latency": summarize([seconds for status, seconds, _, _ in results if status == 200]),
+        "seconds": round(elapsed, 2),
+        "mb_per_second": round(sum(nbytes for _, _, nbytes, _ in results) / elapsed / 1e6, 2),
+        "bot_detections": server.counts.get('bot_detection', 0),
+        "wrong_ip_media_requests": server.counts.get('wrong_ip', 0),
+        "tunnels_per_proxy": [proxy.counts.get('tunnels', 0) for proxy, _ in proxies],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default=','.join(MODES), help='comma-separated, from: ' + ', '.join(MODES))
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='bytes per progressive download')
+    parser.add_argument('--seconds', type=int, default=30, help='length of the generated audio')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='delay of each fake YouTube API response')
+    parser.add_argument('--address-rate', type=int, default=2_000_000, help='media bytes/s per client address')
+    args = parser.parse_args()
+
+    files = make_test_media(os.path.join(tempfile.gettempdir(), 'youtube-python-bench-media', str(args.seconds)), args.seconds)
+    # Progressive downloads stay synthetic (args.size bytes); merges need real audio
+    files = {path: files[path] for path in ('/audio.m4a', '/audio.webm')}
+    results = {name: run_mode(name, args, files) for name in args.modes.split(',')}
+    print_json({"benchmark": "egress", "params": vars(args), "results": results})
+
+
+if __name__ == '__main__':
+    main()
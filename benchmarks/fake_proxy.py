@@ -0,0 +1,139 @@
+"""Local stand-in egress proxies, so the egress pool can be benchmarked offline.
+
+start_fake_proxy() runs an HTTP CONNECT or SOCKS5 proxy on 127.0.0.1 whose
+outgoing connections leave from its own loopback address (127.0.0.2, ...), so
+the fake YouTube server sees every proxy as a different client address, the
+way YouTube sees different egress IPs.
+"""
+import socket
+import socketserver
+import threading
+import time
+
+
+class FakeProxyHandler(socketserver.BaseRequestHandler):
+    """Tunnels one client connection: HTTP CONNECT, or SOCKS5 if the first
+    byte says so. Tunnelled bytes are throttled to self.server.rate bytes/s
+    per connection (if set); with self.server.down set, connections are
+    dropped as if the proxy had gone away.
+    """
+
+    def _recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('client went away')
+            data += chunk
+        return data
+
+    def _connect_http(self, first):
+        data = first
+        while b'\r\n\r\n' not in data:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return None
+            data += chunk
+        method, target = data.split(b'\r\n', 1)[0].split()[:2]
+        if method != b'CONNECT':
+            self.request.sendall(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+            return None
+        host, port = target.decode().rsplit(':', 1)
+        try:
+            upstream = self._open(host, int(port))
+        except OSError:
+            self.request.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+            return None
+        self.request.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        return upstream
+
+    def _connect_socks(self):
+        methods = self._recv_exact(self._recv_exact(1)[0])
+        if 0 not in methods:
+            self.request.sendall(b'\x05\xff')
+            return None
+        self.request.sendall(b'\x05\x00')
+        _, command, _, address_type = self._recv_exact(4)
+        if address_type == 1:
+            host = socket.inet_ntop(socket.AF_INET, self._recv_exact(4))
+        elif address_type == 4:
+            host = socket.inet_ntop(socket.AF_INET6, self._recv_exact(16))
+        else:
+            host = self._recv_exact(self._recv_exact(1)[0]).decode('idna')
+        port = int.from_bytes(self._recv_exact(2), 'big')
+        try:
+            upstream = self._open(host, port) if command == 1 else None
+        except OSError:
+            upstream = None
+        self.request.sendall(b'\x05' + (b'\x00' if upstream else b'\x05') + b'\x00\x01' + bytes(6))
+        return upstream
+
+    def _open(self, host, port):
+        upstream = socket.create_connection((host, port), timeout=30, source_address=(self.server.source_ip, 0))
+        with self.server.lock:
+            self.server.counts['tunnels'] = self.server.counts.get('tunnels', 0) + 1
+        return upstream
+
+    def _pipe(self, source, target, direction):
+        started = time.time()
+        sent = 0
+        try:
+            while True:
+                data = source.recv(64 * 1024)
+                if not data:
+                    break
+                target.sendall(data)
+                sent += len(data)
+                if self.server.rate and direction == 'down':
+                    ahead = sent / self.server.rate - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except OSError:
+            pass
+        finally:
+            with self.server.lock:
+                self.server.counts[f'bytes_{direction}'] = self.server.counts.get(f'bytes_{direction}', 0) + sent
+            for sock in (source, target):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def handle(self):
+        if self.server.down:
+            return
+        first = self.request.recv(1)
+        if not first:
+            return
+        upstream = self._connect_socks() if first == b'\x05' else self._connect_http(first)
+        if upstream is None:
+            return
+        try:
+            up = threading.Thread(target=self._pipe, args=(self.request, upstream, 'up'), daemon=True)
+            up.start()
+            self._pipe(upstream, self.request, 'down')
+            up.join()
+        finally:
+            upstream.close()
+
+
+class _ProxyServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_fake_proxy(source_ip, scheme='http', rate=None):
+    """Start a FakeProxyHandler server in a background thread; returns (server, proxy_url).
+
+    Tunnels leave from source_ip, a loopback address such as '127.0.0.2'.
+    scheme ('http' or 'socks5h') only picks the URL returned: the server
+    speaks both.
+    """
+    server = _ProxyServer(('127.0.0.1', 0), FakeProxyHandler)
+    server.source_ip = source_ip
+    server.rate = rate
+    server.down = False
+    server.lock = threading.Lock()
+    server.counts = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{scheme}://127.0.0.1:{server.server_address[1]}'
@@ -0,0 +1,136 @@
+"""A local stand-in for a Redis server, so the redis cache backend can be checked offline.
+
+FakeRedisHandler speaks enough of RESP2 for redis-py and RedisCacheBackend:
+PING, GET, SET (with EX, PX and NX), DEL, and EVAL of the scripts in
+SCRIPTS. HELLO switches to RESP2 or RESP3, which here only differ in the null reply
+and HELLO's own; CLIENT and SELECT are answered with OK. Keys expire like
+Redis's.
+"""
+import socketserver
+import threading
+import time
+
+# Lua scripts FakeRedisHandler can EVAL: script -> fn(store, keys, args)
+SCRIPTS = {
+    # Compare-and-delete, as used to release a lock only by its owner
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0":
+        lambda store, keys, args: store.delete(keys[0]) if store.get(keys[0]) == args[0] else 0,
+}
+
+
+class _Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # key -> (value, expires_at or None)
+
+    def get(self, key):
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self.values[key]
+            return None
+        return value
+
+    def delete(self, key):
+        return 1 if self.get(key) is not None and self.values.pop(key, None) else 0
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Answers the commands of one client connection until it closes."""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.decode().split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def _reply(self, value):
+        if value is None:
+            data = b'_\r\n' if self.server.protocol == 3 else b'$-1\r\n'
+        elif isinstance(value, int):
+            data = b':%d\r\n' % value
+        elif isinstance(value, Exception):
+            data = b'-ERR %s\r\n' % str(value).encode()
+        elif value == 'OK':
+            data = b'+OK\r\n'
+        elif isinstance(value, dict):
+            head = b'%%%d\r\n' if self.server.protocol == 3 else b'*%d\r\n'
+            data = head % (len(value) * (2 if self.server.protocol == 2 else 1))
+            for key, item in value.items():
+                data += b'$%d\r\n%s\r\n:%d\r\n' % (len(key), key, item)
+        else:
+            data = b'$%d\r\n%s\r\n' % (len(value), value)
+        self.wfile.write(data)
+
+    def _set(self, store, key, value, options):
+        expires_at = None
+        nx = False
+        options = [option.upper() if isinstance(option, bytes) else option for option in options]
+        while options:
+            option = options.pop(0)
+            if option == b'EX':
+                expires_at = time.time() + int(options.pop(0))
+            elif option == b'PX':
+                expires_at = time.time() + int(options.pop(0)) / 1000
+            elif option == b'NX':
+                nx = True
+            else:
+                return ValueError(f'unsupported SET option {option!r}')
+        if nx and store.get(key) is not None:
+            return None
+        store.values[key] = (value, expires_at)
+        return 'OK'
+
+    def _execute(self, args):
+        command = args[0].upper() if isinstance(args[0], bytes) else args[0].upper().encode()
+        store = self.server.store
+        with store.lock:
+            self.server.counts[command.decode()] = self.server.counts.get(command.decode(), 0) + 1
+            if command == b'HELLO':
+                self.server.protocol = int(args[1]) if len(args) > 1 else 2
+                return {b'proto': self.server.protocol}
+            if command in (b'CLIENT', b'SELECT'):
+                return 'OK'
+            if command == b'PING':
+                return b'PONG'
+            if command == b'GET':
+                return store.get(args[1])
+            if command == b'SET':
+                return self._set(store, args[1], args[2], list(args[3:]))
+            if command == b'DEL':
+                return sum(store.delete(key) for key in args[1:])
+            if command == b'EVAL':
+                script = SCRIPTS.get(args[1].decode())
+                if script is None:
+                    return ValueError('unknown script')
+                numkeys = int(args[2])
+                return script(store, args[3:3 + numkeys], args[3 + numkeys:])
+            return ValueError(f'unknown command {command.decode()!r}')
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if not args:
+                return
+            self._reply(self._execute(args))
+            self.wfile.flush()
+
+
+class _RedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_fake_redis():
+    """Start a FakeRedisHandler server in a background thread; returns (server, redis_url)."""
+    server = _RedisServer(('127.0.0.1', 0), FakeRedisHandler)
+    server.store = _Store()
+    server.protocol = 2
+    server.counts = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'redis://127.0.0.1:{server.server_address[1]}/0'
@@ -0,0 +1,356 @@
+"""A local stand-in for YouTube and googlevideo, so extraction can be benchmarked offline.
+
+FakeYouTubeHandler answers the requests pytubefix makes while extracting a
+video (the watch page, the player's base.js and the InnerTube player API) with
+canned responses, and serves the media those responses point at. Any 11
+character video ID is valid. redirect_youtube() points pytubefix's HTTPS
+requests for YouTube hosts at the fake server.
+
+Bot detection can be injected: a player request from one of server.bot_clients
+is answered with YouTube's "Sign in to confirm you're not a bot" response with
+probability server.bot_rate, and so is every player request from an address
+in server.bot_addresses. Formats whose itag is in server.hidden_itags
+are left out of player responses.
+
+Playlists are served too: /playlist?list=ID lists server.playlist_length
+videos, 100 per page. Like YouTube's, the browse endpoint stops giving
+continuation tokens after server.browse_limit entries; the rest can only be
+read from the playlist panel of the watch page (the next endpoint), which
+lists the 100 entries either side of its video.
+
+Like googlevideo's, media URLs carry the address they were issued to; with
+server.check_ip set, media requests from any other address get a 403. With
+server.address_rate set, all media sent to one address shares that many
+bytes/s, on top of MediaHandler's per-connection rate.
+"""
+import http.client
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.common import MediaHandler
+
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'youtubei.googleapis.com', 'img.youtube.com')
+PLAYER_JS_PATH = '/s/player/fake0001/player_ias.vflset/en_US/base.js'
+SIGNATURE_TIMESTAMP = 20000
+VIDEO_SECONDS = 60
+BOT_DETECTION_REASON = 'Sign in to confirm you’re not a bot'
+VISITOR_DATA = 'CgtGYWtlVmlzaXRvcg%3D%3D'
+PLAYLIST_PAGE = 100
+
+# itag: (media path, mimeType, extra format fields)
+FORMATS = {
+    18: ('/progressive.mp4', 'video/mp4; codecs="avc1.42001E, mp4a.40.2"',
+         {"width": 640, "height": 360, "qualityLabel": "360p", "fps": 30, "audioQuality": "AUDIO_QUALITY_LOW"}),
+    136: ('/video.mp4', 'video/mp4; codecs="avc1.4d401f"',
+          {"width": 1280, "height": 720, "qualityLabel": "720p", "fps": 30}),
+    137: ('/video.mp4', 'video/mp4; codecs="avc1.640028"',
+          {"width": 1920, "height": 1080, "qualityLabel": "1080p", "fps": 30}),
+    140: ('/audio.m4a', 'audio/mp4; codecs="mp4a.40.2"', {"audioQuality": "AUDIO_QUALITY_MEDIUM"}),
+    251: ('/audio.webm', 'audio/webm; codecs="opus"', {"audioQuality": "AUDIO_QUALITY_MEDIUM"}),
+}
+PROGRESSIVE_ITAGS = (18,)
+
+
+class FakeYouTubeHandler(MediaHandler):
+    """Serves the watch page, base.js, the InnerTube player API, thumbnails
+    and /videoplayback/<video_id>/<itag> media.
+
+    Media paths map to self.server.files like MediaHandler's; itags whose
+    file isn't present are served as self.server.media_size synthetic bytes.
+    API responses are delayed by self.server.api_latency seconds.
+    """
+
+    def _media_path(self):
+        match = re.match(r"/videoplayback/[\w-]{11}/(\d+)", self.path)
+        if match and int(match.group(1)) in FORMATS:
+            return FORMATS[int(match.group(1))][0]
+        return None
+
+    def _body(self):
+        path = self._media_path()
+        return self.server.files.get(path) if path else None
+
+    def _send(self, body, content_type):
+        time.sleep(self.server.api_latency)
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, name):
+        with self.server.lock:
+            self.server.counts[name] = self.server.counts.get(name, 0) + 1
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path in ('/watch', '/embed') or path.startswith('/embed/'):
+            self._count('watch')
+            video_id = parse_qs(urlparse(self.path).query).get('v', [path.rsplit('/', 1)[-1]])[0]
+            return self._send(watch_html(video_id), 'text/html; charset=utf-8')
+        if path == PLAYER_JS_PATH:
+            self._count('player_js')
+            return self._send(player_js(self.server.player_js_size), 'text/javascript')
+        if path == '/playlist':
+            self._count('playlist')
+            return self._send(playlist_html(self.server), 'text/html; charset=utf-8')
+        if path.startswith('/vi/'):
+            self._count('thumbnail')
+            return self._send(self.server.thumbnail, 'image/jpeg')
+        if path.startswith('/videoplayback/'):
+            if not self._address_allowed():
+                return self.send_error(403)
+            self._count('media')
+            return super().do_GET()
+        self.send_error(404)
+
+    def do_HEAD(self):
+        if urlparse(self.path).path.startswith('/videoplayback/'):
+            if not self._address_allowed():
+                return self.send_error(403)
+            return super().do_HEAD()
+        self.send_error(404)
+
+    def _address_allowed(self):
+        if not self.server.check_ip:
+            return True
+        if parse_qs(urlparse(self.path).query).get('ip', [None])[0] == self.client_address[0]:
+            return True
+        self._count('wrong_ip')
+        return False
+
+    def setup(self):
+        super().setup()
+        if self.server.address_rate:
+            self.wfile = _AddressThrottle(self.wfile, self.server, self.client_address[0])
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = urlparse(self.path).path
+        if path == '/youtubei/v1/browse':
+            self._count('browse')
+            page = int(body.get('continuation', 'page-0').split('-')[1])
+            response = {"onResponseReceivedActions": [{"appendContinuationItemsAction": {
+                "continuationItems": playlist_items(self.server, page)}}]}
+            return self._send(json.dumps(response), 'application/json')
+        if path == '/youtubei/v1/next':
+            self._count('next')
+            return self._send(json.dumps(playlist_panel(self.server, body.get('videoId', ''))), 'application/json')
+        if path != '/youtubei/v1/player':
+            self.send_error(404)
+            return
+        client = body.get('context', {}).get('client', {}).get('clientName', '')
+        self._count('player')
+        with self.server.lock:
+            bot_detected = (client in self.server.bot_clients and self.server.random.random() < self.server.bot_rate
+                            or self.client_address[0] in self.server.bot_addresses)
+        if bot_detected:
+            self._count('bot_detection')
+            response = {"playabilityStatus": {"status": "LOGIN_REQUIRED", "reason": BOT_DETECTION_REASON}}
+        else:
+            response = player_response(body.get('videoId', ''), self.server.base_url, self.server.sizes,
+                                       self.server.hidden_itags, self.client_address[0])
+        response["responseContext"] = {"visitorData": VISITOR_DATA}
+        self._send(json.dumps(response), 'application/json')
+
+
+class _AddressThrottle:
+    """A handler's wfile, sharing server.address_rate bytes/s with every
+    other connection from the same address.
+    """
+
+    def __init__(self, wfile, server, address):
+        self._wfile = wfile
+        self._server = server
+        self._address = address
+
+    def write(self, data):
+        with self._server.lock:
+            now = time.time()
+            # Each write takes the next free slot on the address's timeline
+            start = max(now, self._server.address_busy_until.get(self._address, 0))
+            self._server.address_busy_until[self._address] = start + len(data) / self._server.address_rate
+        delay = start + len(data) / self._server.address_rate - now
+        if delay > 0:
+            time.sleep(delay)
+        return self._wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._wfile, name)
+
+
+def watch_html(video_id):
+    return (
+        '<html><head><meta itemprop="datePublished" content="2024-01-02T03:04:05-08:00"></head><body>'
+        f'<script>ytcfg.set({{"PLAYER_JS_URL":"{PLAYER_JS_PATH}"}});</script>'
+        f'<script>var ytInitialData = {{"responseContext":{{"serviceTrackingParams":[{{"params":'
+        f'[{{"key":"visitor_data","value":"{VISITOR_DATA}"}}]}}]}},"videoId":"{video_id}"}};</script>'
+        '</body></html>'
+    )
+
+
+def playlist_video_id(index):
+    return f'pl{index:09d}'
+
+
+def playlist_items(server, page):
+    """Page page of the playlist as browse items, with a continuation while the browse limit allows."""
+    start = page * PLAYLIST_PAGE
+    end = min(start + PLAYLIST_PAGE, server.playlist_length)
+    items = [{"playlistVideoRenderer": {"videoId": playlist_video_id(i)}} for i in range(start, end)]
+    if end < min(server.playlist_length, server.browse_limit):
+        items.append({"continuationItemRenderer": {"continuationEndpoint": {
+            "continuationCommand": {"token": f'page-{page + 1}'}}}})
+    return items
+
+
+def playlist_html(server):
+    data = {
+        "responseContext": {"webResponseContextExtensionData": {"ytConfigData": {"visitorData": VISITOR_DATA}}},
+        "contents": {"twoColumnBrowseResultsRenderer": {"tabs": [{"tabRenderer": {"content": {
+            "sectionListRenderer": {"contents": [{"itemSectionRenderer": {"contents": [
+                {"playlistVideoListRenderer": {"contents": playlist_items(server, 0)}}
+            ]}}]}
+        }}}]}},
+    }
+    return f'<html><body><script>var ytInitialData = {json.dumps(data)};</script></body></html>'
+
+
+def playlist_panel(server, video_id):
+    """The watch page's playlist panel around video_id."""
+    try:
+        index = int(video_id[2:]) if video_id.startswith('pl') else 0
+    except ValueError:
+        index = 0
+    entries = range(max(0, index - PLAYLIST_PAGE), min(server.playlist_length, index + PLAYLIST_PAGE + 1))
+    return {"contents": {"twoColumnWatchNextResults": {"playlist": {"playlist": {"contents": [
+        {"playlistPanelVideoRenderer": {"videoId": playlist_video_id(i)}} for i in entries
+    ]}}}}}
+
+
+def player_js(size=0):
+    # Just enough of base.js for pytubefix: the signature timestamp, and a
+    # signature and an n-parameter function for it to find and load into
+    # node. The stream URLs are pre-signed, so neither is ever called. It is
+    # padded with filler functions to about size bytes (YouTube's is ~2.5 MB).
+    filler = ''.join(f'var f{n}=function(a){{return a+{n}}};' for n in range(size // 30))
+    return (
+        'var _yt_player={};(function(g){' + filler +
+        'var Nq=function(a){return a.split("").reverse().join("")};var Nl=[Nq];'
+        'var Sg=function(a){a=a.split("");a.reverse();return a.join("")};'
+        f'g.config={{signatureTimestamp:{SIGNATURE_TIMESTAMP}}};'
+        '})(_yt_player);'
+    )
+
+
+def player_response(video_id, base_url, sizes, hidden_itags=(), ip='127.0.0.1'):
+    expire = int(time.time()) + 6 * 60 * 60
+    formats, adaptive = [], []
+    for itag, (path, mime_type, fields) in FORMATS.items():
+        if itag in hidden_itags:
+            continue
+        entry = dict(
+            fields,
+            itag=itag,
+            url=f'{base_url}/videoplayback/{video_id}/{itag}?expire={expire}&ip={ip}&sig=fake',
+            mimeType=mime_type,
+            bitrate=1_000_000,
+            contentLength=str(sizes[path]),
+            approxDurationMs=str(VIDEO_SECONDS * 1000),
+            lastModified='1700000000000000',
+        )
+        (formats if itag in PROGRESSIVE_ITAGS else adaptive).append(entry)
+    return {
+        "playabilityStatus": {"status": "OK"},
+        "playerConfig": {"mediaCommonConfig": {"mediaUstreamerRequestConfig": {"videoPlaybackUstreamerConfig": ""}}},
+        "streamingData": {"expiresInSeconds": "21540", "formats": formats, "adaptiveFormats": adaptive},
+        "videoDetails": {
+            "videoId": video_id,
+            "title": f"Fake video {video_id}",
+            "lengthSeconds": str(VIDEO_SECONDS),
+            "author": "Fake channel",
+            "shortDescription": "A video served by the benchmark's fake YouTube.",
+            "viewCount": "12345",
+            "thumbnail": {"thumbnails": [{"url": f"{base_url}/vi/{video_id}/maxresdefault.jpg", "width": 1280, "height": 720}]},
+        },
+    }
+
+
+def start_fake_youtube(media_size, files=None, rate=None, latency=0.0, api_latency=0.0,
+                       bot_rate=0.0, bot_clients=('WEB',), seed=0, player_js_size=0,
+                       bot_addresses=(), check_ip=False, address_rate=None):
+    """Start a FakeYouTubeHandler server in a background thread; returns (server, base_url).
+
+    files maps media paths ('/progressive.mp4', '/video.mp4', '/audio.m4a',
+    '/audio.webm') to local files; missing ones are media_size synthetic bytes.
+    '/thumbnail.jpg' is served for every thumbnail. base.js is padded to
+    about player_js_size bytes.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeYouTubeHandler)
+    server.daemon_threads = True
+    server.files = {}
+    for path, filename in (files or {}).items():
+        with open(filename, 'rb') as f:
+            server.files[path] = f.read()
+    server.media_size = media_size
+    server.sizes = {path: len(server.files[path]) if path in server.files else media_size
+                    for path, _, _ in FORMATS.values()}
+    server.rate = rate
+    server.latency = latency
+    server.api_latency = api_latency
+    server.bot_rate = bot_rate
+    server.bot_clients = set(bot_clients)
+    server.bot_addresses = set(bot_addresses)
+    server.check_ip = check_ip
+    server.address_rate = address_rate
+    server.address_busy_until = {}
+    server.hidden_itags = set()
+    server.random = random.Random(seed)
+    server.player_js_size = player_js_size
+    server.playlist_length = 250
+    server.browse_limit = 200
+    server.thumbnail = server.files.get('/thumbnail.jpg', bytes(range(256)) * 64)
+    server.lock = threading.Lock()
+    server.counts = {}
+    server.base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.base_url
+
+
+class _RedirectHandler(urllib.request.HTTPSHandler):
+    """Sends HTTPS requests for YouTube hosts to the fake server over plain HTTP."""
+
+    def __init__(self, base_url, connection):
+        super().__init__()
+        self.target = urlparse(base_url).netloc
+        self.connection = connection
+
+    def https_open(self, req):
+        if req.host.split(':')[0] not in YOUTUBE_HOSTS:
+            return super().https_open(req)
+        return self.do_open(_connection_to(self.target, self.connection), req)
+
+
+def _connection_to(netloc, connection):
+    def connect(host, timeout=None, **kwargs):
+        if connection:
+            return connection('http', netloc, timeout=timeout)
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+    return connect
+
+
+def redirect_youtube(base_url, connection=None):
+    """Route urllib's (and so pytubefix's) requests for YouTube hosts to the fake server.
+
+    pytubefix calls urllib.request.urlopen, which uses the globally installed
+    opener. connection(scheme, netloc, timeout=...), if given, opens the
+    connections, e.g. through the app's egress pool.
+    """
+    urllib.request.install_opener(urllib.request.build_opener(_RedirectHandler(base_url, connection)))
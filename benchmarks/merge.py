@@ -0,0 +1,65 @@
+"""CPU cost of ffmpeg merges: always transcoding audio to AAC vs the stream-copy fast path.
+
+Merges a generated H.264 video with AAC or opus audio, served by a local media
+server, once per case, and reports ffmpeg's CPU seconds per minute of merged
+video. "transcode_aac" is the merge every download used to run.
+
+    python -m benchmarks.merge --seconds 120
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+import main
+from benchmarks.common import make_test_media, print_json, start_media_server
+
+# name: (profile, audio file, copy audio?)
+CASES = {
+    "transcode_aac": ('mp4', '/audio.m4a', False),
+    "mp4_remux": ('mp4', '/audio.m4a', True),
+    "mkv_passthrough_opus": ('mkv', '/audio.webm', True),
+    "mp4_transcode_opus": ('mp4', '/audio.webm', False),
+}
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(media_url, profile, audio_path, copy_audio, seconds):
+    cpu_started, started = children_cpu(), time.perf_counter()
+    size = 0
+    for chunk in main.stream_with_ffmpeg_merge(media_url + '/video.mp4', media_url + audio_path, profile, copy_audio):
+        size += len(chunk)
+    cpu = children_cpu() - cpu_started
+    return {
+        "output_bytes": size,
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_seconds_per_minute": round(cpu / (seconds / 60), 3),
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=int, default=120, help='length of the generated test video')
+    parser.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), 'youtube-python-bench-media'))
+    args = parser.parse_args()
+
+    files = make_test_media(os.path.join(args.media_dir, str(args.seconds)), args.seconds)
+    server, media_url = start_media_server(0, files=files)
+    try:
+        results = {
+            name: measure(media_url, profile, audio_path, copy_audio, args.seconds)
+            for name, (profile, audio_path, copy_audio) in CASES.items()
+        }
+    finally:
+        server.shutdown()
+    print_json({"benchmark": "merge", "params": vars(args), "results": results})
+
+
+if __name__ == '__main__':
+    run()
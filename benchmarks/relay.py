@@ -0,0 +1,107 @@
+"""Progressive relay throughput through gunicorn: the app's relay vs older relay loops.
+
+Runs the app under gunicorn once per relay loop and downloads SIZE bytes COUNT
+times back to back from an unthrottled local media server, over one
+connection (segmented fetching is off). Reports MB/s, CPU seconds per GB of
+the gunicorn processes, and whether every body arrived complete. The loops:
+
+- read: the app's relay_upstream, which yields upstream.read(RELAY_CHUNK_SIZE)
+- readinto_copy: readinto one reusable buffer, yielding a bytes copy of it
+- read_4096: the original urlopen-era loop, read(4096)
+
+    python -m benchmarks.relay --size 268435456 --count 4
+"""
+import argparse
+import os
+import time
+
+import main
+from benchmarks import bench_app
+from benchmarks.common import (VIDEO_URL, print_json, process_tree, process_usage, request, run_gunicorn,
+                               start_media_server)
+
+
+def relay_readinto_copy(upstream, chunk_size=main.RELAY_CHUNK_SIZE):
+    buffer = memoryview(bytearray(chunk_size))
+    try:
+        while True:
+            size = upstream._response.readinto(buffer)
+            if not size:
+                break
+            yield bytes(buffer[:size])
+    finally:
+        upstream.close()
+
+
+def relay_read_4096(upstream):
+    try:
+        while True:
+            chunk = upstream.read(4096)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        upstream.close()
+
+
+RELAYS = {
+    "read": main.relay_upstream,
+    "readinto_copy": relay_readinto_copy,
+    "read_4096": relay_read_4096,
+}
+
+
+def create_app():
+    """bench_app.create_app() relaying with the BENCH_RELAY loop."""
+    main.relay_upstream = RELAYS[os.environ['BENCH_RELAY']]
+    return bench_app.create_app()
+
+
+def cpu_seconds(pid):
+    total = 0.0
+    for child in process_tree(pid):
+        try:
+            total += process_usage(child)[0]
+        except OSError:
+            pass
+    return total
+
+
+def measure(relay, args, media_url):
+    env = {"BENCH_MEDIA_URL": media_url, "BENCH_MEDIA_SIZE": str(args.size), "BENCH_RELAY": relay,
+           "SEGMENT_CONNECTIONS": "1"}
+    with run_gunicorn(args.worker_class, env=env, app='benchmarks.relay:create_app()') as (process, base_url):
+        # Warm up the worker and its upstream connection
+        request(base_url, 'POST', '/download/360p', {"url": VIDEO_URL})
+        cpu_started = cpu_seconds(process.pid)
+        started = time.perf_counter()
+        results = [request(base_url, 'POST', '/download/360p', {"url": VIDEO_URL}) for _ in range(args.count)]
+        wall = time.perf_counter() - started
+        cpu = cpu_seconds(process.pid) - cpu_started
+    total = sum(nbytes for _, _, nbytes, _ in results)
+    return {
+        "complete": all(status == 200 and nbytes == args.size for status, _, nbytes, _ in results),
+        "bytes": total,
+        "mb_per_s": round(total / wall / 1e6, 1),
+        "cpu_seconds_per_gb": round(cpu / (total / 1e9), 3) if total else None,
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--count', type=int, default=4)
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--relays', default=','.join(RELAYS), help='comma-separated, from: ' + ', '.join(RELAYS))
+    args = parser.parse_args()
+
+    server, media_url = start_media_server(args.size)
+    try:
+        results = {relay: measure(relay, args, media_url) for relay in args.relays.split(',')}
+    finally:
+        server.shutdown()
+    print_json({"benchmark": "relay", "params": vars(args), "results": results})
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,269 @@
+"""Load-test scenarios against a local fake YouTube, with machine-readable results.
+
+Runs the app under gunicorn with pytubefix pointed at benchmarks.fake_youtube,
+so every scenario goes through real extraction, stream selection, relaying and
+ffmpeg merges without touching YouTube. Each scenario gets a fresh server (cold
+caches) and reports latency and time-to-first-byte percentiles, throughput,
+status codes, CPU seconds and RSS of the gunicorn process tree, and how many
+requests reached the fake YouTube.
+
+    python -m benchmarks.scenarios --concurrency 20 --requests 200 --output run.json
+    python -m benchmarks.scenarios --compare run.json
+
+--compare reports the ratio of each headline metric to a previous run's and
+lists those that got worse by more than --threshold. /playlist and /channel
+are not covered: the fake YouTube has no browse API.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import (make_test_media, print_json, process_tree, process_usage, request, run_gunicorn,
+                               summarize)
+from benchmarks.fake_youtube import start_fake_youtube
+
+APP = 'benchmarks.bench_app:create_offline_app()'
+
+
+def video_url(n):
+    return f'https://www.youtube.com/watch?v=bench{n:06d}'
+
+
+# name: description, how many distinct videos, whether to warm them first,
+# extra server env, injected bot-detection rate, itags the fake YouTube should
+# leave out, and a function of the request number returning (method, path, body)
+SCENARIOS = {
+    "metadata_cold": {
+        "description": "/video_info for a new video every request, so each one is extracted",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/video_info', {"url": video_url(i)}),
+    },
+    "metadata_fields_cold": {
+        "description": "metadata_cold asking only for title and length",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/video_info', {"url": video_url(i), "fields": "title,length"}),
+    },
+    "metadata_full_cold": {
+        "description": "/available_resolutions for a new video every request: a full extraction with streams and signatures",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/available_resolutions', {"url": video_url(i)}),
+    },
+    "metadata_hot": {
+        "description": "/video_info and /available_resolutions for a few cached videos",
+        "videos": 5, "warm": True, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', ('/video_info', '/available_resolutions')[i % 2], {"url": video_url(i % 5)}),
+    },
+    "metadata_bot_detection": {
+        "description": "metadata_cold with half of WEB client player requests bot-detected",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.5,
+        "request": lambda i: ('POST', '/video_info', {"url": video_url(i)}),
+    },
+    "batch": {
+        "description": "/video_info/batch with 10 new videos per request",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/video_info/batch', {"urls": [video_url(i * 10 + n) for n in range(10)]}),
+    },
+    "relay_cold": {
+        "description": "/download/360p progressive relay of a new video every request",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/download/360p', {"url": video_url(i)}),
+    },
+    "relay_hot": {
+        "description": "/download/360p progressive relay of a few already-extracted videos",
+        "videos": 5, "warm": True, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/download/360p', {"url": video_url(i % 5)}),
+    },
+    "relay_hot_expiring": {
+        "description": "relay_hot with cache entries expiring every 10 s, kept fresh by background prefetch "
+                       "(run long enough to span several expiries)",
+        "videos": 5, "warm": True, "bot_rate": 0.0,
+        "env": {"VIDEO_CACHE_TTL": "10", "PREFETCH_LEAD": "6", "PREFETCH_INTERVAL": "0.5", "PREFETCH_JITTER": "0.5",
+                "PREFETCH_MIN_SCORE": "1"},
+        "request": lambda i: ('POST', '/download/360p', {"url": video_url(i % 5)}),
+    },
+    "relay_hot_expiring_no_prefetch": {
+        "description": "relay_hot_expiring with prefetch disabled, so expired videos are extracted on the request path",
+        "videos": 5, "warm": True, "bot_rate": 0.0, "env": {"VIDEO_CACHE_TTL": "10", "PREFETCH_TOP_K": "0"},
+        "request": lambda i: ('POST', '/download/360p', {"url": video_url(i % 5)}),
+    },
+    "merge": {
+        "description": "/download/1080p ffmpeg merge (stream copy), a new video every request",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/download/1080p', {"url": video_url(i)}),
+    },
+    "merge_transcode": {
+        "description": "/download/1080p into MP4 from opus audio (the AAC track is hidden), so the audio is transcoded",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0, "hidden_itags": {140},
+        "request": lambda i: ('POST', '/download/1080p', {"url": video_url(i), "profile": "mp4"}),
+    },
+    "audio": {
+        "description": "/download/audio of a new video every request, cycling through m4a (relayed), opus, mp3 and wav",
+        "videos": None, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/download/audio', {"url": video_url(i), "format": ('m4a', 'opus', 'mp3', 'wav')[i % 4]}),
+    },
+    "merge_media_cache_hot": {
+        "description": "/download/1080p of a few videos already in the media cache",
+        "videos": 5, "warm": True, "env": {"MEDIA_CACHE_MAX_BYTES": str(4 * 1024 ** 3)}, "bot_rate": 0.0,
+        "request": lambda i: ('POST', '/download/1080p', {"url": video_url(i % 5)}),
+    },
+    "endpoints": {
+        "description": "Every other endpoint in turn, over a pool of 20 videos",
+        "videos": 20, "warm": False, "env": {}, "bot_rate": 0.0,
+        "request": lambda i: [
+            ('GET', '/check-connection', None),
+            ('POST', '/video_info', {"url": video_url(i % 20)}),
+            ('POST', '/available_resolutions', {"url": video_url(i % 20)}),
+            ('POST', '/available_resolutions/batch', {"urls": [video_url((i + n) % 20) for n in range(5)]}),
+            ('POST', '/download/360p', {"url": video_url(i % 20)}),
+            ('POST', '/download/best', {"url": video_url(i % 20), "profile": "mkv"}),
+            ('POST', '/download_thumbnail', {"url": video_url(i % 20)}),
+            ('GET', f'/thumbnail/bench{i % 20:06d}?width=320&format=webp', None),
+            ('POST', '/jobs', {"url": video_url(i % 20), "resolution": "720p"}),
+            ('GET', '/stats', None),
+            ('GET', '/metrics', None),
+            ('GET', '/help', None),
+        ][i % 12],
+    },
+}
+
+
+def tree_usage(pid):
+    cpu, rss = 0.0, 0
+    for child in process_tree(pid):
+        try:
+            child_cpu, child_rss = process_usage(child)
+        except OSError:
+            continue
+        cpu += child_cpu
+        rss += child_rss
+    return cpu, rss
+
+
+def run_scenario(name, args, server, fake_url):
+    scenario = SCENARIOS[name]
+    server.hidden_itags = scenario.get("hidden_itags", set())
+    server.bot_rate = scenario["bot_rate"]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict({"FAKE_YOUTUBE_URL": fake_url, "THUMBNAIL_BASE_URL": fake_url, "CACHE_DIR": cache_dir},
+                   **scenario["env"], **args.env)
+        with run_gunicorn(args.worker_class, workers=args.workers, env=env, app=APP) as (process, base_url):
+            if scenario["warm"]:
+                for i in range(scenario["videos"]):
+                    request(base_url, *scenario["request"](i))
+            counts_before = dict(server.counts)
+            cpu_before, _ = tree_usage(process.pid)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                results = list(pool.map(lambda i: request(base_url, *scenario["request"](i)), range(args.requests)))
+            elapsed = time.perf_counter() - started
+            cpu_after, rss = tree_usage(process.pid)
+    server.hidden_itags = set()
+    server.bot_rate = 0.0
+
+    statuses = {}
+    for status, _, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [r for r in results if 200 <= r[0] < 300]
+    return {
+        "description": scenario["description"],
+        "requests": len(results),
+        "statuses": statuses,
+        "error_rate": round(1 - len(ok) / len(results), 4),
+        "latency_seconds": summarize([r[1] for r in ok]),
+        "ttfb_seconds": summarize([r[3] for r in ok]),
+        "requests_per_second": round(len(results) / elapsed, 2),
+        "mb_per_second": round(sum(r[2] for r in ok) / elapsed / 1e6, 2),
+        "cpu_seconds": round(cpu_after - cpu_before, 3),
+        "cpu_ms_per_request": round((cpu_after - cpu_before) * 1000 / len(results), 2),
+        "rss_mb": round(rss / 1e6, 1),
+        "upstream": {key: server.counts.get(key, 0) - counts_before.get(key, 0) for key in server.counts},
+    }
+
+
+# metric path: True if bigger is better
+HEADLINE_METRICS = {
+    ("latency_seconds", "p50"): False,
+    ("latency_seconds", "p95"): False,
+    ("latency_seconds", "p99"): False,
+    ("ttfb_seconds", "p50"): False,
+    ("requests_per_second",): True,
+    ("mb_per_second",): True,
+    ("cpu_ms_per_request",): False,
+    ("rss_mb",): False,
+    ("error_rate",): False,
+}
+
+
+def metric(result, path):
+    for key in path:
+        result = result.get(key) if isinstance(result, dict) else None
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Ratio of each headline metric to the baseline's, and the regressions beyond threshold."""
+    comparison, regressions = {}, []
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        ratios = {}
+        for path, higher_is_better in HEADLINE_METRICS.items():
+            old, new = metric(before, path), metric(result, path)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            ratios[".".join(path)] = round(ratio, 3)
+            if (ratio < 1 - threshold) if higher_is_better else (ratio > 1 + threshold):
+                regressions.append(f'{name}.{".".join(path)}: {old} -> {new}')
+        comparison[name] = ratios
+    return {"baseline_params": baseline.get("params"), "ratios": comparison, "regressions": regressions}
+
+
+def parse_env(value):
+    key, _, val = value.partition('=')
+    return key, val
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='bytes per progressive download')
+    parser.add_argument('--seconds', type=int, default=30, help='length of the generated adaptive media')
+    parser.add_argument('--rate', type=int, default=None, help='upstream media bytes/s per connection')
+    parser.add_argument('--latency', type=float, default=0.0, help='upstream media time to first byte')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='delay of each fake YouTube API response')
+    parser.add_argument('--env', action='append', type=parse_env, default=[], metavar='KEY=VALUE',
+                        help='extra environment for the app, e.g. ADMISSION_CAPACITY=10000')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    args = parser.parse_args()
+    args.env = dict(args.env)
+
+    files = make_test_media(os.path.join(tempfile.gettempdir(), 'youtube-python-bench-media', str(args.seconds)), args.seconds)
+    server, fake_url = start_fake_youtube(args.size, files=files, rate=args.rate, latency=args.latency,
+                                          api_latency=args.api_latency)
+    try:
+        results = {name: run_scenario(name, args, server, fake_url) for name in args.scenarios.split(',')}
+    finally:
+        server.shutdown()
+    output = {"benchmark": "scenarios", "params": vars(args), "results": results}
+    if args.compare:
+        with open(args.compare) as f:
+            output["comparison"] = compare(results, json.load(f), args.threshold)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    print_json(output)
+
+
+if __name__ == '__main__':
+    main()
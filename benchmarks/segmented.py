@@ -0,0 +1,80 @@
+"""Wall-clock time to deliver a large progressive download, one connection vs parallel segments.
+
+Downloads a SIZE-byte stream through the app from a local media server that
+throttles each connection to RATE bytes/s, like googlevideo. With
+SEGMENT_CONNECTIONS=1 the app relays it over a single connection (the old
+path); with more it fetches byte ranges in parallel and reassembles them.
+Peak RSS of the gunicorn workers shows the cost of the in-flight window.
+
+    python -m benchmarks.segmented --size 1073741824 --rate 16000000 --connections 1,4,8
+"""
+import argparse
+import threading
+import time
+
+from benchmarks.common import (VIDEO_URL, print_json, process_tree, process_usage, request, run_gunicorn,
+                               start_media_server)
+
+
+def run_mode(connections, args, media_url):
+    env = {
+        "BENCH_MEDIA_URL": media_url,
+        "BENCH_MEDIA_SIZE": str(args.size),
+        "SEGMENT_CONNECTIONS": str(connections),
+        "SEGMENT_SIZE": str(args.segment_size),
+    }
+    with run_gunicorn(args.worker_class, workers=1, env=env) as (process, base_url):
+        peak_rss = 0
+        done = threading.Event()
+
+        def sample_rss():
+            nonlocal peak_rss
+            while not done.is_set():
+                rss = 0
+                for pid in process_tree(process.pid)[1:]:
+                    try:
+                        rss += process_usage(pid)[1]
+                    except OSError:
+                        pass
+                peak_rss = max(peak_rss, rss)
+                time.sleep(0.2)
+
+        sampler = threading.Thread(target=sample_rss)
+        sampler.start()
+        cpu_before = sum(process_usage(pid)[0] for pid in process_tree(process.pid))
+        status, seconds, nbytes, ttfb = request(base_url, 'POST', '/download/360p', {"url": VIDEO_URL})
+        cpu = sum(process_usage(pid)[0] for pid in process_tree(process.pid)) - cpu_before
+        done.set()
+        sampler.join()
+
+    return {
+        "status": status,
+        "bytes": nbytes,
+        "complete": nbytes == args.size,
+        "seconds": round(seconds, 2),
+        "mb_per_s": round(nbytes / seconds / 1e6, 2),
+        "ttfb_seconds": round(ttfb, 3),
+        "cpu_seconds": round(cpu, 2),
+        "peak_worker_rss_mb": round(peak_rss / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1024 ** 3, help='bytes in the download')
+    parser.add_argument('--rate', type=int, default=16_000_000, help='upstream bytes/s per connection')
+    parser.add_argument('--connections', default='1,4,8', help='SEGMENT_CONNECTIONS values to compare')
+    parser.add_argument('--segment-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--worker-class', default='gevent')
+    args = parser.parse_args()
+
+    server, media_url = start_media_server(args.size, rate=args.rate)
+    try:
+        results = {f"connections_{n}": run_mode(int(n), args, media_url) for n in args.connections.split(',')}
+    finally:
+        server.shutdown()
+    print_json({"benchmark": "segmented", "params": vars(args), "results": results})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Compare the sync and gevent worker classes under slow concurrent downloads.
+
+Starts DOWNLOADS concurrent progressive downloads from a throttled local media
+server and, while they run, measures /video_info latency. With sync workers
+each download pins a worker process; with gevent they share one.
+
+    python -m benchmarks.serving --downloads 50 --rate 1000000
+"""
+import argparse
+import threading
+import time
+
+from benchmarks.common import (VIDEO_URL, print_json, request, run_concurrently, run_gunicorn,
+                               start_media_server, summarize)
+
+
+def run_mode(worker_class, args, media_url):
+    env = {
+        "BENCH_MEDIA_URL": media_url,
+        "BENCH_MEDIA_SIZE": str(args.size),
+        # Room for every download, so only the worker class limits them
+        "ADMISSION_CAPACITY": str(args.downloads * 100),
+    }
+    with run_gunicorn(worker_class, workers=args.workers, env=env) as (_, base_url):
+        info_latencies = []
+        done = threading.Event()
+
+        def poll_video_info():
+            while not done.is_set():
+                status, seconds, _, _ = request(base_url, 'POST', '/video_info', {"url": VIDEO_URL})
+                if status == 200:
+                    info_latencies.append(seconds)
+                time.sleep(0.05)
+
+        poller = threading.Thread(target=poll_video_info)
+        started = time.time()
+        poller.start()
+        results = run_concurrently(
+            args.downloads,
+            lambda i: request(base_url, 'POST', '/download/360p', {"url": VIDEO_URL}),
+        )
+        elapsed = time.time() - started
+        done.set()
+        poller.join()
+
+    ok = [r for r in results if isinstance(r, tuple) and r[0] == 200 and r[2] == args.size]
+    return {
+        "downloads_ok": len(ok),
+        "downloads_failed": args.downloads - len(ok),
+        "download_seconds": summarize([r[1] for r in ok]),
+        "aggregate_mb_per_s": round(sum(r[2] for r in ok) / elapsed / 1e6, 2),
+        "video_info_seconds": summarize(info_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--downloads', type=int, default=50)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='bytes per download')
+    parser.add_argument('--rate', type=int, default=1_000_000, help='upstream bytes/s per connection')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--modes', default='sync,gevent')
+    args = parser.parse_args()
+
+    server, media_url = start_media_server(args.size, rate=args.rate)
+    try:
+        results = {mode: run_mode(mode, args, media_url) for mode in args.modes.split(',')}
+    finally:
+        server.shutdown()
+    print_json({"benchmark": "serving", "params": vars(args), "results": results})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Gunicorn settings, loaded automatically from the working directory.
+#
+# The default worker class is gevent: upstream sockets and ffmpeg pipes become
+# cooperative, so one worker process can relay thousands of slow downloads
+# while /video_info and the other metadata endpoints stay responsive.
+# Set WORKER_CLASS=sync to get one request per worker process instead.
+import os
+import shutil
+import tempfile
+
+worker_class = os.environ.get('WORKER_CLASS', 'gevent')
+# Maximum simultaneous clients per gevent worker
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+# Async workers keep heartbeating while streaming, so long downloads are not
+# killed; sync workers need a timeout long enough for a whole download.
+timeout = int(os.environ.get('WORKER_TIMEOUT', 30 if worker_class == 'sync' else 120))
+
+# PRELOAD=1 imports the app once in the master and forks the workers from it
+# (see main.preload), so new workers start with pytubefix loaded and the
+# player JS cached, sharing that memory copy-on-write.
+preload_app = os.environ.get('PRELOAD', '0') == '1'
+if preload_app:
+    # Sentry starts threads, which don't survive the fork; each worker sets it
+    # up on its first request instead
+    os.environ.setdefault('FAST_START', '1')
+    if worker_class == 'gevent':
+        # The app creates locks at import, so they must already be gevent's
+        from gevent import monkey
+        monkey.patch_all()
+
+# Each worker writes its Prometheus samples to files in this directory so that
+# /metrics, whichever worker serves it, reports totals for the whole server.
+# It must be set before the app (and prometheus_client) is imported.
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(
+    os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'youtube-python-cache')), 'metrics'
+))
+
+
+def reset_metrics_dir():
+    # Samples left by a previous run would be added to this one's. Only once
+    # per master: the config is read again on reload (HUP).
+    if os.environ.get('METRICS_DIR_RESET') != str(os.getpid()):
+        os.environ['METRICS_DIR_RESET'] = str(os.getpid())
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+# With PRELOAD the app is imported before on_starting runs
+if preload_app:
+    reset_metrics_dir()
+
+
+def on_starting(server):
+    reset_metrics_dir()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    if preload_app:
+        import main
+        main.preload()
@@ -1,5 +1,4 @@
 from flask import Flask, request, jsonify, send_file, Response, stream_with_context
-from pytubefix import YouTube
 import re
 import ssl
 import os
@@ -7,31 +6,80 @@ import sentry_sdk
 import threading
 import subprocess
 import shutil
+import time
+import json
+import sqlite3
+import tempfile
+import uuid
+import hashlib
+import itertools
+import heapq
+import random
+import math
+import fcntl
+import socket
+import select
+import base64
+import urllib.request
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
 from io import BytesIO
-from urllib.request import urlopen
-from urllib.parse import quote
-from functools import wraps
-
-FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
-
-# Initialize Sentry
-sentry_sdk.init(
-    dsn="https://703c70222d9f64e1b656b744a9267205@o480658.ingest.us.sentry.io/4510664628109312",
-    # Add data like request headers and IP for users,
-    # see https://docs.sentry.io/platforms/python/data-management/data-collected/ for more info
-    send_default_pii=True,
-    # Enable sending logs to Sentry
-    enable_logs=True,
-)
+import http.client
+from urllib.parse import quote, unquote, urlsplit, urljoin
+from functools import wraps, lru_cache
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_date
+from werkzeug.wsgi import wrap_file
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+# Startup-optimized mode for serverless and autoscaled containers: Sentry is
+# set up on the first request instead of at import, with only the
+# integrations the app uses (loading them all takes longer than the rest of
+# the app). pytubefix is always imported on first use.
+FAST_START = os.environ.get('FAST_START', '0') == '1'
+startup_stats = {"fast_start": FAST_START, "preloaded": False, "sentry_initialized": False}
+_sentry_lock = threading.Lock()
+
+def init_sentry():
+    with _sentry_lock:
+        if startup_stats["sentry_initialized"]:
+            return
+        options = {}
+        if FAST_START:
+            # Only the integrations this app uses: by default Sentry imports
+            # every library it supports that happens to be installed
+            # (aiohttp alone takes ~100 ms)
+            from sentry_sdk.integrations.flask import FlaskIntegration
+            options = {"auto_enabling_integrations": False, "integrations": [FlaskIntegration()]}
+            if os.environ.get('CACHE_BACKEND') == 'redis':
+                from sentry_sdk.integrations.redis import RedisIntegration
+                options["integrations"].append(RedisIntegration())
+        sentry_sdk.init(
+            dsn="https://703c70222d9f64e1b656b744a9267205@o480658.ingest.us.sentry.io/4510664628109312",
+            # Add data like request headers and IP for users,
+            # see https://docs.sentry.io/platforms/python/data-management/data-collected/ for more info
+            send_default_pii=True,
+            # Enable sending logs to Sentry
+            enable_logs=True,
+            **options,
+        )
+        startup_stats["sentry_initialized"] = True
+
+if not FAST_START:
+    init_sentry()
+
+@lru_cache(maxsize=None)
+def ffmpeg_available():
+    return shutil.which('ffmpeg') is not None
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
 app = Flask(__name__)
 app.json.ensure_ascii = False
 
-# Rate limiting: Max 6 simultaneous downloads
-download_semaphore = threading.BoundedSemaphore(value=6)
-
 # Security: API Key required for functional endpoints
 API_KEY = os.environ.get('API_KEY', 'X-eGKp0yitrTNE4LXilSo_9zsDbOcwcqgj7qLTkhVT0')
 
@@ -44,314 +92,4274 @@ def require_api_key(f):
             return jsonify({"error": "Unauthorized: Invalid or missing API Key."}), 401
     return decorated_function
 
+# Prometheus metrics, served on /metrics. Labels only take values from small
+# fixed sets (route templates, client names, resolution buckets), so the
+# number of series stays bounded. Under gunicorn, gunicorn.conf.py sets
+# PROMETHEUS_MULTIPROC_DIR so /metrics aggregates every worker.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 2 ** n for n in range(14))  # 64 KiB/s to 512 MiB/s
+
+REQUESTS = Counter('youtube_api_requests_total', 'HTTP requests by route and status', ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = Histogram(
+    'youtube_api_request_seconds', 'Time to build the response; streamed bodies are measured separately',
+    ['endpoint'], buckets=LATENCY_BUCKETS
+)
+VIDEO_LOOKUPS = Counter('youtube_api_video_lookups_total', 'Where video metadata came from', ['source'])
+EXTRACTION_SECONDS = Histogram(
+    'youtube_api_extraction_seconds', 'YouTube extraction attempts by client and outcome',
+    ['client', 'outcome'], buckets=LATENCY_BUCKETS
+)
+STREAM_SELECTION_SECONDS = Histogram(
+    'youtube_api_stream_selection_seconds', 'Choosing streams from a resolved video', ['mode'], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_TTFB_SECONDS = Histogram(
+    'youtube_api_upstream_ttfb_seconds', 'Upstream request sent to response headers received',
+    ['connection'], buckets=LATENCY_BUCKETS
+)
+FFMPEG_FIRST_CHUNK_SECONDS = Histogram(
+    'youtube_api_ffmpeg_first_chunk_seconds', 'ffmpeg spawned to first output chunk', ['mode'], buckets=LATENCY_BUCKETS
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    'youtube_api_admission_wait_seconds', 'Time spent waiting for admission', ['class', 'outcome'], buckets=LATENCY_BUCKETS
+)
+DOWNLOAD_BYTES = Counter('youtube_api_download_bytes_total', 'Bytes streamed to download clients', ['kind', 'resolution'])
+DOWNLOAD_SECONDS = Histogram(
+    'youtube_api_download_seconds', 'Duration of streamed downloads', ['kind', 'resolution'], buckets=LATENCY_BUCKETS
+)
+DOWNLOAD_THROUGHPUT = Histogram(
+    'youtube_api_download_throughput_bytes_per_second', 'Average throughput of each streamed download',
+    ['kind'], buckets=THROUGHPUT_BUCKETS
+)
+DOWNLOADS_IN_FLIGHT = Gauge('youtube_api_downloads_in_flight', 'Downloads being streamed', ['kind'], multiprocess_mode='livesum')
+FFMPEG_PROCESSES = Gauge('youtube_api_ffmpeg_processes', 'Running ffmpeg merges', multiprocess_mode='livesum')
+EGRESS_REQUESTS = Counter('youtube_api_egress_requests_total', 'Outbound requests and extractions by egress and outcome',
+                          ['egress', 'outcome'])
+
+def resolution_bucket(stream):
+    """Bounded metrics label for a stream's resolution."""
+    resolution = getattr(stream, 'resolution', None)
+    if not resolution:
+        return 'audio'
+    height = int(re.match(r"\d+", resolution).group())
+    for limit, label in ((360, '<=360p'), (480, '480p'), (720, '720p'), (1080, '1080p')):
+        if height <= limit:
+            return label
+    return '>1080p'
+
+def measure_download(chunks, kind, resolution):
+    """Pass chunks through, recording bytes, duration and throughput of the download."""
+    in_flight = DOWNLOADS_IN_FLIGHT.labels(kind)
+    sent_bytes = DOWNLOAD_BYTES.labels(kind, resolution)
+    in_flight.inc()
+    started = time.monotonic()
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            sent_bytes.inc(len(chunk))
+            yield chunk
+    finally:
+        in_flight.dec()
+        elapsed = time.monotonic() - started
+        DOWNLOAD_SECONDS.labels(kind, resolution).observe(elapsed)
+        if sent and elapsed > 0:
+            DOWNLOAD_THROUGHPUT.labels(kind).observe(sent / elapsed)
+
+@app.before_request
+def start_request_timer():
+    request.started_at = time.monotonic()
+    if not startup_stats["sentry_initialized"]:
+        init_sentry()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(time.monotonic() - request.started_at)
+    return response
+
 # Client fallback order for bot detection
 CLIENTS = ['WEB', 'TV_EMBED', 'IOS', 'ANDROID']
 
+# Video cache: resolved metadata + stream manifests, shared by all endpoints.
+# Entries are dropped VIDEO_CACHE_EXPIRY_MARGIN seconds before the signed
+# googlevideo URLs in them expire, or after VIDEO_CACHE_TTL, whichever is first.
+VIDEO_CACHE_TTL = int(os.environ.get('VIDEO_CACHE_TTL', 4 * 60 * 60))
+VIDEO_CACHE_EXPIRY_MARGIN = int(os.environ.get('VIDEO_CACHE_EXPIRY_MARGIN', 10 * 60))
+VIDEO_CACHE_MAX_ENTRIES = int(os.environ.get('VIDEO_CACHE_MAX_ENTRIES', 500))
+VIDEO_CACHE_MAX_BYTES = int(os.environ.get('VIDEO_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+INFO_FIELDS = ('title', 'author', 'length', 'views', 'description', 'publish_date', 'thumbnail_url')
+STREAM_FIELDS = (
+    'itag', 'url', 'title', 'mime_type', 'type', 'subtype', 'codecs', 'video_codec', 'audio_codec',
+    'resolution', 'fps', 'abr', 'is_progressive', 'is_adaptive', 'includes_audio_track',
+    'includes_video_track', 'is_dash', 'is_drc', 'audio_track_name',
+)
+
+def extract_video_id(url):
+    match = re.search(r"(?:[?&]v=|youtu\.be/)([\w-]+)", url)
+    return match.group(1) if match else None
+
+class CachedStream:
+    """Plain-data copy of a pytubefix Stream, safe to share between requests."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    @classmethod
+    def from_stream(cls, stream, egress=None):
+        fields = {name: getattr(stream, name, None) for name in STREAM_FIELDS}
+        # Only keep the size if YouTube sent it; Stream.filesize would do a HEAD request
+        fields['filesize'] = getattr(stream, '_filesize', 0) or None
+        # Name of the egress the URL was issued to, the only one it works from
+        fields['egress'] = egress
+        return cls(**fields)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class VideoSnapshot:
+    """Resolved metadata and stream manifest of one video.
+
+    Exposes the same attributes the endpoints read from a YouTube object
+    (title, author, ..., streams) so it can be used in its place. A
+    metadata-only snapshot has just some of the INFO_FIELDS and no streams.
+    """
+
+    def __init__(self, video_id, info, streams, expires_at):
+        self.video_id = video_id
+        self.info = info
+        from pytubefix.query import StreamQuery
+        self.streams = StreamQuery(streams) if streams is not None else None
+        self.expires_at = expires_at
+
+    def __getattr__(self, name):
+        info = self.__dict__.get('info', {})
+        if name in info:
+            return info[name]
+        raise AttributeError(name)
+
+    @property
+    def has_streams(self):
+        return self.streams is not None
+
+    def covers(self, fields=(), streams=True):
+        """Whether this snapshot can answer a request for fields (and streams)."""
+        return (self.has_streams or not streams) and all(name in self.info for name in fields)
+
+    @classmethod
+    def from_youtube(cls, yt, video_id=None, fields=None, egress=None):
+        """Resolve a YouTube object: everything, or with fields, only those
+        info fields. The latter skips the stream manifest, signature
+        deciphering and the poToken, which need the player JS and node.
+        egress names the egress yt was extracted through.
+        """
+        if fields is not None:
+            # Two things pytubefix does for a WEB player request only matter
+            # to stream URLs: signing it with the signature timestamp from
+            # base.js, and running botGuard in node for a poToken it then adds
+            # to them. Skip both: send the request unsigned, and give it a
+            # placeholder token, which no stream URL will carry
+            yt._signature_timestamp = {'playbackContext': {'contentPlaybackContext': {'html5Preference': 'HTML5_PREF_WANTS'}}}
+            yt._pot = 'unused'
+            # Raises for bot detection, private videos etc., which reading
+            # some fields alone would not
+            yt.check_availability()
+            info = {name: getattr(yt, name) for name in fields}
+            return cls(video_id or yt.video_id, info, None, time.time() + VIDEO_CACHE_TTL)
+        streams = [CachedStream.from_stream(s, egress) for s in yt.streams]
+        info = {name: getattr(yt, name) for name in INFO_FIELDS}
+        expires_at = time.time() + VIDEO_CACHE_TTL
+        for stream in streams:
+            match = re.search(r"[?&]expire=(\d+)", stream.url or '')
+            if match:
+                expires_at = min(expires_at, int(match.group(1)) - VIDEO_CACHE_EXPIRY_MARGIN)
+        return cls(video_id or yt.video_id, info, streams, expires_at)
+
+    @classmethod
+    def from_dict(cls, data):
+        info = dict(data['info'])
+        if info.get('publish_date'):
+            info['publish_date'] = datetime.fromisoformat(info['publish_date'])
+        streams = [CachedStream(**s) for s in data['streams']] if data['streams'] is not None else None
+        return cls(data['video_id'], info, streams, data['expires_at'])
+
+    def to_dict(self):
+        """JSON-serializable form, used by the shared cache backends."""
+        info = dict(self.info)
+        if isinstance(info.get('publish_date'), datetime):
+            info['publish_date'] = info['publish_date'].isoformat()
+        return {
+            "video_id": self.video_id,
+            "info": info,
+            "streams": [s.to_dict() for s in self.streams] if self.has_streams else None,
+            "expires_at": self.expires_at,
+        }
+
+    def estimated_size(self):
+        return len(json.dumps(self.to_dict()))
+
+class VideoCache:
+    """Thread-safe TTL + LRU cache of VideoSnapshots keyed by video ID."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # video_id -> (snapshot, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, video_id):
+        _, size = self._entries.pop(video_id)
+        self._bytes -= size
+
+    def get(self, video_id, fields=(), streams=True):
+        """The cached snapshot if it covers fields (and streams), else None."""
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry and entry[0].expires_at <= time.time():
+                self._remove(video_id)
+                self.expirations += 1
+                entry = None
+            if entry is None or not entry[0].covers(fields, streams):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(video_id)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, video_id):
+        """The cached snapshot, even if expired, without counting a lookup or touching its LRU position."""
+        with self._lock:
+            entry = self._entries.get(video_id)
+            return entry[0] if entry else None
+
+    def put(self, snapshot):
+        if snapshot.expires_at <= time.time():
+            return
+        size = snapshot.estimated_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if snapshot.video_id in self._entries:
+                existing = self._entries[snapshot.video_id][0]
+                if not snapshot.has_streams and existing.expires_at > time.time():
+                    if existing.has_streams:
+                        # Never replace a full snapshot with a metadata-only one
+                        return
+                    snapshot.info = dict(existing.info, **snapshot.info)
+                self._remove(snapshot.video_id)
+            self._entries[snapshot.video_id] = (snapshot, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+video_cache = VideoCache(VIDEO_CACHE_MAX_ENTRIES, VIDEO_CACHE_MAX_BYTES)
+
+# Shared cache backend, so gunicorn workers and replicas reuse each other's
+# extractions: 'memory' (per-process only), 'sqlite' or 'redis'.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'youtube-python-cache'))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# How long one worker may hold the extraction lock for a video
+EXTRACTION_LOCK_TIMEOUT = int(os.environ.get('EXTRACTION_LOCK_TIMEOUT', 30))
+# How long a failed extraction is shared with the workers that waited for it
+EXTRACTION_ERROR_TTL = 10
+
+class CacheBackend:
+    """Cache shared between processes. Stores JSON-serializable values with expiry.
+
+    This base class shares nothing; every lock is granted immediately.
+    """
+
+    name = 'memory'
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def acquire_lock(self, key, ttl):
+        """Return a token if the lock was taken, otherwise None."""
+        return 'local'
+
+    def release_lock(self, key, token):
+        pass
+
+class SQLiteCacheBackend(CacheBackend):
+    """On-disk backend shared by all processes on the host."""
+
+    name = 'sqlite'
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'cache.sqlite3')
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._sets = 0
+        db = self._connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, token TEXT, expires_at REAL)")
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, or with the
+        # process a preloaded worker was forked from
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        db = self._connect()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), now + ttl)
+        )
+        self._sets += 1
+        if self._sets % 100 == 0:
+            db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+
+    def acquire_lock(self, key, ttl):
+        db = self._connect()
+        token = uuid.uuid4().hex
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM locks WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO locks (key, token, expires_at) VALUES (?, ?, ?)",
+                (key, token, now + ttl)
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return token if cursor.rowcount == 1 else None
+
+    def release_lock(self, key, token):
+        self._connect().execute("DELETE FROM locks WHERE key = ? AND token = ?", (key, token))
+
+class RedisCacheBackend(CacheBackend):
+    """Backend for any Redis-protocol server, shared by all hosts using it."""
+
+    name = 'redis'
+    # Only delete the lock if we still own it
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url, prefix='youtube-python:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def acquire_lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        if self.client.set(self.prefix + 'lock:' + key, token, nx=True, px=int(ttl * 1000)):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        self.client.eval(self.RELEASE_SCRIPT, 1, self.prefix + 'lock:' + key, token)
+
+def create_cache_backend(name):
+    if name == 'sqlite':
+        return SQLiteCacheBackend(CACHE_DIR)
+    if name == 'redis':
+        return RedisCacheBackend(REDIS_URL)
+    return CacheBackend()
+
+shared_cache = create_cache_backend(CACHE_BACKEND)
+shared_cache_stats = {"hits": 0, "misses": 0, "lock_waits": 0, "errors": 0}
+
+def get_shared_snapshot(video_id):
+    """Look a video up in the shared backend. Backend errors count as a miss."""
+    try:
+        data = shared_cache.get('video:' + video_id)
+    except Exception as e:
+        shared_cache_stats["errors"] += 1
+        sentry_sdk.capture_exception(e)
+        return None
+    if data and data['expires_at'] > time.time():
+        shared_cache_stats["hits"] += 1
+        return VideoSnapshot.from_dict(data)
+    shared_cache_stats["misses"] += 1
+    return None
+
+def acquire_extraction_lock(video_id):
+    """Take the backend's extraction lock for a video; a backend error grants it."""
+    try:
+        return shared_cache.acquire_lock(video_id, EXTRACTION_LOCK_TIMEOUT)
+    except Exception as e:
+        shared_cache_stats["errors"] += 1
+        sentry_sdk.capture_exception(e)
+        return 'local'
+
+def get_shared_error(video_id, since):
+    """Error of an extraction of video_id that failed after since, if any."""
+    try:
+        data = shared_cache.get('video-error:' + video_id)
+    except Exception as e:
+        shared_cache_stats["errors"] += 1
+        sentry_sdk.capture_exception(e)
+        return None
+    if data and data['failed_at'] >= since:
+        return data['error']
+    return None
+
+def put_shared_error(video_id, error):
+    try:
+        shared_cache.set('video-error:' + video_id, {"error": error, "failed_at": time.time()}, EXTRACTION_ERROR_TTL)
+    except Exception as e:
+        shared_cache_stats["errors"] += 1
+        sentry_sdk.capture_exception(e)
+
+def put_shared_snapshot(snapshot):
+    try:
+        shared_cache.set('video:' + snapshot.video_id, snapshot.to_dict(), snapshot.expires_at - time.time())
+    except Exception as e:
+        shared_cache_stats["errors"] += 1
+        sentry_sdk.capture_exception(e)
+
+class SingleFlight:
+    """Lets concurrent callers for the same key share one in-flight call.
+
+    The first caller runs the function; callers arriving while it runs wait
+    and get the same result (or exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
+
+extraction_flight = SingleFlight()
+
 def get_youtube_object(url):
-    """Try multiple clients to avoid bot detection and other errors."""
-    from pytubefix import exceptions as yt_exceptions
+    """Return a VideoSnapshot for url, from the in-process cache, the shared
+    cache backend, or a fresh extraction (in that order).
+
+    Concurrent requests for the same video in this process join a single
+    extraction, and only one process extracts a given video at a time.
+    """
+    video_id = extract_video_id(url)
+    if not video_id:
+        VIDEO_LOOKUPS.labels('extraction').inc()
+        return extract_video(url, video_id)
+
+    prefetcher.record(video_id)
+    cached = video_cache.get(video_id)
+    if cached:
+        VIDEO_LOOKUPS.labels('memory').inc()
+        return cached, None
+
+    return extraction_flight.do(video_id, lambda: load_video(url, video_id))
+
+def get_video_metadata(url, fields=INFO_FIELDS):
+    """Return a VideoSnapshot with at least the given INFO_FIELDS for url.
+
+    Unlike get_youtube_object this doesn't resolve the stream manifest: a
+    cached snapshot is used if it has the fields, otherwise only the fields
+    are extracted. Metadata-only snapshots are cached in-process but not
+    published to the shared backend, where they would hide full ones.
+    """
+    video_id = extract_video_id(url)
+    if not video_id:
+        VIDEO_LOOKUPS.labels('extraction').inc()
+        return extract_video(url, video_id, fields)
+
+    cached = video_cache.get(video_id, fields, streams=False)
+    if cached:
+        VIDEO_LOOKUPS.labels('memory').inc()
+        return cached, None
+
+    return extraction_flight.do(f"{video_id}:{','.join(fields)}", lambda: load_video_metadata(url, video_id, fields))
+
+def load_video_metadata(url, video_id, fields):
+    snapshot = get_shared_snapshot(video_id)
+    if snapshot:
+        VIDEO_LOOKUPS.labels('shared').inc()
+        video_cache.put(snapshot)
+        return snapshot, None
+
+    # No cross-process lock: a metadata-only extraction is a single player
+    # API request, cheaper than waiting on another worker
+    VIDEO_LOOKUPS.labels('extraction').inc()
+    snapshot, error = extract_video(url, video_id, fields)
+    if snapshot:
+        video_cache.put(snapshot)
+    return snapshot, error
+
+def load_video(url, video_id, min_expires_at=0, admission_class='metadata'):
+    """Fetch a video from the shared backend, or extract and publish it.
+
+    Other processes extracting the same video hold its lock in the backend;
+    wait for them to publish the result (or their error) instead of
+    extracting it again. If the lock is released with neither, e.g. the
+    holder raised, the first waiter to retake it extracts. A shared snapshot
+    expiring before min_expires_at is extracted again.
+    """
+    snapshot = get_shared_snapshot(video_id)
+    if snapshot and snapshot.expires_at > min_expires_at:
+        VIDEO_LOOKUPS.labels('shared').inc()
+        video_cache.put(snapshot)
+        return snapshot, None
+
+    token = acquire_extraction_lock(video_id)
+    if not token:
+        # Another worker is extracting this video; wait for its result
+        shared_cache_stats["lock_waits"] += 1
+        started = time.time()
+        deadline = started + EXTRACTION_LOCK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(0.25)
+            snapshot = get_shared_snapshot(video_id)
+            if snapshot and snapshot.expires_at > min_expires_at:
+                VIDEO_LOOKUPS.labels('shared').inc()
+                video_cache.put(snapshot)
+                return snapshot, None
+            error = get_shared_error(video_id, started)
+            if error:
+                return None, error
+            token = acquire_extraction_lock(video_id)
+            if token:
+                break
+
+    try:
+        VIDEO_LOOKUPS.labels('extraction').inc()
+        snapshot, error = extract_video(url, video_id, admission_class=admission_class)
+        if snapshot:
+            video_cache.put(snapshot)
+            put_shared_snapshot(snapshot)
+        elif token != 'local':
+            put_shared_error(video_id, error)
+        return snapshot, error
+    finally:
+        if token:
+            try:
+                shared_cache.release_lock(video_id, token)
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+
+# Adaptive client ordering: clients are tried by rolling success rate and
+# latency instead of the fixed CLIENTS order. A client that is bot-detected
+# CLIENT_BREAKER_THRESHOLD times in a row is skipped for CLIENT_BREAKER_COOLDOWN
+# seconds (set the threshold to 0 to disable the circuit breaker).
+ADAPTIVE_CLIENT_ORDER = os.environ.get('ADAPTIVE_CLIENT_ORDER', '1') == '1'
+CLIENT_BREAKER_THRESHOLD = int(os.environ.get('CLIENT_BREAKER_THRESHOLD', 3))
+CLIENT_BREAKER_COOLDOWN = int(os.environ.get('CLIENT_BREAKER_COOLDOWN', 300))
+# Weight of the latest attempt in the rolling averages
+CLIENT_STATS_DECAY = 0.2
+
+class ClientHealth:
+    """Rolling success/latency statistics and circuit breakers per client."""
+
+    def __init__(self, clients):
+        self.clients = list(clients)
+        self._lock = threading.Lock()
+        self._stats = {
+            client: {
+                "attempts": 0,
+                "successes": 0,
+                "failures": 0,
+                "success_rate": 1.0,
+                "latency": None,
+                "consecutive_failures": 0,
+                "open_until": 0,
+            }
+            for client in self.clients
+        }
+
+    def record(self, client, ok, latency):
+        with self._lock:
+            stats = self._stats[client]
+            stats["attempts"] += 1
+            stats["successes" if ok else "failures"] += 1
+            stats["success_rate"] += CLIENT_STATS_DECAY * ((1.0 if ok else 0.0) - stats["success_rate"])
+            if stats["latency"] is None:
+                stats["latency"] = latency
+            else:
+                stats["latency"] += CLIENT_STATS_DECAY * (latency - stats["latency"])
+            if ok:
+                stats["consecutive_failures"] = 0
+                stats["open_until"] = 0
+            else:
+                stats["consecutive_failures"] += 1
+                if CLIENT_BREAKER_THRESHOLD and stats["consecutive_failures"] >= CLIENT_BREAKER_THRESHOLD:
+                    stats["open_until"] = time.time() + CLIENT_BREAKER_COOLDOWN
+
+    def _cost(self, client):
+        # Expected time to a successful extraction. Untried clients sort last,
+        # keeping their CLIENTS order until they are needed as a fallback.
+        stats = self._stats[client]
+        if stats["latency"] is None:
+            return float('inf')
+        return stats["latency"] / max(stats["success_rate"], 0.05)
+
+    def order(self):
+        """Clients to try, best first, skipping those with an open breaker.
+
+        If every breaker is open, all clients are returned, the one whose
+        breaker closes soonest first.
+        """
+        if not ADAPTIVE_CLIENT_ORDER:
+            return list(self.clients)
+        now = time.time()
+        with self._lock:
+            available = [c for c in self.clients if self._stats[c]["open_until"] <= now]
+            if not available:
+                return sorted(self.clients, key=lambda c: self._stats[c]["open_until"])
+            return sorted(available, key=self._cost)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            clients = {
+                client: dict(stats, circuit_open=stats["open_until"] > now)
+                for client, stats in self._stats.items()
+            }
+        return {"order": self.order(), "clients": clients}
+
+client_health = ClientHealth(CLIENTS)
+
+# Player JS: pytubefix keeps the player's base.js in memory once it has
+# downloaded it. It is also saved to disk, so a new process (or a new
+# instance sharing CACHE_DIR) starts with it instead of downloading it again
+# on its first extraction. pytubefix fetches a new one if YouTube's changed.
+PLAYER_JS_DIR = os.environ.get('PLAYER_JS_DIR', os.path.join(CACHE_DIR, 'player'))
+player_js_stats = {"checked": False, "loaded": False, "url": None, "saves": 0}
+_player_js_lock = threading.Lock()
+
+def load_player_js():
+    """Seed pytubefix with the player JS saved by an earlier process, once per process."""
+    import pytubefix
+    with _player_js_lock:
+        if player_js_stats["checked"]:
+            return
+        player_js_stats["checked"] = True
+        try:
+            with open(os.path.join(PLAYER_JS_DIR, 'base.js'), encoding='utf-8') as f:
+                url = f.readline().rstrip('\n')
+                js = f.read()
+        except OSError:
+            return
+        if url and js and pytubefix.__js_url__ is None:
+            pytubefix.__js__, pytubefix.__js_url__ = js, url
+            player_js_stats.update(loaded=True, url=url)
+
+def save_player_js():
+    """Save pytubefix's player JS to disk if it isn't the one already there."""
+    import pytubefix
+    url, js = pytubefix.__js_url__, pytubefix.__js__
+    if not url or not js or url == player_js_stats["url"]:
+        return
+    player_js_stats["url"] = url
+    part = os.path.join(PLAYER_JS_DIR, f'base.js.{uuid.uuid4().hex}.part')
+    try:
+        os.makedirs(PLAYER_JS_DIR, exist_ok=True)
+        with open(part, 'w', encoding='utf-8') as f:
+            f.write(url + '\n')
+            f.write(js)
+        os.replace(part, os.path.join(PLAYER_JS_DIR, 'base.js'))
+        player_js_stats["saves"] += 1
+    except OSError as e:
+        sentry_sdk.capture_exception(e)
+
+def preload():
+    """Warm the process gunicorn forks its workers from (PRELOAD=1, see gunicorn.conf.py).
+
+    Imports pytubefix, Pillow and Sentry's Flask integration, loads the saved
+    player JS and looks for ffmpeg, then freezes the heap so workers share all
+    of it copy-on-write instead of each paying for it on their first request.
+    Starts no threads and opens no connections, which wouldn't survive the
+    fork.
+    """
+    import gc
+    import importlib
+    for module in ('pytubefix', 'pytubefix.cipher', 'pytubefix.query',
+                   'sentry_sdk.integrations.flask', 'PIL.Image', 'PIL.ImageOps'):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            # Pillow is only needed for thumbnail variants, see resize_image
+            pass
+    # Sentry reads the metadata of every installed package the first time it
+    # looks up a version, and keeps it
+    sentry_sdk.utils.package_version('flask')
+    load_player_js()
+    ffmpeg_available()
+    startup_stats["preloaded"] = True
+    gc.freeze()
+
+def extract_video(url, video_id, fields=None, admission_class='metadata'):
+    """Try multiple clients to avoid bot detection and other errors.
+
+    With fields, only those info fields are resolved (see VideoSnapshot.from_youtube).
+    Raises AdmissionRejected if the host is too busy to extract right now.
+    """
+    ticket = admission.acquire(admission_class)
+    try:
+        return extract_with_clients(url, video_id, fields)
+    finally:
+        ticket.release()
+
+def extract_with_clients(url, video_id, fields=None):
+    from pytubefix import YouTube, exceptions as yt_exceptions
+    load_player_js()
     last_error = None
-    for client in CLIENTS:
-        try:
-            yt = YouTube(url, client=client)
-            # Test access by checking streams
-            _ = yt.streams
-            return yt, None
-        except (yt_exceptions.BotDetection, yt_exceptions.UnknownVideoError) as e:
-            last_error = e
-            sentry_sdk.capture_exception(e)
-            continue
-        except Exception as e:
-            sentry_sdk.capture_exception(e)
-            return None, f"({type(e).__name__}): {str(e)}"
+    egress = egress_pool.choose()
+    egress.acquire()
+    tried = [egress]
+    clients = client_health.order()
+    attempt = 0
+    try:
+        while attempt < len(clients):
+            client = clients[attempt]
+            started = time.time()
+            try:
+                with egress_pool.use(egress):
+                    yt = YouTube(url, client=client)
+                    # Resolving the snapshot touches yt.streams (or checks availability
+                    # for a metadata-only one), which tests access
+                    snapshot = VideoSnapshot.from_youtube(yt, video_id, fields, egress.name)
+                client_health.record(client, True, time.time() - started)
+                egress.record(True, time.time() - started, extraction=True)
+                EXTRACTION_SECONDS.labels(client, 'ok').observe(time.time() - started)
+                save_player_js()
+                return snapshot, None
+            except (yt_exceptions.BotDetection, yt_exceptions.UnknownVideoError) as e:
+                # Only bot detection counts against the client: an unknown
+                # video fails for every client, and must not open their breakers
+                if isinstance(e, yt_exceptions.BotDetection):
+                    client_health.record(client, False, time.time() - started)
+                outcome = 'bot_detection' if isinstance(e, yt_exceptions.BotDetection) else 'unknown_video'
+                EXTRACTION_SECONDS.labels(client, outcome).observe(time.time() - started)
+                last_error = e
+                sentry_sdk.capture_exception(e)
+                if isinstance(e, yt_exceptions.BotDetection):
+                    # YouTube flags addresses as much as clients: retire this
+                    # egress for a while and retry the client through another
+                    egress.record(False, extraction=True)
+                    egress.quarantine()
+                    previous, egress = egress, egress_pool.switch(egress, tried)
+                    if egress is not previous:
+                        continue
+                attempt += 1
+            except Exception as e:
+                EXTRACTION_SECONDS.labels(client, 'error').observe(time.time() - started)
+                sentry_sdk.capture_exception(e)
+                if isinstance(e, OSError):
+                    # e.g. the proxy is down; retry the client through another egress
+                    egress.record(False, extraction=True)
+                    previous, egress = egress, egress_pool.switch(egress, tried)
+                    if egress is not previous:
+                        last_error = e
+                        continue
+                return None, f"({type(e).__name__}): {str(e)}"
+    finally:
+        egress.release()
     sentry_sdk.capture_message(f"All clients failed for URL: {url}")
     return None, f"All clients failed. Last error: {str(last_error)}"
 
-def get_stream_object(url, resolution):
+# Output profiles for downloads, selected with the 'profile' request parameter.
+# Merges stream-copy the audio when its codec fits the container and only
+# transcode it otherwise (e.g. opus audio into MP4).
+OUTPUT_PROFILES = {
+    'mp4': {
+        "ext": "mp4", "mimetype": "video/mp4", "audio_only": False, "progressive": True,
+        "video_subtype": "mp4", "audio_subtype": "mp4", "passthrough_subtype": None,
+        "copy_audio_codecs": ("mp4a",),
+        "transcode_audio": ['-c:a', 'aac', '-b:a', '192k'],
+        "format": ['-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4'],
+    },
+    'mkv': {
+        "ext": "mkv", "mimetype": "video/x-matroska", "audio_only": False, "progressive": False,
+        "video_subtype": None, "audio_subtype": None, "passthrough_subtype": None,
+        "copy_audio_codecs": ("mp4a", "opus", "vorbis"),
+        "transcode_audio": ['-c:a', 'aac', '-b:a', '192k'],
+        "format": ['-f', 'matroska'],
+    },
+    'webm': {
+        "ext": "webm", "mimetype": "video/webm", "audio_only": False, "progressive": False,
+        "video_subtype": "webm", "audio_subtype": "webm", "passthrough_subtype": None,
+        "copy_audio_codecs": ("opus", "vorbis"),
+        "transcode_audio": ['-c:a', 'libopus', '-b:a', '160k'],
+        "format": ['-f', 'webm'],
+    },
+    # Audio only: m4a is relayed as-is when YouTube has an mp4 audio stream
+    'm4a': {
+        "ext": "m4a", "mimetype": "audio/mp4", "audio_only": True, "progressive": False,
+        "video_subtype": None, "audio_subtype": "mp4", "passthrough_subtype": "mp4",
+        "copy_audio_codecs": ("mp4a",),
+        "transcode_audio": ['-c:a', 'aac', '-b:a', '192k'],
+        "format": ['-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4'],
+    },
+    'opus': {
+        "ext": "opus", "mimetype": "audio/ogg", "audio_only": True, "progressive": False,
+        "video_subtype": None, "audio_subtype": "webm", "passthrough_subtype": None,
+        "copy_audio_codecs": ("opus",),
+        "transcode_audio": ['-c:a', 'libopus', '-b:a', '160k'],
+        "format": ['-f', 'opus'],
+    },
+    'mp3': {
+        "ext": "mp3", "mimetype": "audio/mpeg", "audio_only": True, "progressive": False,
+        "video_subtype": None, "audio_subtype": None, "passthrough_subtype": None,
+        "copy_audio_codecs": (),
+        "transcode_audio": ['-c:a', 'libmp3lame', '-b:a', '192k'],
+        "format": ['-f', 'mp3'],
+    },
+    # 16 kHz mono PCM, the input most speech recognition models expect
+    'wav': {
+        "ext": "wav", "mimetype": "audio/wav", "audio_only": True, "progressive": False,
+        "video_subtype": None, "audio_subtype": None, "passthrough_subtype": None,
+        "copy_audio_codecs": (),
+        "transcode_audio": ['-ac', '1', '-ar', '16000', '-c:a', 'pcm_s16le'],
+        "format": ['-f', 'wav'],
+    },
+}
+DEFAULT_PROFILE = 'mp4'
+
+def get_audio_stream(yt, profile):
+    """Best audio stream for a profile, preferring the profile's container."""
+    audio_subtype = OUTPUT_PROFILES[profile]["audio_subtype"]
+    audio_stream = None
+    if audio_subtype:
+        audio_stream = yt.streams.filter(adaptive=True, only_audio=True, file_extension=audio_subtype).order_by('abr').desc().first()
+    if not audio_stream:
+        audio_stream = yt.streams.filter(adaptive=True, only_audio=True).order_by('abr').desc().first()
+    return audio_stream
+
+def get_audio_only_streams(yt, profile, bitrate=None):
+    """(stream, error, audio_stream) for an audio-only profile.
+
+    Audio already in the profile's container is returned as the stream to
+    relay directly, unless a bitrate was asked for; anything else is
+    returned as audio_stream for ffmpeg.
+    """
+    audio_stream = get_audio_stream(yt, profile)
+    if not audio_stream:
+        return None, "No audio streams found for this video.", None
+    if not bitrate and audio_stream.subtype == OUTPUT_PROFILES[profile]["passthrough_subtype"]:
+        return audio_stream, None, None
+    return None, None, audio_stream
+
+def get_stream_object(url, resolution, profile=DEFAULT_PROFILE):
+    yt, error = get_youtube_object(url)
+    if not yt:
+        return None, error, None
+    
+    try:
+        with STREAM_SELECTION_SECONDS.labels('resolution').time():
+            settings = OUTPUT_PROFILES[profile]
+            if settings["audio_only"]:
+                return get_audio_only_streams(yt, profile)
+
+            # Try progressive first (has audio)
+            if settings["progressive"]:
+                stream = yt.streams.filter(progressive=True, file_extension='mp4', resolution=resolution).first()
+                if stream:
+                    return stream, None, None
+        
+            # Fall back to adaptive (video-only, needs audio merge)
+            video_stream = yt.streams.filter(adaptive=True, only_video=True, file_extension=settings["video_subtype"], resolution=resolution).first()
+            if video_stream:
+                return video_stream, None, get_audio_stream(yt, profile)
+        
+            return None, "Video with the specified resolution not found.", None
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return None, f"({type(e).__name__}): {str(e)}", None
+
+def get_best_stream(url, profile=DEFAULT_PROFILE):
     yt, error = get_youtube_object(url)
     if not yt:
         return None, error, None
     
     try:
-        # Try progressive first (has audio)
-        stream = yt.streams.filter(progressive=True, file_extension='mp4', resolution=resolution).first()
-        if stream:
-            return stream, None, None
-        
-        # Fall back to adaptive (video-only, needs audio merge)
-        video_stream = yt.streams.filter(adaptive=True, file_extension='mp4', resolution=resolution).first()
-        if video_stream:
-            # Prefer m4a/mp4 audio, fall back to webm if needed
-            audio_stream = yt.streams.filter(adaptive=True, only_audio=True, file_extension='mp4').order_by('abr').desc().first()
-            if not audio_stream:
-                audio_stream = yt.streams.filter(adaptive=True, only_audio=True).order_by('abr').desc().first()
-            return video_stream, None, audio_stream
-        
-        return None, "Video with the specified resolution not found.", None
+        with STREAM_SELECTION_SECONDS.labels('best').time():
+            settings = OUTPUT_PROFILES[profile]
+            if settings["audio_only"]:
+                return get_audio_only_streams(yt, profile)
+
+            # Try progressive first (has audio)
+            if settings["progressive"]:
+                stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
+                if stream:
+                    return stream, None, None
+        
+            # Fall back to best adaptive (video-only, needs audio merge)
+            video_stream = yt.streams.filter(adaptive=True, only_video=True, file_extension=settings["video_subtype"]).order_by('resolution').desc().first()
+            if video_stream:
+                return video_stream, None, get_audio_stream(yt, profile)
+        
+            label = settings["video_subtype"].upper() if settings["video_subtype"] else "video"
+            return None, f"No {label} streams found for this video.", None
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return None, f"({type(e).__name__}): {str(e)}", None
+
+def get_info_fields(value):
+    """(fields, error) from a 'fields' parameter: a list or comma-separated
+    string of INFO_FIELDS, all of them if not given.
+    """
+    if value is None:
+        return INFO_FIELDS, None
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+        return None, "'fields' must be a list or a comma-separated string of field names."
+    names = {name.strip() for name in value}
+    unknown = sorted(names - set(INFO_FIELDS))
+    if unknown or not names:
+        return None, f"Invalid 'fields'{': ' + ', '.join(unknown) if unknown else ''}. Choose from: {', '.join(INFO_FIELDS)}."
+    return tuple(name for name in INFO_FIELDS if name in names), None
+
+def get_video_info(url, fields=INFO_FIELDS):
+    yt, error = get_video_metadata(url, fields)
+    if not yt:
+        return None, error
+    
+    try:
+        video_info = {name: getattr(yt, name) for name in fields}
+        return video_info, None
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return None, f"({type(e).__name__}): {str(e)}"
+
+def get_available_resolutions(url):
+    yt, error = get_youtube_object(url)
+    if not yt:
+        return None, error
+
+    try:
+        progressive_resolutions = list(set([
+            stream.resolution 
+            for stream in yt.streams.filter(progressive=True, file_extension='mp4')
+            if stream.resolution
+        ]))
+        all_resolutions = list(set([
+            stream.resolution 
+            for stream in yt.streams.filter(file_extension='mp4')
+            if stream.resolution
+        ]))
+        # Get audio streams info
+        audio_streams = yt.streams.filter(adaptive=True, only_audio=True)
+        audio_info = [{"abr": s.abr, "mime": s.mime_type, "ext": s.subtype} for s in audio_streams]
+
+        return {
+            "progressive": sorted(progressive_resolutions),
+            "all": sorted(all_resolutions),
+            "audio_streams": audio_info,
+            "ffmpeg_available": ffmpeg_available()
+        }, None
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return None, f"({type(e).__name__}): {str(e)}"
+
+def is_valid_youtube_url(url):
+    # Supports youtube.com/watch?v=... and youtu.be/...
+    pattern = r"^(https?://)?(www\.)?(youtube\.com/watch\?v=|youtu\.be/)[\w-]+([?&]\S*)?$"
+    return re.match(pattern, url) is not None
+
+# Egress pool: outbound traffic (extraction, relays, ffmpeg inputs and
+# thumbnails) is spread over the proxies in EGRESS_PROXIES instead of leaving
+# from one address. Each egress is scored by its rolling success rate, latency
+# and throughput, and is skipped for new extractions for EGRESS_QUARANTINE
+# seconds after YouTube's bot detection. googlevideo URLs only work from the
+# address that extracted them, so streams remember their egress and are always
+# fetched through it.
+# Comma-separated http://, socks5:// (local DNS) or socks5h:// (proxy DNS)
+# URLs, with optional user:password@; 'direct' adds the host's own address
+EGRESS_PROXIES = [p.strip() for p in os.environ.get('EGRESS_PROXIES', '').split(',') if p.strip()]
+EGRESS_MAX_CONCURRENCY = int(os.environ.get('EGRESS_MAX_CONCURRENCY', 32))  # requests in flight per egress; 0 = unlimited
+EGRESS_WAIT = float(os.environ.get('EGRESS_WAIT', 10))  # seconds to wait for a slot on a busy egress
+EGRESS_QUARANTINE = int(os.environ.get('EGRESS_QUARANTINE', 15 * 60))
+# Transfer size an egress's cost is computed for, weighing throughput against latency
+EGRESS_COST_BYTES = 1024 * 1024
+# Shorter transfers say too little about an egress's throughput to be counted
+EGRESS_MIN_TRANSFER = 256 * 1024
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Proxy closed the connection")
+        data += chunk
+    return data
+
+class Egress:
+    """One way out: an HTTP or SOCKS5 proxy, or the host's own address
+    (proxy_url None), with its concurrency slots and rolling statistics.
+    """
+
+    def __init__(self, proxy_url, max_concurrency):
+        self.scheme = None
+        self.name = 'direct'
+        if proxy_url:
+            parts = urlsplit(proxy_url)
+            if parts.scheme not in ('http', 'socks5', 'socks5h'):
+                raise ValueError(f"Unsupported egress proxy: {proxy_url}")
+            self.scheme = parts.scheme
+            self.host = parts.hostname
+            self.port = parts.port or (8080 if parts.scheme == 'http' else 1080)
+            self.username = unquote(parts.username or '')
+            self.password = unquote(parts.password or '')
+            # Stored with cached streams and shown in /stats, so no credentials
+            self.name = f"{self.scheme}://{self.host}:{self.port}"
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Condition()
+        self.in_flight = 0
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.bot_detections = 0
+        self.rejected = 0
+        self.success_rate = 1.0
+        self.latency = None  # upstream request to response headers
+        self.extraction_latency = None
+        self.throughput = None  # bytes/s of media transfers
+        self.bytes = 0
+        self.quarantined_until = 0
+
+    @property
+    def proxied(self):
+        return self.scheme is not None
+
+    def connection(self, scheme, host, port=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, **kwargs):
+        """An unconnected http.client connection to host (and port) through this egress.
+
+        HTTP proxies are asked to CONNECT a tunnel for plain HTTP targets too,
+        so both schemes are relayed the same way.
+        """
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        if self.scheme == 'http':
+            conn = conn_class(self.host, self.port, timeout=timeout, **kwargs)
+            headers = {}
+            if self.username:
+                credentials = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+                headers["Proxy-Authorization"] = f"Basic {credentials}"
+            conn.set_tunnel(host, port, headers)
+            return conn
+        conn = conn_class(host, port, timeout=timeout, **kwargs)
+        if self.scheme:
+            # http.client opens its socket through this hook; TLS is layered on top
+            conn._create_connection = self._socks_connect
+        return conn
+
+    def _socks_connect(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """A socket to address tunnelled through the SOCKS5 proxy (RFC 1928/1929)."""
+        host, port = address
+        if self.scheme == 'socks5':
+            host = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+        try:
+            target = b'\x01' + socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            try:
+                target = b'\x04' + socket.inet_pton(socket.AF_INET6, host)
+            except OSError:
+                name = host.encode('idna')
+                target = b'\x03' + bytes([len(name)]) + name
+        sock = socket.create_connection((self.host, self.port), timeout, source_address)
+        try:
+            sock.sendall(b'\x05\x02\x00\x02' if self.username else b'\x05\x01\x00')
+            method = recv_exact(sock, 2)[1]
+            if method == 2 and self.username:
+                user, password = self.username.encode(), self.password.encode()
+                sock.sendall(b'\x01' + bytes([len(user)]) + user + bytes([len(password)]) + password)
+                if recv_exact(sock, 2)[1] != 0:
+                    raise ConnectionError("SOCKS proxy rejected the credentials")
+            elif method != 0:
+                raise ConnectionError("SOCKS proxy offers no supported authentication method")
+            sock.sendall(b'\x05\x01\x00' + target + port.to_bytes(2, 'big'))
+            reply = recv_exact(sock, 4)
+            if reply[1] != 0:
+                raise ConnectionError(f"SOCKS proxy could not connect to {host}:{port} (reply {reply[1]})")
+            # Skip the address the proxy bound for us
+            bound = {1: 4, 4: 16}.get(reply[3]) or recv_exact(sock, 1)[0]
+            recv_exact(sock, bound + 2)
+            return sock
+        except BaseException:
+            sock.close()
+            raise
+
+    def acquire(self, wait=EGRESS_WAIT):
+        """Take a concurrency slot, waiting up to wait seconds for one.
+
+        Raises AdmissionRejected if the egress stays at its limit.
+        """
+        with self._lock:
+            if self.max_concurrency and not self._lock.wait_for(lambda: self.in_flight < self.max_concurrency, wait):
+                self.rejected += 1
+                raise AdmissionRejected(f"egress {self.name} is at its concurrency limit", max(1, math.ceil(wait)))
+            self.in_flight += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._lock.notify()
+
+    @staticmethod
+    def _average(current, value):
+        return value if current is None else current + CLIENT_STATS_DECAY * (value - current)
+
+    def record(self, ok, latency=None, extraction=False):
+        """Record an upstream request (or with extraction, a video extraction)."""
+        with self._lock:
+            self.attempts += 1
+            if ok:
+                self.successes += 1
+            else:
+                self.failures += 1
+            self.success_rate += CLIENT_STATS_DECAY * ((1.0 if ok else 0.0) - self.success_rate)
+            if latency is not None and extraction:
+                self.extraction_latency = self._average(self.extraction_latency, latency)
+            elif latency is not None:
+                self.latency = self._average(self.latency, latency)
+        EGRESS_REQUESTS.labels(self.name, ('extraction_' if extraction else '') + ('ok' if ok else 'error')).inc()
+
+    def record_transfer(self, size, seconds):
+        with self._lock:
+            self.bytes += size
+            if size >= EGRESS_MIN_TRANSFER and seconds > 0:
+                self.throughput = self._average(self.throughput, size / seconds)
+
+    def quarantine(self):
+        """Keep new extractions off this egress after YouTube flagged its address.
+
+        Streams it already extracted keep using it: their URLs work nowhere else.
+        """
+        with self._lock:
+            self.bot_detections += 1
+            self.quarantined_until = time.time() + EGRESS_QUARANTINE
+        EGRESS_REQUESTS.labels(self.name, 'bot_detection').inc()
+
+    def expected_seconds(self):
+        """Seconds to extract a video and fetch EGRESS_COST_BYTES of it, or
+        None if nothing succeeded through this egress yet.
+        """
+        if self.extraction_latency is None and self.latency is None:
+            return None
+        seconds = (self.extraction_latency or 0) + (self.latency or 0)
+        if self.throughput:
+            seconds += EGRESS_COST_BYTES / self.throughput
+        return seconds
+
+    def cost(self, typical):
+        # expected_seconds (typical, the pool's average, until measured),
+        # inflated by failures and by the requests already in flight
+        seconds = self.expected_seconds()
+        return (typical if seconds is None else seconds) / max(self.success_rate, 0.05) * (1 + self.in_flight)
+
+    def stats(self, typical):
+        with self._lock:
+            return {
+                "proxy": self.scheme or 'direct',
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "attempts": self.attempts,
+                "successes": self.successes,
+                "failures": self.failures,
+                "bot_detections": self.bot_detections,
+                "rejected": self.rejected,
+                "success_rate": self.success_rate,
+                "latency": self.latency,
+                "extraction_latency": self.extraction_latency,
+                "throughput": self.throughput,
+                "bytes": self.bytes,
+                "quarantined": self.quarantined_until > time.time(),
+                "cost": self.cost(typical),
+            }
+
+class EgressPool:
+    """The configured egresses, and the one the current thread's urllib
+    (and so pytubefix) requests go out through.
+    """
+
+    def __init__(self, proxy_urls, max_concurrency):
+        self.egresses = [Egress(None if url == 'direct' else url, max_concurrency) for url in proxy_urls]
+        self._by_name = {egress.name: egress for egress in self.egresses}
+        # Without a configured pool everything goes direct, with no concurrency limit
+        self.direct = self._by_name.get('direct') or Egress(None, 0)
+        if not self.egresses:
+            self.egresses = [self.direct]
+        self._local = threading.local()
+        self.switches = 0
+
+    @property
+    def enabled(self):
+        return any(egress.proxied for egress in self.egresses)
+
+    def get(self, name):
+        """The egress called name, e.g. the one a cached stream was extracted
+        through. Streams from before the pool was configured go direct.
+        """
+        return self._by_name.get(name) or self.direct
+
+    def choose(self, exclude=()):
+        """An egress for a new extraction, skipping quarantined ones and those
+        at their concurrency limit while others are left.
+
+        Picked at random, weighted by 1 / cost: cheaper egresses get more of
+        the load, but no single one gets all of it and stands out to YouTube.
+        """
+        now = time.time()
+        candidates = [e for e in self.egresses if e not in exclude] or self.egresses
+        healthy = [e for e in candidates if e.quarantined_until <= now]
+        if not healthy:
+            # Everything is quarantined: use the one released soonest
+            return min(candidates, key=lambda e: e.quarantined_until)
+        free = [e for e in healthy if not e.max_concurrency or e.in_flight < e.max_concurrency] or healthy
+        typical = self.typical_seconds()
+        return random.choices(free, weights=[1 / e.cost(typical) for e in free])[0]
+
+    def typical_seconds(self):
+        measured = [s for s in (e.expected_seconds() for e in self.egresses) if s is not None]
+        return sum(measured) / len(measured) if measured else 1.0
+
+    def switch(self, egress, tried):
+        """Move an extraction holding a slot on egress to one not in tried.
+
+        Returns the egress now held, which is egress itself if there is no other.
+        """
+        other = self.choose(exclude=tried)
+        if other in tried:
+            return egress
+        other.acquire()
+        egress.release()
+        tried.append(other)
+        self.switches += 1
+        return other
+
+    @contextmanager
+    def use(self, egress):
+        """Send this thread's urllib requests through egress."""
+        previous = getattr(self._local, 'egress', None)
+        self._local.egress = egress
+        try:
+            yield egress
+        finally:
+            self._local.egress = previous
+
+    def connection(self, scheme, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, **kwargs):
+        """A connection to host through the current thread's egress (see use())."""
+        egress = getattr(self._local, 'egress', None) or self.direct
+        return egress.connection(scheme, host, None, timeout, **kwargs)
+
+    def stats(self):
+        typical = self.typical_seconds()
+        return {
+            "enabled": self.enabled,
+            "switches": self.switches,
+            "egresses": {egress.name: egress.stats(typical) for egress in self.egresses},
+        }
+
+egress_pool = EgressPool(EGRESS_PROXIES, EGRESS_MAX_CONCURRENCY)
+
+def stream_egress(stream):
+    """The egress a stream's URL was issued to."""
+    return egress_pool.get(getattr(stream, 'egress', None))
+
+class EgressHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(lambda host, **kwargs: egress_pool.connection('http', host, **kwargs), req)
+
+class EgressHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(lambda host, **kwargs: egress_pool.connection('https', host, **kwargs), req,
+                            context=self._context)
+
+if egress_pool.enabled:
+    # pytubefix requests through urllib.request.urlopen, i.e. the global opener
+    urllib.request.install_opener(urllib.request.build_opener(EgressHTTPHandler, EgressHTTPSHandler))
+
+# Upstream HTTP: keep-alive connections to googlevideo/ytimg hosts are pooled
+# and reused across requests instead of opening a new one per download.
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 16))  # idle connections kept per host
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30))
+RELAY_CHUNK_SIZE = int(os.environ.get('RELAY_CHUNK_SIZE', 256 * 1024))
+
+class UpstreamError(Exception):
+    pass
+
+class SegmentMismatch(UpstreamError):
+    """Upstream isn't serving the stream a segment expected; retrying won't help."""
+
+class UpstreamResponse:
+    """An upstream response whose connection goes back to the pool, and whose
+    egress slot is freed (unless release_slot is False), once closed.
+    """
+
+    def __init__(self, pool, key, conn, response, egress, release_slot=True):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._egress = egress
+        self._release_slot = release_slot
+        self._started = time.monotonic()
+        self._bytes = 0
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, size=None):
+        """Up to size bytes of the body or, without size, all of it (and close)."""
+        if size is not None:
+            data = self._response.read(size)
+            self._bytes += len(data)
+            return data
+        try:
+            data = self._response.read()
+            self._bytes += len(data)
+            return data
+        finally:
+            self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+        # Only a fully read response leaves the connection reusable
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.release(self._key, self._conn)
+        else:
+            self._response.close()
+            self._conn.close()
+        self._conn = None
+        self._egress.record_transfer(self._bytes, time.monotonic() - self._started)
+        if self._release_slot:
+            self._egress.release()
+
+class UpstreamPool:
+    """Keep-alive HTTP(S) connection pool shared by all requests."""
+
+    def __init__(self, size, connect_timeout, read_timeout):
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = {}  # (egress name, scheme, host, port) -> [connections]
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _connect(self, key, egress):
+        _, scheme, host, port = key
+        conn = egress.connection(scheme, host, port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, method='GET', headers=None, max_redirects=5, egress=None, slot_held=False):
+        """Send a request through egress (direct by default) and return an
+        UpstreamResponse, which holds one of the egress's slots until closed.
+        With slot_held, the caller already holds the slot and keeps it.
+        Raises UpstreamError on HTTP errors.
+        """
+        egress = egress or egress_pool.direct
+        if not slot_held:
+            egress.acquire()
+        started = time.monotonic()
+        try:
+            upstream, host = self._follow(url, method, headers or {}, max_redirects, egress, slot_held)
+        except (UpstreamError, http.client.HTTPException, OSError):
+            if not slot_held:
+                egress.release()
+            egress.record(False)
+            raise
+        except BaseException:
+            if not slot_held:
+                egress.release()
+            raise
+        # 403 and 429 are how googlevideo refuses an address; other client
+        # errors say nothing about the egress
+        egress.record(upstream.status < 500 and upstream.status not in (403, 429), time.monotonic() - started)
+        if upstream.status >= 400:
+            upstream.close()
+            raise UpstreamError(f"Upstream returned HTTP {upstream.status} for {host}")
+        return upstream
+
+    def _follow(self, url, method, headers, max_redirects, egress, slot_held):
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            key = (egress.name, parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            response, conn = self._send(key, egress, method, path, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.release(key, conn)
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            return UpstreamResponse(self, key, conn, response, egress, release_slot=not slot_held), parts.hostname
+        raise UpstreamError(f"Too many redirects for {parts.hostname}")
+
+    def _send(self, key, egress, method, path, headers):
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            try:
+                started = time.monotonic()
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                UPSTREAM_TTFB_SECONDS.labels('reused').observe(time.monotonic() - started)
+                with self._lock:
+                    self.reused += 1
+                return response, conn
+            except (http.client.HTTPException, OSError):
+                # The server closed the idle connection; retry on a fresh one
+                conn.close()
+        started = time.monotonic()
+        conn = self._connect(key, egress)
+        conn.request(method, path, headers=headers)
+        response = conn.getresponse()
+        UPSTREAM_TTFB_SECONDS.labels('new').observe(time.monotonic() - started)
+        return response, conn
+
+    def stats(self):
+        with self._lock:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "idle": sum(len(idle) for idle in self._idle.values()),
+            }
+
+upstream_pool = UpstreamPool(UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+
+def relay_upstream(upstream, chunk_size=RELAY_CHUNK_SIZE):
+    """Yield an upstream body in chunk_size pieces.
+
+    Each piece is a new bytes object read straight off the socket: WSGI
+    servers only accept bytes, so reading into a reusable buffer would cost
+    a second copy per chunk.
+    """
+    try:
+        while True:
+            chunk = upstream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        upstream.close()
+
+# Segmented fetching: googlevideo throttles each connection, so large streams
+# are fetched as byte ranges over several connections at once and reassembled
+# in order. A download holds at most SEGMENT_CONNECTIONS segments (plus the one
+# being sent) in memory.
+SEGMENT_CONNECTIONS = int(os.environ.get('SEGMENT_CONNECTIONS', 4))  # ranges fetched at once; 1 disables
+SEGMENT_SIZE = int(os.environ.get('SEGMENT_SIZE', 8 * 1024 * 1024))
+SEGMENT_MIN_SIZE = int(os.environ.get('SEGMENT_MIN_SIZE', 32 * 1024 * 1024))  # smaller streams use one connection
+SEGMENT_RETRIES = int(os.environ.get('SEGMENT_RETRIES', 3))  # per segment
+SEGMENT_POOL_SIZE = int(os.environ.get('SEGMENT_POOL_SIZE', 64))  # fetch threads, shared by all downloads
+# The first segment is small so the first bytes reach the client quickly
+SEGMENT_FIRST_SIZE = 1024 * 1024
+
+segment_pool = ThreadPoolExecutor(max_workers=SEGMENT_POOL_SIZE, thread_name_prefix='segment')
+segment_stats = {"downloads": 0, "narrowed": 0, "segments": 0, "retries": 0, "failures": 0}
+
+def use_segments(length):
+    return SEGMENT_CONNECTIONS > 1 and bool(length) and length >= SEGMENT_MIN_SIZE
+
+def segment_ranges(start, end):
+    """Inclusive (start, end) ranges covering start..end, the first one short."""
+    size = min(SEGMENT_FIRST_SIZE, SEGMENT_SIZE)
+    while start <= end:
+        yield start, min(start + size - 1, end)
+        start += size
+        size = SEGMENT_SIZE
+
+def fetch_segment(url, start, end, size, egress):
+    """Bytes start..end of url, a stream of size bytes, retried on its own if
+    the connection fails. The caller holds a slot on egress for it.
+    """
+    for attempt in range(SEGMENT_RETRIES + 1):
+        try:
+            upstream = upstream_pool.request(url, headers={"Range": f"bytes={start}-{end}"}, egress=egress,
+                                             slot_held=True)
+            if upstream.status != 206:
+                # Never read a whole stream into memory if the range was ignored
+                upstream.close()
+                raise SegmentMismatch(f"Upstream ignored the byte range (HTTP {upstream.status})")
+            if not (upstream.headers.get('Content-Range') or '').endswith(f"/{size}"):
+                # A wrong size would silently truncate or overrun the download
+                upstream.close()
+                raise SegmentMismatch(f"Upstream size doesn't match the expected {size} bytes")
+            data = upstream.read()
+            if len(data) != end - start + 1:
+                raise UpstreamError(f"Short segment: got {len(data)} of {end - start + 1} bytes")
+            segment_stats["segments"] += 1
+            return data
+        except SegmentMismatch:
+            segment_stats["failures"] += 1
+            raise
+        except (UpstreamError, http.client.HTTPException, OSError):
+            if attempt == SEGMENT_RETRIES:
+                segment_stats["failures"] += 1
+                raise
+            segment_stats["retries"] += 1
+            time.sleep(min(0.25 * 2 ** attempt, 2))
+
+def fetch_segmented(url, size, start, end, connections=None, egress=None):
+    """Yield bytes start..end (inclusive) of url, a stream of size bytes, in
+    order, fetched as SEGMENT_SIZE ranges over up to `connections`
+    connections at once through egress.
+
+    The egress slots of its connections are taken, and the first segments
+    requested, immediately, before iteration starts: a full egress fails the
+    download with AdmissionRejected before any bytes are sent, rather than
+    cutting it short part way through. Only the first connection waits for a
+    slot; on a busy egress the download gets fewer connections.
+    """
+    egress = egress or egress_pool.direct
+    ranges = segment_ranges(start, end)
+    first = list(itertools.islice(ranges, connections or SEGMENT_CONNECTIONS))
+    egress.acquire()
+    slots = 1
+    while slots < len(first):
+        try:
+            egress.acquire(wait=0)
+        except AdmissionRejected:
+            break
+        slots += 1
+    ranges = itertools.chain(first[slots:], ranges)
+    pending = deque(segment_pool.submit(fetch_segment, url, *r, size, egress) for r in first[:slots])
+    segment_stats["downloads"] += 1
+    if slots < len(first):
+        segment_stats["narrowed"] += 1
+
+    def generate():
+        # Each pending segment holds one of the slots, passed on to the next
+        # segment and released after the last
+        try:
+            while pending:
+                data = pending[0].result()
+                pending.popleft()
+                next_range = next(ranges, None)
+                if next_range:
+                    pending.append(segment_pool.submit(fetch_segment, url, *next_range, size, egress))
+                else:
+                    egress.release()
+                yield data
+        finally:
+            for future in pending:
+                if future.cancel():
+                    egress.release()
+                else:
+                    future.add_done_callback(lambda _: egress.release())
+
+    return generate()
+
+def stream_chunks(url, size, byte_range=None, egress=None):
+    """Chunks of a stream's body, or of byte_range (inclusive) of it,
+    fetched through egress (the one its URL was issued to).
+
+    Streams of at least SEGMENT_MIN_SIZE bytes are fetched in parallel
+    segments; others are relayed over a single connection.
+    """
+    start, end = byte_range or (0, size - 1 if size else None)
+    if size and use_segments(end - start + 1):
+        return fetch_segmented(url, size, start, end, egress=egress)
+    headers = {"Range": f"bytes={start}-{end}"} if byte_range else {}
+    return relay_upstream(upstream_pool.request(url, headers=headers, egress=egress))
+
+# Media cache: finished download outputs, stored on disk and keyed by
+# (video ID, itags, output profile). Disabled unless MEDIA_CACHE_MAX_BYTES > 0.
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', os.path.join(CACHE_DIR, 'media'))
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 0))
+# Media cache key profile for streams relayed as-is
+PROGRESSIVE_PROFILE = 'progressive'
+# Longest a process goes without rescanning a cache directory, to pick up
+# what other workers stored
+MEDIA_CACHE_SCAN_INTERVAL = 60
+
+class MediaCache:
+    """Content-addressed on-disk cache of download outputs with LRU eviction.
+
+    Files are written to a temporary .part file and atomically renamed into
+    place once complete. Hits refresh the file's mtime, and eviction removes
+    the least recently used files until the cache fits in max_bytes. Since
+    all state is on disk, the cache is shared by every worker on the host.
+
+    Each process keeps a running total of the cache's size: the total found
+    by the last scan of the directory plus what it stored since. Stores only
+    scan (and evict) when that total is over max_bytes, or when the last scan
+    is MEDIA_CACHE_SCAN_INTERVAL seconds old.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._bytes = None  # running total; None until the first scan
+        self._scanned_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(video_id, video_itag, audio_itag, profile):
+        return hashlib.sha256(f"{video_id}:{video_itag}:{audio_itag}:{profile}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key):
+        """Path of the cached file for key, or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def open_writer(self, key):
+        return MediaCacheWriter(self, key)
+
+    def publish(self, temp_path, key):
+        path = self.path(key)
+        size = os.path.getsize(temp_path)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(temp_path, path)
+        with self._lock:
+            self.stores += 1
+            if self._bytes is not None:
+                self._bytes += size - replaced
+            due = (self._bytes is None or self._bytes > self.max_bytes
+                   or time.monotonic() - self._scanned_at > MEDIA_CACHE_SCAN_INTERVAL)
+        if due:
+            self.evict()
+
+    def _scan(self):
+        """(mtime, size, path) of every cached file; removes stale .part files."""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.part'):
+                    # Leftovers of a crashed worker
+                    if stat.st_mtime < now - 24 * 60 * 60:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                # Evicted, published or cleaned up by another worker meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits in max_bytes."""
+        # One scan per process at a time; a store arriving meanwhile is
+        # counted in the running total and checked on the next one
+        if not self._scan_lock.acquire(blocking=False):
+            return
+        try:
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+            with self._lock:
+                self._bytes = total
+                self._scanned_at = time.monotonic()
+        finally:
+            self._scan_lock.release()
+
+    def stats(self):
+        if not self.enabled:
+            return {"enabled": False}
+        if self._bytes is None:
+            self.evict()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+class MediaCacheWriter:
+    """Collects one output in a temporary file; commit() publishes it to the cache."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        self.cache.publish(self.temp_path, self.key)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+def tee_to_cache(chunks, writer):
+    """Yield chunks while copying them to a MediaCacheWriter.
+
+    The file is only published if every chunk was produced and sent.
+    """
+    completed = False
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        if completed:
+            writer.commit()
+        else:
+            writer.abort()
+
+# Thumbnails: fetched by video ID from the image host, without extracting the
+# video, and kept in an in-process LRU in front of an on-disk cache shared by
+# the workers. Resized and WebP variants are cached the same way.
+THUMBNAIL_BASE_URL = os.environ.get('THUMBNAIL_BASE_URL', 'https://i.ytimg.com')
+THUMBNAIL_NAMES = ('maxresdefault', 'hqdefault')  # tried in order; not every video has maxres
+THUMBNAIL_TTL = int(os.environ.get('THUMBNAIL_TTL', 24 * 60 * 60))  # seconds before an image is refetched
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 24 * 60 * 60))  # Cache-Control max-age
+THUMBNAIL_MEMORY_BYTES = int(os.environ.get('THUMBNAIL_MEMORY_BYTES', 32 * 1024 * 1024))
+THUMBNAIL_DISK_BYTES = int(os.environ.get('THUMBNAIL_DISK_BYTES', 512 * 1024 * 1024))  # 0 disables the disk cache
+THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR', os.path.join(CACHE_DIR, 'thumbnails'))
+THUMBNAIL_MAX_SIZE = 1280  # largest width/height of a resized variant
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+class Thumbnail:
+    """An image with the validators used for conditional requests."""
+
+    def __init__(self, data, mimetype, last_modified, fetched_at=None):
+        self.data = data
+        self.mimetype = mimetype
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at or time.time()
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+
+    @property
+    def fresh(self):
+        return time.time() - self.fetched_at < THUMBNAIL_TTL
+
+    def to_bytes(self):
+        """On-disk form: a JSON header line followed by the image."""
+        header = {"mimetype": self.mimetype, "last_modified": self.last_modified, "fetched_at": self.fetched_at}
+        return json.dumps(header).encode() + b'\n' + self.data
+
+    @classmethod
+    def from_bytes(cls, raw):
+        header, data = raw.split(b'\n', 1)
+        header = json.loads(header)
+        return cls(data, header["mimetype"], header["last_modified"], header["fetched_at"])
+
+class ThumbnailCache:
+    """In-process LRU of Thumbnails, bounded by bytes, backed by a MediaCache on disk."""
+
+    def __init__(self, max_bytes, disk):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self._entries = OrderedDict()  # key -> Thumbnail
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def disk_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _remember(self, key, thumbnail):
+        size = len(thumbnail.data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= len(old.data)
+            self._entries[key] = thumbnail
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.data)
+
+    def get(self, key):
+        with self._lock:
+            thumbnail = self._entries.get(key)
+            if thumbnail and thumbnail.fresh:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return thumbnail
+        path = self.disk.lookup(self.disk_key(key)) if self.disk.enabled else None
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    thumbnail = Thumbnail.from_bytes(f.read())
+            except (OSError, ValueError, KeyError):
+                thumbnail = None
+            if thumbnail and thumbnail.fresh:
+                self._remember(key, thumbnail)
+                with self._lock:
+                    self.disk_hits += 1
+                return thumbnail
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, thumbnail):
+        self._remember(key, thumbnail)
+        if self.disk.enabled:
+            writer = self.disk.open_writer(self.disk_key(key))
+            writer.write(thumbnail.to_bytes())
+            writer.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "disk": self.disk.stats(),
+            }
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_MEMORY_BYTES, MediaCache(THUMBNAIL_DIR, THUMBNAIL_DISK_BYTES))
+
+def fetch_thumbnail(url, video_id):
+    """(Thumbnail, error) for a video's original thumbnail.
+
+    The image URL is derived from the video ID; only if none of those exist
+    is the video extracted for the thumbnail URL YouTube reports.
+    """
+    candidates = [f"{THUMBNAIL_BASE_URL}/vi/{video_id}/{name}.jpg" for name in THUMBNAIL_NAMES]
+    for index, thumbnail_url in enumerate(candidates + [None]):
+        try:
+            if thumbnail_url is None:
+                yt, error = get_video_metadata(url, ('thumbnail_url',))
+                if not yt:
+                    return None, error
+                thumbnail_url = yt.thumbnail_url
+            # Thumbnail URLs aren't tied to an address; any egress will do
+            upstream = upstream_pool.request(thumbnail_url, egress=egress_pool.choose())
+            last_modified = parse_date(upstream.headers.get('Last-Modified'))
+            data = upstream.read()
+            return Thumbnail(data, 'image/jpeg', last_modified.timestamp() if last_modified else time.time()), None
+        except UpstreamError as e:
+            # e.g. no maxresdefault for this video; try the next candidate
+            if index == len(candidates):
+                return None, f"({type(e).__name__}): {str(e)}"
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            return None, f"({type(e).__name__}): {str(e)}"
+
+def resize_image(data, width, height, image_format):
+    """Re-encode an image, scaled to width x height (cropped to fill if both are given)."""
+    # Pillow is only needed for variants, so it isn't loaded at startup
+    from PIL import Image, ImageOps
+    image = Image.open(BytesIO(data)).convert('RGB')
+    if width and height:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    elif width or height:
+        original_width, original_height = image.size
+        width = width or max(1, round(original_width * height / original_height))
+        height = height or max(1, round(original_height * width / original_width))
+        image = image.resize((width, height), Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, format=image_format.upper(), quality=THUMBNAIL_QUALITY)
+    return output.getvalue()
+
+def get_thumbnail_options(params):
+    """(width, height, format, error) from request parameters."""
+    try:
+        width = int(params.get('width') or 0)
+        height = int(params.get('height') or 0)
+    except (TypeError, ValueError):
+        return None, None, None, "'width' and 'height' must be integers."
+    if not (0 <= width <= THUMBNAIL_MAX_SIZE and 0 <= height <= THUMBNAIL_MAX_SIZE):
+        return None, None, None, f"'width' and 'height' must be positive and at most {THUMBNAIL_MAX_SIZE}."
+    image_format = params.get('format') or 'jpeg'
+    if not isinstance(image_format, str) or image_format not in THUMBNAIL_FORMATS:
+        return None, None, None, f"Invalid 'format'. Choose one of: {', '.join(THUMBNAIL_FORMATS)}."
+    return width, height, image_format, None
+
+def get_thumbnail(url, width=0, height=0, image_format='jpeg'):
+    """(Thumbnail, error) for a video, resized/re-encoded if asked, from the cache when possible."""
+    video_id = extract_video_id(url)
+    original = thumbnail_cache.get(f"{video_id}:original")
+    if not original:
+        original, error = fetch_thumbnail(url, video_id)
+        if not original:
+            return None, error
+        thumbnail_cache.put(f"{video_id}:original", original)
+    if not width and not height and image_format == 'jpeg':
+        return original, None
+
+    key = f"{video_id}:{width}x{height}:{image_format}"
+    variant = thumbnail_cache.get(key)
+    if not variant:
+        try:
+            data = resize_image(original.data, width, height, image_format)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            return None, f"({type(e).__name__}): {str(e)}"
+        variant = Thumbnail(data, THUMBNAIL_FORMATS[image_format], original.last_modified)
+        thumbnail_cache.put(key, variant)
+    return variant, None
+
+def thumbnail_response(thumbnail, download_name=None):
+    """The image with ETag, Last-Modified and Cache-Control, or 304 if the client's copy is current."""
+    response = Response(thumbnail.data, mimetype=thumbnail.mimetype)
+    response.set_etag(thumbnail.etag)
+    response.last_modified = thumbnail.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    if download_name:
+        response.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(thumbnail.etag)
+    else:
+        not_modified = bool(request.if_modified_since) and int(thumbnail.last_modified) <= request.if_modified_since.timestamp()
+    if not_modified:
+        response.status_code = 304
+        response.set_data(b'')
+        response.headers.pop("Content-Disposition", None)
+    return response
+
+class FFmpegError(Exception):
+    pass
+
+def audio_can_be_copied(audio_stream, profile, bitrate=None):
+    """Whether the audio codec fits the profile's container without transcoding."""
+    if bitrate:
+        return False
+    codec = (audio_stream.audio_codec or '').split('.')[0]
+    return codec in OUTPUT_PROFILES[profile]["copy_audio_codecs"]
+
+def ffmpeg_command(video_url, audio_url, profile, copy_audio, bitrate=None):
+    """ffmpeg arguments for a merge; either URL may be 'pipe:N' to read that
+    input from file descriptor N (0 being stdin).
+
+    bitrate (kbps) overrides the profile's audio bitrate when transcoding.
+    """
+    reconnect = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-nostats']
+    for url in (video_url, audio_url):
+        if url and url.startswith('pipe:'):
+            command += ['-i', url]
+        elif url:
+            command += reconnect + ['-i', url]
+    if video_url:
+        command += ['-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy']
+    else:
+        command += ['-map', '0:a:0', '-vn']
+    if copy_audio:
+        command += ['-c:a', 'copy']
+    else:
+        audio_args = list(OUTPUT_PROFILES[profile]["transcode_audio"])
+        if bitrate and '-b:a' in audio_args:
+            audio_args[audio_args.index('-b:a') + 1] = f'{bitrate}k'
+        command += audio_args
+    if video_url:
+        command += ['-shortest']
+    return command + OUTPUT_PROFILES[profile]["format"] + ['pipe:1']
+
+class PipeWriter:
+    """Write end of an extra ffmpeg input pipe (besides stdin).
+
+    The pipe is non-blocking and waits for room with select, which gevent
+    patches, so a slow ffmpeg doesn't block the whole worker.
+    """
+
+    def __init__(self, fd):
+        os.set_blocking(fd, False)
+        self.fd = fd
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+
+    def close(self):
+        os.close(self.fd)
+
+def feed_ffmpeg(pipe, chunks, errors):
+    """Write chunks to one of ffmpeg's input pipes, recording any fetch error in errors."""
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except (BrokenPipeError, ValueError):
+        # ffmpeg exited, or was killed because the client went away
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        chunks.close()
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+def stream_with_ffmpeg_merge(video_url, audio_url, profile=DEFAULT_PROFILE, copy_audio=False, video_size=None,
+                             bitrate=None, egress=None):
+    """Merge video and audio streams using ffmpeg and yield chunks.
+
+    video_url may be None for audio-only profiles. With copy_audio the audio
+    is remuxed (-c:a copy) instead of transcoded, otherwise encoded at the
+    profile's bitrate or bitrate (kbps). A video of at least
+    SEGMENT_MIN_SIZE bytes (video_size) is fetched in parallel segments and
+    piped to ffmpeg's stdin instead of being read by ffmpeg over one connection.
+    Through a proxy egress both inputs are fetched by us and piped, as ffmpeg
+    can't use SOCKS proxies and would bypass the egress's limits and stats.
+
+    Raises FFmpegError at the end if ffmpeg failed, so a truncated output
+    isn't mistaken for a complete one.
+    """
+    started = time.monotonic()
+    proxied = egress is not None and egress.proxied
+    pipe_video = bool(video_url) and (proxied or use_segments(video_size))
+    # The first piped input is ffmpeg's stdin; a second one gets its own pipe
+    extra_pipe = os.pipe() if pipe_video and proxied else None
+    video_input = 'pipe:0' if pipe_video else video_url
+    audio_input = (f'pipe:{extra_pipe[0]}' if extra_pipe else 'pipe:0') if proxied else audio_url
+    try:
+        process = subprocess.Popen(
+            ffmpeg_command(video_input, audio_input, profile, copy_audio, bitrate),
+            stdin=subprocess.PIPE if pipe_video or proxied else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            pass_fds=extra_pipe[:1] if extra_pipe else ()
+        )
+    except BaseException:
+        if extra_pipe:
+            os.close(extra_pipe[1])
+        raise
+    finally:
+        if extra_pipe:
+            os.close(extra_pipe[0])
+    FFMPEG_PROCESSES.inc()
+
+    def fetch(url, size):
+        # Requested from the feeder thread, so a failed request lands in feed_errors
+        yield from stream_chunks(url, size, egress=egress)
+
+    feeds = []
+    if pipe_video:
+        feeds.append((process.stdin, video_url, video_size))
+    if proxied:
+        feeds.append((PipeWriter(extra_pipe[1]) if extra_pipe else process.stdin, audio_url, None))
+    feed_errors = []
+    feeders = [
+        threading.Thread(target=feed_ffmpeg, args=(pipe, fetch(url, size), feed_errors), daemon=True)
+        for pipe, url, size in feeds
+    ]
+    for feeder in feeders:
+        feeder.start()
+    first_chunk = True
+    try:
+        while True:
+            chunk = process.stdout.read(8192)
+            if not chunk:
+                break
+            if first_chunk:
+                FFMPEG_FIRST_CHUNK_SECONDS.labels('remux' if copy_audio else 'transcode').observe(time.monotonic() - started)
+                first_chunk = False
+            yield chunk
+        process.wait()
+        for feeder in feeders:
+            feeder.join()
+        if feed_errors:
+            # Checked first: ffmpeg may even exit cleanly on a truncated input
+            raise FFmpegError(f"Fetching the video failed: {feed_errors[0]}")
+        if process.returncode != 0:
+            raise FFmpegError(f"ffmpeg exited with status {process.returncode}")
+    finally:
+        # The client may have gone away mid-stream; don't leave ffmpeg blocked on the pipe
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        FFMPEG_PROCESSES.dec()
+
+class MergeBroadcast:
+    """One ffmpeg merge whose output is shared by every client that asks for it.
+
+    A producer thread writes ffmpeg's output to a spill file; each reader
+    streams the file from the start and then follows the live tail. When the
+    merge completes the spill file is published to the media cache (if
+    enabled) or deleted; open readers keep their file handles either way.
+    """
+
+    def __init__(self, key, filename, mimetype, cache_key, on_done):
+        self.key = key
+        self.filename = filename
+        self.mimetype = mimetype
+        self.cache_key = cache_key
+        self._on_done = on_done
+        self._cond = threading.Condition()
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        fd, self.path = tempfile.mkstemp(dir=media_cache.directory if cache_key else None, suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+
+    def start(self, chunks, release):
+        threading.Thread(target=self._produce, args=(chunks, release), daemon=True).start()
+
+    def _produce(self, chunks, release):
+        try:
+            for chunk in chunks:
+                self._file.write(chunk)
+                self._file.flush()
+                with self._cond:
+                    self.size += len(chunk)
+                    self._cond.notify_all()
+                    # Without a cache to fill, stop once every client has left
+                    if not self.readers and not self.cache_key:
+                        raise FFmpegError("All clients disconnected")
+        except Exception as e:
+            self.error = e
+            if not isinstance(e, FFmpegError):
+                sentry_sdk.capture_exception(e)
+        finally:
+            chunks.close()
+            self._file.close()
+            release()
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            self._on_done(self)
+
+    def open_reader(self):
+        """Must be called before the broadcast finishes (see MergeBroadcasts)."""
+        with self._cond:
+            self.readers += 1
+        return BroadcastReader(self, open(self.path, 'rb'))
+
+    def wait_for(self, offset):
+        """Block until data past offset exists; returns (size, done, error)."""
+        with self._cond:
+            while self.size <= offset and not self.done:
+                self._cond.wait()
+            return self.size, self.done, self.error
+
+    def detach(self):
+        with self._cond:
+            self.readers -= 1
+
+class BroadcastReader:
+    """Iterates over a MergeBroadcast's output for one client."""
+
+    def __init__(self, broadcast, file):
+        self.broadcast = broadcast
+        self._file = file
+        self._closed = False
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            size, done, error = self.broadcast.wait_for(offset)
+            if offset < size:
+                chunk = self._file.read(min(size - offset, RELAY_CHUNK_SIZE))
+                offset += len(chunk)
+                yield chunk
+            elif error:
+                raise error
+            elif done:
+                return
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._file.close()
+            self.broadcast.detach()
+
+class MergeBroadcasts:
+    """Registry of in-progress merges, keyed by (video, resolution, profile)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self.started = 0
+        self.attached = 0
+
+    def attach(self, key):
+        """A reader on the in-progress merge for key, or None."""
+        with self._lock:
+            broadcast = self._active.get(key)
+            if broadcast is None:
+                return None
+            self.attached += 1
+            return broadcast.open_reader()
+
+    def start(self, key, chunks, filename, mimetype, release, cache_key):
+        """Start a merge and return a reader on it.
+
+        If another request started the same merge in the meantime, attach to
+        that one instead and give up this request's slot.
+        """
+        with self._lock:
+            broadcast = self._active.get(key)
+            if broadcast:
+                self.attached += 1
+                reader = broadcast.open_reader()
+            else:
+                broadcast = MergeBroadcast(key, filename, mimetype, cache_key, self._finish)
+                self._active[key] = broadcast
+                self.started += 1
+                reader = broadcast.open_reader()
+                broadcast.start(chunks, release)
+                return reader
+        # ffmpeg hasn't been spawned yet: the generator was never started
+        chunks.close()
+        release()
+        return reader
+
+    def _finish(self, broadcast):
+        with self._lock:
+            del self._active[broadcast.key]
+        if broadcast.cache_key and not broadcast.error:
+            media_cache.publish(broadcast.path, broadcast.cache_key)
+        else:
+            os.remove(broadcast.path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._active),
+                "readers": sum(b.readers for b in self._active.values()),
+                "started": self.started,
+                "attached": self.attached,
+            }
+
+merge_broadcasts = MergeBroadcasts()
+
+def merged_response(reader, filename, mimetype, kind='shared', resolution='unknown'):
+    """Stream a broadcast reader to the client. kind and resolution label
+    the download's metrics; requests that joined someone else's merge are
+    counted as 'shared'.
+    """
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+        "Content-Type": mimetype,
+        "Accept-Ranges": "none",
+    }
+
+    def generate():
+        try:
+            yield from measure_download(reader, kind, resolution)
+        finally:
+            reader.close()
+
+    return Response(stream_with_context(generate()), headers=headers)
+
+def get_request_url():
+    """The video URL from the JSON body (POST) or the query string (GET/HEAD)."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        return data.get('url')
+    return request.args.get('url')
+
+def get_stream_size(stream):
+    """Size of a stream in bytes, asking upstream with HEAD if YouTube didn't send it."""
+    if not stream.filesize:
+        upstream = upstream_pool.request(stream.url, method='HEAD', egress=stream_egress(stream))
+        upstream.close()
+        length = upstream.headers.get('Content-Length')
+        stream.filesize = int(length) if length else None
+    return stream.filesize
+
+def get_byte_range(size):
+    """The (start, end) byte range requested by the client, inclusive.
+
+    Returns None when the whole file should be sent (no Range header, or a
+    multi-range request) and raises RequestedRangeNotSatisfiable for ranges
+    outside the file.
+    """
+    byte_range = request.range
+    if not size or byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+    bounds = byte_range.range_for_length(size)
+    if bounds is None:
+        raise RequestedRangeNotSatisfiable(length=size)
+    return bounds[0], bounds[1] - 1
+
+def download_headers(filename, mimetype, size):
+    """Status, headers and byte range (or None) of a download of size bytes.
+
+    The Range header is honoured whatever the method, so POST downloads can
+    be resumed like GET ones.
+    """
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+        "Content-Type": mimetype,
+        "Accept-Ranges": "bytes",
+    }
+    status = 200
+    byte_range = get_byte_range(size)
+    if byte_range:
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+    elif size:
+        headers["Content-Length"] = str(size)
+    return status, headers, byte_range
+
+def serve_cached_file(path, filename, mimetype):
+    """Serve a media cache file with the same Range and HEAD handling as a
+    relay (werkzeug's send_file only honours Range for GET and HEAD).
+
+    Full files go out through the WSGI server's file wrapper (sendfile) and
+    answer If-None-Match. The ETag comes from the inode, not the mtime,
+    which every cache hit bumps for LRU eviction; a new download of the key
+    replaces the file, and so the inode. Returns None if the file was evicted
+    since it was looked up.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        stat = os.fstat(f.fileno())
+        status, headers, byte_range = download_headers(filename, mimetype, stat.st_size)
+    except BaseException:
+        f.close()
+        raise
+    if request.method == 'HEAD':
+        f.close()
+        return Response(status=status, headers=headers)
+
+    if not byte_range:
+        response = Response(wrap_file(request.environ, f, RELAY_CHUNK_SIZE), status=status, headers=headers,
+                            direct_passthrough=True)
+        response.set_etag(f"{stat.st_ino:x}-{stat.st_size:x}")
+        return response.make_conditional(request)
+
+    start, end = byte_range
+    f.seek(start)
+
+    def generate():
+        remaining = end - start + 1
+        try:
+            while remaining > 0:
+                chunk = f.read(min(remaining, RELAY_CHUNK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+    return Response(generate(), status=status, headers=headers)
+
+def serve_progressive(stream, filename, release, cache_key=None, mimetype='video/mp4'):
+    """Relay a progressive stream, honouring Range and HEAD requests.
+
+    release() is called once the response is finished (or was never started).
+    Full downloads are also stored in the media cache under cache_key.
+    """
+    size = get_stream_size(stream)
+    status, headers, byte_range = download_headers(filename, mimetype, size)
+
+    if request.method == 'HEAD':
+        release()
+        return Response(status=status, headers=headers)
+
+    chunks = stream_chunks(stream.url, size, byte_range, stream_egress(stream))
+    if cache_key and not byte_range:
+        chunks = tee_to_cache(chunks, media_cache.open_writer(cache_key))
+    chunks = measure_download(chunks, 'relay', resolution_bucket(stream))
+
+    def generate():
+        try:
+            yield from chunks
+        finally:
+            release()
+
+    return Response(stream_with_context(generate()), status=status, headers=headers)
+
+def serve_merged(stream, audio_stream, filename, release, cache_key=None, broadcast_key=None, profile=DEFAULT_PROFILE,
+                 bitrate=None):
+    """Merge an adaptive video stream (None for audio-only profiles) with its
+    audio through ffmpeg, stream-copying the audio when the profile allows.
+
+    Clients asking for the same broadcast_key while the merge runs share its
+    output (see MergeBroadcasts). The merged output is produced on the fly, so
+    byte ranges can't be served until it has been stored in the media cache
+    under cache_key.
+    """
+    mimetype = OUTPUT_PROFILES[profile]["mimetype"]
+    if request.method == 'HEAD':
+        release()
+        return Response(headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+            "Content-Type": mimetype,
+            "Accept-Ranges": "none",
+        })
+
+    chunks = stream_with_ffmpeg_merge(
+        stream.url if stream else None, audio_stream.url, profile, audio_can_be_copied(audio_stream, profile, bitrate),
+        stream.filesize if stream else None, bitrate, stream_egress(audio_stream)
+    )
+    reader = merge_broadcasts.start(broadcast_key or uuid.uuid4().hex, chunks, filename, mimetype, release, cache_key)
+    return merged_response(reader, filename, mimetype, download_class(audio_stream, profile, bitrate), resolution_bucket(stream))
+
+def get_request_profile():
+    """The 'profile' request parameter (JSON body or query string), or None if invalid."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        profile = data.get('profile')
+    else:
+        profile = request.args.get('profile')
+    profile = profile or DEFAULT_PROFILE
+    # A list or dict from the JSON body would raise on the lookup (a 500)
+    return profile if isinstance(profile, str) and profile in OUTPUT_PROFILES else None
+
+def get_download_streams(url, variant, profile):
+    """(stream, error, audio_stream) for /download/<variant>, where variant is a resolution or 'best'."""
+    if variant == 'best':
+        return get_best_stream(url, profile)
+    return get_stream_object(url, variant, profile)
+
+def download_filename(variant, stream, merged):
+    if variant == 'best':
+        return f"{stream.title}_{stream.resolution}"
+    return f"{stream.title}_{variant}" if merged else stream.title
+
+def describe_download(stream, audio_stream, profile, filename):
+    """(download_name, mimetype) of the file built from stream and audio_stream."""
+    settings = OUTPUT_PROFILES[profile]
+    merged = audio_stream is not None
+    if settings["audio_only"]:
+        download_name = f"{(stream or audio_stream).title}.{settings['ext']}"
+    else:
+        download_name = f"{filename(stream, merged)}.{settings['ext'] if merged else 'mp4'}"
+    mimetype = settings["mimetype"] if merged or settings["audio_only"] else 'video/mp4'
+    return download_name, mimetype
+
+def serve_download(get_streams, filename, ffmpeg_error, variant, profile=None, bitrate=None):
+    """Shared body of the download endpoints.
+
+    get_streams(url, profile) returns (stream, error, audio_stream): stream
+    alone is relayed as-is, otherwise stream (None for audio-only profiles)
+    and audio_stream are merged by ffmpeg. filename(stream, merged) names
+    the downloaded file (without extension) and variant identifies what was
+    asked for (e.g. the resolution). profile defaults to the 'profile'
+    request parameter; bitrate (kbps) makes ffmpeg re-encode the audio.
+    """
+    url = get_request_url()
+
+    if not url:
+        return jsonify({"error": "Missing 'url' parameter in the request body."}), 400
+
+    if not isinstance(url, str) or not is_valid_youtube_url(url):
+        return jsonify({"error": "Invalid YouTube URL."}), 400
+
+    if profile is None:
+        profile = get_request_profile()
+        if not profile:
+            return jsonify({"error": f"Invalid 'profile'. Choose one of: {', '.join(OUTPUT_PROFILES)}."}), 400
+    output = f"{profile}-{bitrate}k" if bitrate else profile
+
+    # Join a merge of the same video already in progress; only the request
+    # that started it is counted by admission control
+    broadcast_key = f"{extract_video_id(url)}:{variant}:{output}"
+    if request.method != 'HEAD':
+        reader = merge_broadcasts.attach(broadcast_key)
+        if reader:
+            return merged_response(reader, reader.broadcast.filename, reader.broadcast.mimetype)
+    
+    stream, error_message, audio_stream = get_streams(url, profile)
+    if not (stream or audio_stream):
+        return jsonify({"error": error_message}), 500
+
+    # Released here if the response is never started; otherwise the
+    # response releases it when it finishes
+    ticket = None
+    try:
+        merged = audio_stream is not None
+        download_name, mimetype = describe_download(stream, audio_stream, profile, filename)
+
+        cache_key = None
+        if media_cache.enabled:
+            cache_key = MediaCache.key(
+                extract_video_id(url), stream.itag if stream else None, audio_stream.itag if merged else None,
+                output if merged else PROGRESSIVE_PROFILE
+            )
+            cached_path = media_cache.lookup(cache_key)
+            if cached_path:
+                # Served from disk (sendfile, Range, HEAD); no admission needed
+                response = serve_cached_file(cached_path, download_name, mimetype)
+                if response:
+                    return response
+
+        if merged and not ffmpeg_available():
+            return jsonify({"error": ffmpeg_error}), 500
+
+        release = lambda: None
+        if request.method != 'HEAD':
+            # Waits for room on the host, or raises AdmissionRejected (503)
+            ticket = admission.acquire(download_class(audio_stream, profile, bitrate))
+            release = ticket.release
+
+        # Check if this is an adaptive stream (needs audio merge)
+        if merged:
+            response = serve_merged(stream, audio_stream, download_name, release, cache_key, broadcast_key, profile, bitrate)
+        else:
+            # Progressive stream - direct streaming
+            response = serve_progressive(stream, download_name, release, cache_key, mimetype)
+        ticket = None
+        return response
+    except (RequestedRangeNotSatisfiable, AdmissionRejected):
+        raise
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return jsonify({"error": f"Error streaming video: {str(e)}"}), 500
+    finally:
+        if ticket:
+            ticket.release()
+
+# Download jobs: downloads submitted to /jobs wait in a queue and are produced
+# in the background by a pool of worker threads, then fetched from disk.
+JOB_DIR = os.environ.get('JOB_DIR', os.path.join(CACHE_DIR, 'jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))  # jobs run at once, per worker process
+JOB_FFMPEG_SLOTS = int(os.environ.get('JOB_FFMPEG_SLOTS', os.cpu_count() or 2))  # of which ffmpeg merges
+JOB_MAX_QUEUED = int(os.environ.get('JOB_MAX_QUEUED', 1000))
+JOB_TTL = int(os.environ.get('JOB_TTL', 60 * 60))  # seconds finished jobs and their files are kept
+JOB_MAX_WAIT = 60  # longest long-poll, in seconds
+JOB_SWEEP_INTERVAL = 60  # seconds between deletions of expired job files
+# Job files stay on the host that produced them (unless JOB_DIR is a shared
+# volume); job states record it so other replicas can say where the file is
+JOB_HOST = os.environ.get('JOB_HOST', socket.gethostname())
+
+JOB_PRIORITIES = ('high', 'normal', 'low')
+JOB_STATS_WINDOW = 200  # recent jobs the wait and stage timings are computed over
+
+class Job:
+    """One queued download and its progress.
+
+    stage moves through queued, resolving, (waiting_ffmpeg, admission,
+    merging | admission, downloading) and finished; durations records how
+    long each took.
+    """
+
+    def __init__(self, owner, url, variant, profile, priority):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.url = url
+        self.variant = variant
+        self.profile = profile
+        self.priority = priority
+        self.state = 'queued'  # queued, running, done or failed
+        self.stage = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stage_started_at = self.created_at
+        self.durations = {}
+        self.bytes = 0
+        self.total_bytes = None
+        self.error = None
+        self.filename = None
+        self.mimetype = None
+        self.path = None
+        self.host = JOB_HOST
+        self.finished = threading.Event()
+
+    def enter(self, stage):
+        now = time.time()
+        self.durations[self.stage] = round(now - self.stage_started_at, 3)
+        self.stage = stage
+        self.stage_started_at = now
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "owner": self.owner,
+            "url": self.url,
+            "resolution": self.variant,
+            "profile": self.profile,
+            "priority": self.priority,
+            "state": self.state,
+            "stage": self.stage,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "durations": self.durations,
+            "bytes": self.bytes,
+            "total_bytes": self.total_bytes,
+            "error": self.error,
+            "filename": self.filename,
+            "mimetype": self.mimetype,
+            "path": self.path,
+            "host": self.host,
+        }
+
+class JobQueue:
+    """Download jobs, scheduled by priority with fair queuing between API keys.
+
+    Each priority level keeps one FIFO per API key, and workers take from the
+    highest non-empty level, rotating between keys so a burst from one key
+    does not starve the others. Jobs run in this process; their state is also
+    written to the shared cache backend so any worker can report on them.
+    Every process sweeps expired job files from the directory on a timer.
+    """
+
+    def __init__(self, directory, workers, ffmpeg_slots, max_queued):
+        self.directory = directory
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ffmpeg_slots = threading.BoundedSemaphore(ffmpeg_slots)
+        self._cond = threading.Condition()
+        self._levels = {priority: OrderedDict() for priority in JOB_PRIORITIES}
+        self._jobs = {}
+        self._threads = []
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=JOB_STATS_WINDOW)
+        self.stage_durations = {}
+        self.swept = 0
+        self._sweeper_pid = None
+
+    def start_sweeper(self):
+        # Started on first use, so the thread is created in the worker process
+        # rather than a preloading master
+        with self._cond:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_periodically, name='job-sweeper', daemon=True).start()
+
+    def _sweep_periodically(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+            time.sleep(JOB_SWEEP_INTERVAL)
+
+    def submit(self, job):
+        """Queue job; returns False if the queue is full."""
+        self.start_sweeper()
+        with self._cond:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                return False
+            # Threads are started on first use, so they are created in the
+            # worker process rather than a preloading master
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='job-worker', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._jobs[job.id] = job
+            self._levels[job.priority].setdefault(job.owner, deque()).append(job)
+            self.queued += 1
+            self._cond.notify()
+        self.publish(job)
+        return True
+
+    def _take(self):
+        with self._cond:
+            while not self.queued:
+                self._cond.wait()
+            for level in self._levels.values():
+                if level:
+                    owner, jobs = next(iter(level.items()))
+                    job = jobs.popleft()
+                    if jobs:
+                        level.move_to_end(owner)
+                    else:
+                        del level[owner]
+                    self.queued -= 1
+                    self.running += 1
+                    return job
+
+    def _work(self):
+        while True:
+            job = self._take()
+            try:
+                run_job(job)
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                job.state = 'failed'
+                job.error = f"({type(e).__name__}): {str(e)}"
+            job.finished_at = time.time()
+            job.enter('finished')
+            with self._cond:
+                self.running -= 1
+                if job.state == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.waits.append(job.started_at - job.created_at)
+                for stage, seconds in job.durations.items():
+                    self.stage_durations.setdefault(stage, deque(maxlen=JOB_STATS_WINDOW)).append(seconds)
+            self.publish(job)
+            job.finished.set()
+
+    def publish(self, job):
+        try:
+            shared_cache.set('job:' + job.id, job.to_dict(), JOB_TTL)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+
+    def get(self, job_id):
+        """State of a job as a dict, from this process or the shared backend."""
+        job = self._jobs.get(job_id)
+        if job:
+            return job.to_dict()
+        try:
+            return shared_cache.get('job:' + job_id)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            return None
+
+    def wait(self, job_id, timeout):
+        """Wait up to timeout seconds for a job to finish; returns its state."""
+        job = self._jobs.get(job_id)
+        if job:
+            job.finished.wait(timeout)
+            return job.to_dict()
+        # Running in another process: poll the shared backend
+        deadline = time.monotonic() + timeout
+        while True:
+            data = self.get(job_id)
+            if not data or data["state"] in ('done', 'failed') or time.monotonic() >= deadline:
+                return data
+            time.sleep(min(0.5, max(0, deadline - time.monotonic())))
+
+    def sweep(self):
+        """Forget finished jobs older than JOB_TTL, and delete job files not
+        written for JOB_TTL seconds, including those of other processes on
+        the host and of processes that have exited.
+        """
+        cutoff = time.time() - JOB_TTL
+        with self._cond:
+            expired = [job for job in self._jobs.values() if job.finished_at and job.finished_at < cutoff]
+            for job in expired:
+                del self._jobs[job.id]
+            in_progress = {job.path for job in self._jobs.values() if job.path and not job.finished_at}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if entry.path in in_progress or entry.stat().st_mtime >= cutoff:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            with self._cond:
+                self.swept += 1
+
+    def stats(self):
+        with self._cond:
+            waits = list(self.waits)
+            return {
+                "workers": self.workers,
+                "queued": {priority: sum(len(jobs) for jobs in level.values()) for priority, level in self._levels.items()},
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "swept": self.swept,
+                "wait_seconds": summarize_durations(waits),
+                "stage_seconds": {stage: summarize_durations(list(values)) for stage, values in self.stage_durations.items()},
+            }
+
+def summarize_durations(values):
+    if not values:
+        return None
+    return {"mean": round(sum(values) / len(values), 3), "max": round(max(values), 3)}
+
+job_queue = JobQueue(JOB_DIR, JOB_WORKERS, JOB_FFMPEG_SLOTS, JOB_MAX_QUEUED)
+
+@app.before_request
+def start_job_sweeper():
+    # Every worker sweeps, including those that never run a job themselves
+    job_queue.start_sweeper()
+
+def run_job(job):
+    """Resolve a job's streams and write the finished download to JOB_DIR."""
+    job.state = 'running'
+    job.started_at = time.time()
+    job.enter('resolving')
+    job_queue.publish(job)
+
+    while True:
+        try:
+            stream, error, audio_stream = get_download_streams(job.url, job.variant, job.profile)
+            break
+        except AdmissionRejected as e:
+            # Jobs are not in a hurry: retry the extraction when the host has room
+            time.sleep(e.retry_after)
+    if not (stream or audio_stream):
+        job.state = 'failed'
+        job.error = error
+        return
+    merged = audio_stream is not None
+    if merged and not ffmpeg_available():
+        job.state = 'failed'
+        job.error = "This download requires ffmpeg for audio merging."
+        return
+    job.filename, job.mimetype = describe_download(
+        stream, audio_stream, job.profile, lambda stream, merged: download_filename(job.variant, stream, merged)
+    )
+
+    os.makedirs(job_queue.directory, exist_ok=True)
+    path = os.path.join(job_queue.directory, job.id)
+    cache_key = None
+    if media_cache.enabled:
+        cache_key = MediaCache.key(
+            extract_video_id(job.url), stream.itag if stream else None, audio_stream.itag if merged else None,
+            job.profile if merged else PROGRESSIVE_PROFILE
+        )
+        cached_path = media_cache.lookup(cache_key)
+        if cached_path:
+            try:
+                os.link(cached_path, path)
+            except OSError:
+                shutil.copyfile(cached_path, path)
+            job.bytes = job.total_bytes = os.path.getsize(path)
+            job.path = path
+            job.state = 'done'
+            return
+
+    if merged:
+        job.total_bytes = sum(get_stream_size(s) or 0 for s in (stream, audio_stream) if s) or None
+        job.enter('waiting_ffmpeg')
+        job_queue.publish(job)
+        job_queue.ffmpeg_slots.acquire()
+        try:
+            job.enter('admission')
+            ticket = admission.acquire(download_class(audio_stream, job.profile), timeout=None)
+            try:
+                job.enter('merging')
+                chunks = stream_with_ffmpeg_merge(
+                    stream.url if stream else None, audio_stream.url, job.profile, audio_can_be_copied(audio_stream, job.profile),
+                    stream.filesize if stream else None, egress=stream_egress(audio_stream)
+                )
+                write_job_file(job, chunks, path, cache_key)
+            finally:
+                ticket.release()
+        finally:
+            job_queue.ffmpeg_slots.release()
+    else:
+        job.total_bytes = get_stream_size(stream)
+        job.enter('admission')
+        job_queue.publish(job)
+        ticket = admission.acquire('relay', timeout=None)
+        try:
+            job.enter('downloading')
+            write_job_file(job, stream_chunks(stream.url, stream.filesize, egress=stream_egress(stream)), path, cache_key)
+        finally:
+            ticket.release()
+    job.path = path
+    job.state = 'done'
+
+def write_job_file(job, chunks, path, cache_key):
+    """Write chunks to path (and the media cache), publishing progress about once a second."""
+    if cache_key:
+        chunks = tee_to_cache(chunks, media_cache.open_writer(cache_key))
+    temp_path = path + '.part'
+    published_at = time.monotonic()
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                job.bytes += len(chunk)
+                if time.monotonic() - published_at >= 1:
+                    job_queue.publish(job)
+                    published_at = time.monotonic()
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def job_status(data):
+    """Public view of a job: internal fields removed, progress and links added."""
+    status = {k: v for k, v in data.items() if k not in ('owner', 'path')}
+    # total_bytes of a merge is estimated from its inputs
+    status["progress"] = round(min(1.0, data["bytes"] / data["total_bytes"]), 4) if data["total_bytes"] else None
+    status["status_url"] = f"/jobs/{data['id']}"
+    status["file_url"] = f"/jobs/{data['id']}/file"
+    return status
+
+def get_job_owner():
+    return hashlib.sha256(request.headers.get('X-API-Key', '').encode()).hexdigest()[:16]
+
+def get_owned_job(job_id, wait=0):
+    """A job's state if it belongs to the requesting API key, else None."""
+    data = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+    if data and data["owner"] == get_job_owner():
+        return data
+    return None
+
+# Admission control: work is admitted by weight against a host-wide capacity,
+# and held back while the host's CPU, outbound bandwidth or ffmpeg process
+# count is over its limit. Each worker process records what it has in flight
+# in ADMISSION_DIR, so the limits apply to all workers on the host together.
+# It is created once at startup and its lock file reopened on every request,
+# so it must not be on a tmpfs something cleans, e.g. systemd-tmpfiles on /tmp:
+# a request would fail with FileNotFoundError once it was removed.
+ADMISSION_DIR = os.environ.get('ADMISSION_DIR', os.path.join(CACHE_DIR, 'admission'))
+# Weights are roughly in hundredths of a CPU core, and capacity defaults to
+# 100 per core
+ADMISSION_CAPACITY = float(os.environ.get('ADMISSION_CAPACITY', (os.cpu_count() or 2) * 100))
+ADMISSION_WEIGHTS = {
+    # metadata: a YouTube extraction, relay: a download relayed as-is,
+    # remux: an ffmpeg merge copying all codecs, transcode: a merge re-encoding audio,
+    # audio: an audio-only download through ffmpeg (no video bytes),
+    # prefetch: a background re-extraction of a hot video (see Prefetcher)
+    "metadata": float(os.environ.get('ADMISSION_WEIGHT_METADATA', 20)),
+    "relay": float(os.environ.get('ADMISSION_WEIGHT_RELAY', 2)),
+    "remux": float(os.environ.get('ADMISSION_WEIGHT_REMUX', 10)),
+    "transcode": float(os.environ.get('ADMISSION_WEIGHT_TRANSCODE', 100)),
+    "audio": float(os.environ.get('ADMISSION_WEIGHT_AUDIO', 25)),
+    "prefetch": float(os.environ.get('ADMISSION_WEIGHT_PREFETCH', 20)),
+}
+ADMISSION_MAX_CPU = float(os.environ.get('ADMISSION_MAX_CPU', 0.9))  # host CPU utilisation, 0-1
+ADMISSION_MAX_TX = float(os.environ.get('ADMISSION_MAX_TX', 0))  # host outbound bytes/s, 0 for no limit
+ADMISSION_MAX_FFMPEG = int(os.environ.get('ADMISSION_MAX_FFMPEG', (os.cpu_count() or 2) * 2))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 5))  # seconds a request may wait
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 100))  # waiting requests per worker
+# Share of capacity background work may fill; it is also held back while any
+# request waits, and never queued itself
+ADMISSION_BACKGROUND_LOAD = float(os.environ.get('ADMISSION_BACKGROUND_LOAD', 0.5))
+# Optional hard cap on downloads per worker process; 0 leaves it to the limits above
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 0))
+
+# Which host resources each class of work needs
+ADMISSION_USES_CPU = {"metadata", "remux", "transcode", "audio", "prefetch"}
+ADMISSION_USES_TX = {"relay", "remux", "transcode", "audio"}
+ADMISSION_USES_FFMPEG = {"remux", "transcode", "audio"}
+DOWNLOAD_CLASSES = {"relay", "remux", "transcode", "audio"}
+BACKGROUND_CLASSES = {"prefetch"}
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server busy: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+class HostMetrics:
+    """CPU utilisation, outbound bandwidth and ffmpeg process count of the
+    host, sampled by refresh() from /proc. Values are None where /proc is
+    unavailable or before a second sample exists.
+
+    When this process's cgroup may use fewer cores than the host has (a CPU
+    quota in cpu.max or cpu.cfs_quota_us, or a cpuset), CPU utilisation is
+    the cgroup's usage of those cores rather than the host's.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._sampled_at = None
+        self._cpu_times = None
+        self._tx_bytes = None
+        self.values = {"cpu": None, "tx_bps": None, "ffmpeg": None}
+
+    @staticmethod
+    def _read_cpu_times():
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+        idle = fields[3] + fields[4]  # idle + iowait
+        return sum(fields) - idle, sum(fields)
+
+    @staticmethod
+    def _cgroup_file(controller, name):
+        """Path of this process's cgroup file name, in the cgroup v1 hierarchy
+        of controller or (controller None) in cgroup v2; None if there is none.
+        """
+        try:
+            with open('/proc/self/cgroup') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        for line in lines:
+            _, controllers, path = line.split(':', 2)
+            if controller is None and controllers == '':
+                mounts = [CGROUP_ROOT, os.path.join(CGROUP_ROOT, 'unified')]
+            elif controller is not None and controller in controllers.split(','):
+                mounts = [os.path.join(CGROUP_ROOT, controller)]
+            else:
+                continue
+            for mount in mounts:
+                # Inside a container its own cgroup is usually mounted as the root
+                for directory in (mount + path, mount):
+                    if os.path.exists(os.path.join(directory, name)):
+                        return os.path.join(directory, name)
+        return None
+
+    def _read_cgroup_cpu(self):
+        """(CPU seconds used by this process's cgroup, cores it may use), or
+        None if it may use all of the host's.
+        """
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        stat, quota = self._cgroup_file(None, 'cpu.stat'), self._cgroup_file(None, 'cpu.max')
+        if stat and quota:
+            with open(quota) as f:
+                limit, period = f.read().split()
+            with open(stat) as f:
+                usage = next(int(line.split()[1]) for line in f if line.startswith('usage_usec ')) / 1e6
+        else:
+            usage_path = self._cgroup_file('cpuacct', 'cpuacct.usage')
+            quota = self._cgroup_file('cpu', 'cpu.cfs_quota_us')
+            period = self._cgroup_file('cpu', 'cpu.cfs_period_us')
+            if not (usage_path and quota and period):
+                return None
+            with open(quota) as f:
+                limit = f.read().strip()
+            with open(period) as f:
+                period = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read()) / 1e9
+        if limit not in ('max', '-1'):
+            cores = min(cores, int(limit) / int(period))
+        if cores >= (os.cpu_count() or 1):
+            return None
+        return usage, cores
+
+    @staticmethod
+    def _read_tx_bytes():
+        total = 0
+        with open('/proc/net/dev') as f:
+            for line in f.readlines()[2:]:
+                name, data = line.split(':', 1)
+                if name.strip() != 'lo':
+                    total += int(data.split()[8])
+        return total
+
+    @staticmethod
+    def _count_ffmpeg():
+        count = 0
+        for entry in os.scandir('/proc'):
+            if entry.name.isdigit():
+                try:
+                    with open(f'/proc/{entry.name}/comm') as f:
+                        if f.read().strip() == 'ffmpeg':
+                            count += 1
+                except OSError:
+                    pass
+        return count
+
+    def refresh(self):
+        """Take a new sample. Run from the admission sampler thread, so the
+        /proc reads stay off the request path.
+        """
+        now = time.monotonic()
+        elapsed = None if self._sampled_at is None else now - self._sampled_at
+        self._sampled_at = now
+        values = {"cpu": None, "tx_bps": None, "ffmpeg": None}
+        try:
+            cgroup = self._read_cgroup_cpu()
+        except (OSError, ValueError, StopIteration):
+            cgroup = None
+        try:
+            if cgroup:
+                # CPU seconds used, and available over the interval
+                busy, total = cgroup[0], now * cgroup[1]
+            else:
+                busy, total = self._read_cpu_times()
+            if self._cpu_times and self._cpu_times[2] == bool(cgroup) and total > self._cpu_times[1]:
+                values["cpu"] = round(min(1.0, (busy - self._cpu_times[0]) / (total - self._cpu_times[1])), 4)
+            self._cpu_times = (busy, total, bool(cgroup))
+            tx_bytes = self._read_tx_bytes()
+            if self._tx_bytes is not None and elapsed:
+                values["tx_bps"] = round((tx_bytes - self._tx_bytes) / elapsed)
+            self._tx_bytes = tx_bytes
+            values["ffmpeg"] = self._count_ffmpeg()
+        except (OSError, ValueError, IndexError):
+            pass
+        self.values = values
+        return values
+
+    def sample(self):
+        """The latest sample; never blocks on /proc."""
+        return self.values
+
+class AdmissionTicket:
+    def __init__(self, controller, cls):
+        self.controller = controller
+        self.cls = cls
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(self)
+
+class AdmissionController:
+    """Admits weighted work against host-wide capacity and live resource use.
+
+    acquire() returns a ticket immediately when there is room, otherwise
+    waits up to a timeout for room and then raises AdmissionRejected with a
+    Retry-After estimate. Requests are only held back by resources while
+    something else of ours is running, so a lone request is always admitted.
+
+    The host's in-flight work is kept as totals in one small file, updated
+    under a host-wide lock; each worker also records its own share in a
+    ledger, so the share of a worker that died can be taken off the totals.
+    Host metrics are sampled and dead workers reaped by a background thread,
+    outside that lock. The host lock is never taken while holding _cond, so
+    a request waiting on another worker doesn't hold up this one's.
+    """
+
+    def __init__(self, directory, capacity, weights, metrics):
+        self.directory = directory
+        self.capacity = capacity
+        self.weights = weights
+        self.metrics = metrics
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, 'lock')
+        self._totals_path = os.path.join(directory, 'totals')
+        self._fds_pid = None
+        self._ledger_fd = None
+        self._totals_fd = None
+        self._sampler_pid = None
+        self._cond = threading.Condition()
+        self._in_flight = dict.fromkeys(weights, 0)
+        self._waiting = 0
+        self._hold_times = dict.fromkeys(weights, None)  # rolling average seconds a ticket is held
+        self.counters = {cls: {"admitted": 0, "queued": 0, "rejected": 0} for cls in weights}
+        self.waits = deque(maxlen=JOB_STATS_WINDOW)
+        self.reaped = 0
+
+    def start_sampler(self):
+        # Started on first use, so the thread is created in the worker process
+        # rather than a preloading master
+        with self._cond:
+            if self._sampler_pid == os.getpid():
+                return
+            self._sampler_pid = os.getpid()
+        threading.Thread(target=self._sample_periodically, name='admission-sampler', daemon=True).start()
+
+    def _sample_periodically(self):
+        while True:
+            try:
+                self.metrics.refresh()
+                self.reap()
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+            time.sleep(self.metrics.interval)
+
+    def _ledger_path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    @contextmanager
+    def _host_lock(self):
+        # Each call opens the file afresh, so it also excludes this process's
+        # other threads. Polled rather than blocking, which under gevent would
+        # stall every greenlet in the worker until the lock came free
+        with open(self._lock_path, 'a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(0.001)
+            yield
+
+    def _open_files(self):
+        """Open this process's ledger and the totals; returns the counts an
+        earlier process with the same PID left in the ledger.
+        """
+        if self._fds_pid == os.getpid():
+            return {}
+        self._ledger_fd = os.open(self._ledger_path(os.getpid()), os.O_RDWR | os.O_CREAT, 0o644)
+        self._totals_fd = os.open(self._totals_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fds_pid = os.getpid()
+        try:
+            return json.loads(os.pread(self._ledger_fd, 65536, 0))
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def _write(fd, counts):
+        # Rewritten in place: replacing the file by rename makes ext4 flush
+        # it to disk, which costs tens of milliseconds per request
+        data = json.dumps(counts).encode()
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+
+    def _read_totals(self):
+        """The host totals; call under the host lock. Rebuilt from the ledgers
+        if they are missing, e.g. on the first run.
+        """
+        stale = self._open_files()
+        try:
+            totals = json.loads(os.pread(self._totals_fd, 65536, 0))
+        except ValueError:
+            totals = None
+        if not isinstance(totals, dict):
+            totals = {}
+            for counts in self._read_ledgers().values():
+                for cls, count in counts.items():
+                    totals[cls] = totals.get(cls, 0) + count
+        if stale:
+            # A worker that died with our PID, e.g. after a container restart
+            for cls, count in stale.items():
+                totals[cls] = max(0, totals.get(cls, 0) - count)
+            self._write(self._totals_fd, totals)
+            self._write(self._ledger_fd, self._in_flight)
+        return totals
+
+    def _read_ledgers(self):
+        """{pid: counts} of every ledger, this process's included."""
+        ledgers = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    ledgers[int(entry.name[:-5])] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return ledgers
+
+    def _update(self, cls, delta):
+        """Add delta to this process's count of cls and the host's; call under the host lock."""
+        totals = self._read_totals()
+        totals[cls] = max(0, totals.get(cls, 0) + delta)
+        self._in_flight[cls] += delta
+        self._write(self._totals_fd, totals)
+        self._write(self._ledger_fd, self._in_flight)
+
+    def reap(self):
+        """Take the in-flight work of worker processes that have died off the host totals."""
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json') or entry.name == f'{os.getpid()}.json':
+                continue
+            try:
+                os.kill(int(entry.name[:-5]), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except (PermissionError, ValueError):
+                continue
+            with self._host_lock():
+                try:
+                    with open(entry.path) as f:
+                        counts = json.load(f)
+                except FileNotFoundError:
+                    continue  # reaped by another worker
+                except (OSError, ValueError):
+                    counts = {}
+                totals = self._read_totals()
+                for cls, count in counts.items():
+                    totals[cls] = max(0, totals.get(cls, 0) - count)
+                self._write(self._totals_fd, totals)
+                os.remove(entry.path)
+                self.reaped += 1
+
+    def host_in_flight(self):
+        """In-flight work per class, summed over all live worker processes."""
+        with self._host_lock():
+            return self._read_totals()
+
+    def _blocked_by(self, cls, in_flight):
+        """Why cls can't be admitted right now, or None."""
+        if not any(in_flight.values()):
+            return None
+        load = sum(self.weights.get(c, 1) * n for c, n in in_flight.items())
+        if load + self.weights[cls] > self.capacity:
+            return "capacity"
+        if cls in BACKGROUND_CLASSES and (self._waiting or load + self.weights[cls] > self.capacity * ADMISSION_BACKGROUND_LOAD):
+            return "background"
+        if cls in DOWNLOAD_CLASSES and MAX_CONCURRENT_DOWNLOADS and \
+                sum(self._in_flight[c] for c in DOWNLOAD_CLASSES) >= MAX_CONCURRENT_DOWNLOADS:
+            return "downloads"
+        host = self.metrics.sample()
+        if cls in ADMISSION_USES_CPU and host["cpu"] is not None and host["cpu"] >= ADMISSION_MAX_CPU:
+            return "cpu"
+        if cls in ADMISSION_USES_TX and ADMISSION_MAX_TX and host["tx_bps"] is not None and host["tx_bps"] >= ADMISSION_MAX_TX:
+            return "bandwidth"
+        if cls in ADMISSION_USES_FFMPEG and host["ffmpeg"] is not None and host["ffmpeg"] >= ADMISSION_MAX_FFMPEG:
+            return "ffmpeg"
+        return None
+
+    def _try_admit(self, cls):
+        """Admit cls if there is room; returns None on success, else the blocking reason."""
+        with self._host_lock():
+            reason = self._blocked_by(cls, self._read_totals())
+            if reason is None:
+                self._update(cls, 1)
+            return reason
+
+    def acquire(self, cls, timeout=ADMISSION_QUEUE_TIMEOUT):
+        """Admit one unit of cls, waiting up to timeout seconds (None waits forever).
+
+        Background classes are never queued: they are rejected at once if
+        there is no spare room.
+        """
+        self.start_sampler()
+        started = time.monotonic()
+        reason = self._try_admit(cls)
+        if reason is not None:
+            with self._cond:
+                if cls in BACKGROUND_CLASSES:
+                    self.counters[cls]["rejected"] += 1
+                    raise AdmissionRejected(f"{reason} limit reached", self.retry_after(cls))
+                if timeout is not None and self._waiting >= ADMISSION_MAX_QUEUE:
+                    self.counters[cls]["rejected"] += 1
+                    raise AdmissionRejected("too many queued requests", self.retry_after(cls))
+                self.counters[cls]["queued"] += 1
+                self._waiting += 1
+            try:
+                while reason is not None:
+                    remaining = None if timeout is None else timeout - (time.monotonic() - started)
+                    if remaining is not None and remaining <= 0:
+                        with self._cond:
+                            self.counters[cls]["rejected"] += 1
+                            retry_after = self.retry_after(cls)
+                        ADMISSION_WAIT_SECONDS.labels(cls, 'rejected').observe(time.monotonic() - started)
+                        raise AdmissionRejected(f"{reason} limit reached", retry_after)
+                    # Other workers release without notifying us, so re-check periodically
+                    with self._cond:
+                        self._cond.wait(0.25 if remaining is None else min(0.25, remaining))
+                    reason = self._try_admit(cls)
+            finally:
+                with self._cond:
+                    self._waiting -= 1
+        with self._cond:
+            self.counters[cls]["admitted"] += 1
+            self.waits.append(time.monotonic() - started)
+            ADMISSION_WAIT_SECONDS.labels(cls, 'admitted').observe(time.monotonic() - started)
+        return AdmissionTicket(self, cls)
+
+    def _release(self, ticket):
+        held = time.monotonic() - ticket.admitted_at
+        with self._host_lock():
+            self._update(ticket.cls, -1)
+        with self._cond:
+            average = self._hold_times[ticket.cls]
+            self._hold_times[ticket.cls] = held if average is None else average + 0.2 * (held - average)
+            self._cond.notify_all()
+
+    def retry_after(self, cls):
+        """Seconds until a slot for cls is likely to free up, from how long they are held."""
+        held = self._hold_times[cls]
+        if held is None:
+            return 5
+        running = max(1, self._in_flight[cls])
+        return max(1, min(300, math.ceil(held * (self._waiting + 1) / running)))
+
+    def stats(self):
+        self.start_sampler()
+        host_in_flight = self.host_in_flight()
+        with self._cond:
+            return {
+                "capacity": self.capacity,
+                "weights": self.weights,
+                "host_load": round(sum(self.weights.get(c, 1) * n for c, n in host_in_flight.items()), 2),
+                "host_in_flight": host_in_flight,
+                "in_flight": dict(self._in_flight),
+                "waiting": self._waiting,
+                "reaped_workers": self.reaped,
+                "host": self.metrics.sample(),
+                "limits": {"cpu": ADMISSION_MAX_CPU, "tx_bps": ADMISSION_MAX_TX or None, "ffmpeg": ADMISSION_MAX_FFMPEG},
+                "classes": self.counters,
+                "wait_seconds": summarize_durations(list(self.waits)),
+            }
+
+admission = AdmissionController(ADMISSION_DIR, ADMISSION_CAPACITY, ADMISSION_WEIGHTS, HostMetrics())
+
+def download_class(audio_stream, profile, bitrate=None):
+    """Admission class of a download: relayed as-is, audio through ffmpeg, or merged by ffmpeg."""
+    if audio_stream is None:
+        return 'relay'
+    if OUTPUT_PROFILES[profile]["audio_only"]:
+        return 'audio'
+    return 'remux' if audio_can_be_copied(audio_stream, profile, bitrate) else 'transcode'
+
+# Prefetch: the most requested videos, and those warmed up through
+# /admin/warmup, are extracted again in the background shortly before their
+# cache entries (and the signed stream URLs in them) expire, so their
+# downloads never wait on an extraction. Refreshes are admitted as
+# background work, and are skipped while the host is busy.
+PREFETCH_TOP_K = int(os.environ.get('PREFETCH_TOP_K', 20))  # hottest videos kept fresh per worker; 0 disables
+PREFETCH_MIN_SCORE = float(os.environ.get('PREFETCH_MIN_SCORE', 3))  # decayed request count to count as hot
+PREFETCH_HALF_LIFE = float(os.environ.get('PREFETCH_HALF_LIFE', 60 * 60))  # seconds for a request to weigh half
+PREFETCH_TRACKED = int(os.environ.get('PREFETCH_TRACKED', 1000))  # videos whose requests are counted
+PREFETCH_LEAD = int(os.environ.get('PREFETCH_LEAD', 30 * 60))  # seconds before expiry an entry is refreshed
+PREFETCH_INTERVAL = float(os.environ.get('PREFETCH_INTERVAL', 30))  # seconds between scans
+PREFETCH_JITTER = float(os.environ.get('PREFETCH_JITTER', 10))  # most seconds a refresh is randomly delayed
+PREFETCH_CONCURRENCY = int(os.environ.get('PREFETCH_CONCURRENCY', 2))  # refreshes at once, per worker
+PREFETCH_WARMUP_TTL = int(os.environ.get('PREFETCH_WARMUP_TTL', 24 * 60 * 60))  # seconds a warm-up is kept fresh
+
+class HotVideos:
+    """Approximate top-K of requested video IDs by exponentially decayed count.
+
+    A Space-Saving sketch: at most `capacity` IDs are tracked, and a new one
+    replaces the lowest-scoring ID and inherits its score, so frequently
+    requested videos are never dropped. Scores use forward decay (a request
+    at time t weighs 2 ** (t / half_life)), so recording a request doesn't
+    touch the other scores.
+    """
+
+    def __init__(self, capacity, half_life):
+        self.capacity = capacity
+        self.half_life = half_life
+        self._scores = {}
+        self._epoch = time.time()
+        self._lock = threading.Lock()
+
+    def _weight(self, now):
+        return 2 ** ((now - self._epoch) / self.half_life)
+
+    def record(self, video_id):
+        now = time.time()
+        with self._lock:
+            weight = self._weight(now)
+            if weight > 2 ** 64:
+                # Rebase before the weights overflow
+                self._scores = {key: score / weight for key, score in self._scores.items()}
+                self._epoch = now
+                weight = 1.0
+            score = self._scores.get(video_id)
+            if score is None:
+                score = 0.0
+                if len(self._scores) >= self.capacity:
+                    victim = min(self._scores, key=self._scores.get)
+                    score = self._scores.pop(victim)
+            self._scores[video_id] = score + weight
+
+    def top(self, k, min_score=0):
+        """Up to k (video_id, score) pairs, hottest first, scored in requests."""
+        with self._lock:
+            weight = self._weight(time.time())
+            hottest = heapq.nlargest(k, self._scores.items(), key=lambda item: item[1])
+        # With 1% slack, so n requests moments ago still count as n
+        return [(video_id, score / weight) for video_id, score in hottest if score / weight >= min_score * 0.99]
+
+    def __len__(self):
+        return len(self._scores)
+
+class Prefetcher:
+    """Keeps the cache entries of hot and warmed-up videos fresh.
+
+    A scan every PREFETCH_INTERVAL seconds picks the warm-up list and the
+    PREFETCH_TOP_K hottest videos whose entries are missing or expire within
+    PREFETCH_LEAD seconds, and refreshes them on a small pool, each after a
+    random delay so replicas and workers don't refresh in lockstep. The
+    warm-up list is kept in the shared cache backend, so every worker (and
+    replica) sharing it warms the same videos; their refreshes share one
+    extraction through the backend's lock.
+    """
+
+    WARMUP_KEY = 'prefetch:warmup'
+
+    def __init__(self, hot, top_k, concurrency):
+        self.hot = hot
+        self.top_k = top_k
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._warmup = {}  # video_id -> keep fresh until
+        self._pending = set()
+        self._pid = None
+        self._pool = None
+        self.counters = {"scans": 0, "refreshes": 0, "urgent": 0, "deferred": 0, "failures": 0}
+
+    def _start(self):
+        # Started on first use, so the thread is created in the worker process
+        # rather than a preloading master
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='prefetch')
+            self._pending = set()
+            threading.Thread(target=self._run, name='prefetch', daemon=True).start()
+
+    def record(self, video_id):
+        """Count a request for video_id."""
+        if not self.top_k:
+            return
+        self.hot.record(video_id)
+        self._start()
+
+    def warm_up(self, video_ids):
+        """Keep video_ids fresh for PREFETCH_WARMUP_TTL seconds, starting now."""
+        until = time.time() + PREFETCH_WARMUP_TTL
+        self._update_warmup(lambda warmup: warmup.update(dict.fromkeys(video_ids, until)))
+        self._start()
+        self._wake.set()
+
+    def cancel(self, video_ids):
+        """Stop keeping video_ids fresh."""
+        self._update_warmup(lambda warmup: [warmup.pop(video_id, None) for video_id in video_ids])
+
+    def _update_warmup(self, change):
+        with self._lock:
+            warmup = self._load_warmup()
+            change(warmup)
+            self._warmup = warmup
+        try:
+            shared_cache.set(self.WARMUP_KEY, warmup, PREFETCH_WARMUP_TTL)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+
+    def _load_warmup(self):
+        """The unexpired warm-up list, from the shared backend if there is one."""
+        warmup = self._warmup
+        if shared_cache.name != 'memory':
+            try:
+                warmup = shared_cache.get(self.WARMUP_KEY) or {}
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+        now = time.time()
+        return {video_id: until for video_id, until in warmup.items() if until > now}
+
+    def warmup_list(self):
+        with self._lock:
+            self._warmup = self._load_warmup()
+            return dict(self._warmup)
+
+    def candidates(self):
+        """Video IDs to keep fresh: the warm-up list, then the hottest videos."""
+        video_ids = list(self.warmup_list())
+        if self.top_k:
+            video_ids += [video_id for video_id, _ in self.hot.top(self.top_k, PREFETCH_MIN_SCORE)]
+        return list(dict.fromkeys(video_ids))
+
+    def scan(self):
+        now = time.time()
+        self.counters["scans"] += 1
+        for video_id in self.candidates():
+            snapshot = video_cache.peek(video_id)
+            if snapshot and snapshot.has_streams and snapshot.expires_at - now > PREFETCH_LEAD:
+                continue
+            with self._lock:
+                if video_id in self._pending:
+                    continue
+                self._pending.add(video_id)
+            self._pool.submit(self._refresh, video_id, random.uniform(0, PREFETCH_JITTER))
+
+    def _refresh(self, video_id, delay):
+        time.sleep(delay)
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        # Once an entry has been deferred through half its lead, deferring it
+        # further risks moving its extraction onto the request path, so it is
+        # admitted like one
+        cached = video_cache.peek(video_id)
+        urgent = cached is not None and cached.expires_at - time.time() < PREFETCH_LEAD / 2
+        if urgent:
+            self.counters["urgent"] += 1
+        try:
+            # Under its own flight key: a live request joining this flight
+            # would get its AdmissionRejected when background work is held
+            # back. Live requests still wait on the extraction lock it holds.
+            snapshot, error = extraction_flight.do(f"prefetch:{video_id}", lambda: load_video(
+                url, video_id, min_expires_at=time.time() + PREFETCH_LEAD,
+                admission_class='metadata' if urgent else 'prefetch'
+            ))
+            self.counters["refreshes" if snapshot else "failures"] += 1
+        except AdmissionRejected:
+            # The host is busy; the next scan tries again
+            self.counters["deferred"] += 1
+        except Exception as e:
+            self.counters["failures"] += 1
+            sentry_sdk.capture_exception(e)
+        finally:
+            with self._lock:
+                self._pending.discard(video_id)
+
+    def _run(self):
+        while True:
+            self._wake.wait(PREFETCH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.scan()
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+
+    def stats(self):
+        now = time.time()
+        hot = []
+        for video_id, score in self.hot.top(self.top_k, PREFETCH_MIN_SCORE):
+            snapshot = video_cache.peek(video_id)
+            hot.append({
+                "video_id": video_id,
+                "score": round(score, 2),
+                "expires_in": round(snapshot.expires_at - now) if snapshot and snapshot.has_streams else None,
+            })
+        with self._lock:
+            in_flight = len(self._pending)
+        return dict(
+            self.counters,
+            in_flight=in_flight,
+            tracked=len(self.hot),
+            warmup=len(self.warmup_list()),
+            hot=hot,
+            top_k=self.top_k,
+            lead=PREFETCH_LEAD,
+            interval=PREFETCH_INTERVAL,
+        )
+
+prefetcher = Prefetcher(HotVideos(PREFETCH_TRACKED, PREFETCH_HALF_LIFE), PREFETCH_TOP_K, PREFETCH_CONCURRENCY)
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    return jsonify({"error": f"{e}. Retry after {e.retry_after}s."}), 503, {"Retry-After": str(e.retry_after)}
+
+@app.route('/download/<resolution>', methods=['GET', 'POST'])
+@require_api_key
+def download_by_resolution(resolution):
+    return serve_download(
+        lambda url, profile: get_download_streams(url, resolution, profile),
+        lambda stream, merged: download_filename(resolution, stream, merged),
+        "This resolution requires ffmpeg for audio merging. Install ffmpeg or use a progressive resolution (360p/720p).",
+        resolution,
+    )
+
+AUDIO_FORMATS = [name for name, settings in OUTPUT_PROFILES.items() if settings["audio_only"]]
+AUDIO_BITRATES = (32, 320)  # kbps range allowed for the 'bitrate' parameter
+
+def get_audio_options():
+    """(format, bitrate, error) from the /download/audio request parameters."""
+    if request.method == 'POST':
+        params = request.get_json(silent=True) or {}
+    else:
+        params = request.args
+    audio_format = params.get('format') or 'm4a'
+    if audio_format not in AUDIO_FORMATS:
+        return None, None, f"Invalid 'format'. Choose one of: {', '.join(AUDIO_FORMATS)}."
+    bitrate = params.get('bitrate')
+    if not bitrate:
+        return audio_format, None, None
+    try:
+        bitrate = int(str(bitrate).lower().rstrip('k'))
+    except ValueError:
+        return None, None, "'bitrate' must be a number of kbps, e.g. 128."
+    if not AUDIO_BITRATES[0] <= bitrate <= AUDIO_BITRATES[1]:
+        return None, None, f"'bitrate' must be between {AUDIO_BITRATES[0]} and {AUDIO_BITRATES[1]} kbps."
+    if '-b:a' not in OUTPUT_PROFILES[audio_format]["transcode_audio"]:
+        return None, None, f"'bitrate' can't be set for {audio_format}."
+    return audio_format, bitrate, None
+
+def get_audio_download_streams(url, profile, bitrate):
+    """(stream, error, audio_stream) for /download/audio; never touches video streams."""
+    yt, error = get_youtube_object(url)
+    if not yt:
+        return None, error, None
+    try:
+        with STREAM_SELECTION_SECONDS.labels('audio').time():
+            return get_audio_only_streams(yt, profile, bitrate)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return None, f"({type(e).__name__}): {str(e)}", None
+
+@app.route('/download/audio', methods=['GET', 'POST'])
+@require_api_key
+def download_audio():
+    audio_format, bitrate, error_message = get_audio_options()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    return serve_download(
+        lambda url, profile: get_audio_download_streams(url, profile, bitrate),
+        lambda stream, merged: stream.title,
+        "This audio format requires ffmpeg. Install ffmpeg or use format=m4a.",
+        'audio',
+        audio_format,
+        bitrate,
+    )
+
+@app.route('/download/best', methods=['GET', 'POST'])
+@require_api_key
+def download_best_quality():
+    return serve_download(
+        lambda url, profile: get_download_streams(url, 'best', profile),
+        lambda stream, merged: download_filename('best', stream, merged),
+        "Best quality requires ffmpeg for audio merging. Install ffmpeg or use /download/720p.",
+        'best',
+    )
+
+# Batch metadata: many videos per request, extracted on a pool shared by all
+# batches so bulk jobs cannot take over the worker.
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))  # extractions in flight per batch
+BATCH_POOL_SIZE = int(os.environ.get('BATCH_POOL_SIZE', 8))  # extractions in flight for all batches, per worker
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', 60))  # seconds
+
+VIDEO_ID_PATTERN = re.compile(r"^[\w-]{11}$")
+
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_POOL_SIZE, thread_name_prefix='batch')
+batch_stats = {"batches": 0, "items": 0, "errors": 0, "deadline_exceeded": 0}
+
+def normalize_batch_item(item):
+    """Return the watch URL for a batch entry (a URL or a bare video ID), or None if invalid."""
+    if not isinstance(item, str):
+        return None
+    item = item.strip()
+    if VIDEO_ID_PATTERN.match(item):
+        return f"https://www.youtube.com/watch?v={item}"
+    return item if is_valid_youtube_url(item) else None
+
+def batch_line(item, video_id, result, error):
+    batch_stats["items"] += 1
+    if error:
+        batch_stats["errors"] += 1
+        line = {"input": item, "id": video_id, "error": error}
+    else:
+        line = {"input": item, "id": video_id, "result": result}
+    return app.json.dumps(line) + '\n'
+
+def resolve_concurrently(entries, resolve, concurrency, deadline):
+    """Run resolve(url) for each (tag, url) in entries on batch_pool and
+    yield (tag, result, error) as each one finishes.
+
+    entries is consumed lazily: a new entry is pulled only when one of the
+    concurrency slots frees up. Once deadline seconds have passed, entries
+    still running are yielded with result and error both None, and the rest
+    of entries is left unconsumed.
+    """
+    entries = iter(entries)
+    running = {}
+    ends = time.monotonic() + deadline
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(running) < concurrency:
+                entry = next(entries, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                tag, url = entry
+                running[batch_pool.submit(resolve, url)] = tag
+            if not running:
+                return
+            done, _ = wait(running, timeout=max(0, ends - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                tag = running.pop(future)
+                try:
+                    result, error = future.result()
+                except Exception as e:
+                    sentry_sdk.capture_exception(e)
+                    result, error = None, f"({type(e).__name__}): {str(e)}"
+                yield tag, result, error
+    finally:
+        # Extractions already running finish in the background and still fill the cache.
+        for future in running:
+            future.cancel()
+
+    for tag in list(running.values()):
+        yield tag, None, None
+
+def run_batch(items, resolve, concurrency, deadline):
+    """Yield one NDJSON line per unique video, in the order they finish.
+
+    resolve(url) returns (result, error). Duplicate videos are resolved once.
+    At most concurrency videos of this batch are extracted at a time, and
+    videos still unresolved after deadline seconds are reported as errors.
+    """
+    unique = OrderedDict()
+    for item in items:
+        url = normalize_batch_item(item)
+        if not url:
+            yield batch_line(item, None, None, "Invalid YouTube URL or video ID.")
+            continue
+        unique.setdefault(extract_video_id(url) or url, (item, url))
+
+    queue = iter(((video_id, item), url) for video_id, (item, url) in unique.items())
+    unresolved = []
+    for (video_id, item), result, error in resolve_concurrently(queue, resolve, concurrency, deadline):
+        if result is None and error is None:
+            unresolved.append((video_id, item))
+        else:
+            yield batch_line(item, video_id, result, error)
+
+    unresolved.extend(tag for tag, url in queue)
+    if unresolved:
+        batch_stats["deadline_exceeded"] += 1
+    for video_id, item in unresolved:
+        yield batch_line(item, video_id, None, "Batch deadline exceeded.")
+
+def batch_response(resolve):
+    """Shared body of the batch endpoints: validate the request and stream NDJSON results."""
+    data = request.get_json(silent=True) or {}
+    items = data.get('urls')
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing 'urls' list in the request body."}), 400
+
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many URLs: at most {BATCH_MAX_ITEMS} per batch."}), 400
+
+    try:
+        concurrency, deadline = get_batch_limits(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'concurrency' and 'deadline' must be numbers."}), 400
+
+    batch_stats["batches"] += 1
+    return Response(run_batch(items, resolve, concurrency, deadline), mimetype='application/x-ndjson')
+
+def get_batch_limits(data):
+    """Per-request (concurrency, deadline), which may only lower the configured limits."""
+    concurrency = max(1, min(int(data.get('concurrency', BATCH_CONCURRENCY)), BATCH_CONCURRENCY))
+    deadline = max(0.0, min(float(data.get('deadline', BATCH_DEADLINE)), BATCH_DEADLINE))
+    return concurrency, deadline
+
+# Playlists and channels: entries are paged from YouTube lazily and resolved
+# on the batch pool. The cursor names the continuation page and the entry
+# within it, so a long listing is resumed without fetching its earlier pages.
+PLAYLIST_PAGE_SIZE = int(os.environ.get('PLAYLIST_PAGE_SIZE', 100))  # default entries per request
+PLAYLIST_MAX_PAGE_SIZE = int(os.environ.get('PLAYLIST_MAX_PAGE_SIZE', 1000))
+# YouTube's browse endpoint can stop giving continuation tokens part way
+# through a long playlist (pytubefix sees it after 100 to 200 entries). A
+# playlist whose pages run out after at least this many entries is continued
+# from the playlist panel of the watch page, like pytubefix does.
+WATCH_PANEL_MIN_ENTRIES = 100
+
+listing_stats = {"listings": 0, "entries": 0, "errors": 0, "pages": 0}
+
+def is_valid_playlist_url(url):
+    pattern = r"^(https?://)?(www\.|m\.)?youtube\.com/(playlist\?|watch\?v=[\w-]+&)list=[\w-]+(&\S*)?$"
+    return re.match(pattern, url) is not None
+
+def is_valid_channel_url(url):
+    pattern = r"^(https?://)?(www\.|m\.)?youtube\.com/(@[\w.-]+|channel/[\w-]+|c/[\w.-]+|user/[\w.-]+)(/(videos|shorts|streams|featured))?/?$"
+    return re.match(pattern, url) is not None
+
+def listing_line(line):
+    return app.json.dumps(line) + '\n'
+
+def encode_listing_cursor(position):
+    """The opaque cursor for position: {"page", "panel", "skip", "index", "visitor"}."""
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode()).decode()
+
+def decode_listing_cursor(cursor):
+    """The position a cursor names; raises ValueError for anything else.
+
+    The page to fetch first is named by page, the continuation token of a
+    browse page, or panel, the video the watch panel is listed after (both
+    None for the listing's own page). skip is the entries of it already sent,
+    index the number of the first entry to send and visitor the visitor data
+    continuation requests need. A plain number is still accepted as an entry
+    offset from the start of the listing.
+    """
+    if not cursor:
+        return {"page": None, "panel": None, "skip": 0, "index": 0, "visitor": None}
+    if isinstance(cursor, str) and cursor.isdigit():
+        cursor = int(cursor)
+    if isinstance(cursor, int) and not isinstance(cursor, bool):
+        cursor = max(0, cursor)
+        return {"page": None, "panel": None, "skip": cursor, "index": cursor, "visitor": None}
+    if not isinstance(cursor, str):
+        raise ValueError('cursor')
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError('cursor') from e
+    if not (isinstance(position, dict)
+            and all(isinstance(position.get(key), (str, type(None))) for key in ('page', 'panel', 'visitor'))
+            and all(isinstance(position.get(key), int) and position[key] >= 0 for key in ('skip', 'index'))):
+        raise ValueError('cursor')
+    return position
+
+def listing_urls(source, items):
+    """Watch URLs of the items pytubefix extracted from a listing page."""
+    for item in items:
+        if isinstance(item, list):
+            yield from listing_urls(source, item)
+        elif isinstance(item, str):
+            yield source._video_url(item) if item.startswith('/watch') else item
+        elif getattr(item, 'watch_url', None):
+            yield item.watch_url
+
+def fetch_through(egress, fetch):
+    """fetch(), holding a slot on egress and sending its requests through it."""
+    egress.acquire()
+    started = time.time()
+    try:
+        with egress_pool.use(egress):
+            result = fetch()
+    except OSError:
+        egress.record(False)
+        raise
+    finally:
+        egress.release()
+    egress.record(True, time.time() - started)
+    return result
+
+def watch_panel_page(source, video_id, egress):
+    """Watch URLs of the playlist's entries after video_id, from the playlist
+    panel of its watch page; see Playlist._extract_watch_panel_video_urls,
+    which fetches the same panel for pytubefix's own paging.
+    """
+    from pytubefix.innertube import InnerTube
+
+    def fetch():
+        client = InnerTube('WEB')
+        client.base_data.update({
+            "videoId": video_id,
+            "playlistId": source.playlist_id,
+            "contentCheckOk": True,
+            "racyCheckOk": True,
+        })
+        return client._call_api(f"{client.base_url}/next", client.base_params, client.base_data)
+
+    video_ids = source._extract_playlist_panel_video_ids(fetch_through(egress, fetch))
+    if video_id not in video_ids:
+        raise UpstreamError(f"The playlist panel of {video_id} doesn't list it")
+    return [f"https://www.youtube.com/watch?v={entry}" for entry in video_ids[video_ids.index(video_id) + 1:]]
+
+def listing_pages(source, page, visitor_data, egress, start, watch_panel):
+    """Yield (page, urls, next_page, visitor_data) for each page of a
+    playlist or channel, from page on, fetched through egress. Pages are
+    named like cursors: {"page": continuation token, "panel": video ID}, both
+    None for the first; start is the number of page's first entry.
+
+    This is pytubefix's paging, minus its walk from the first page: a
+    continuation page is fetched directly from its token. With watch_panel,
+    a playlist whose browse pages run out after WATCH_PANEL_MIN_ENTRIES
+    entries is continued from the watch panel.
+    """
+    from pytubefix.innertube import InnerTube
+    last_url = None
+    while page:
+        if page["panel"]:
+            urls = watch_panel_page(source, page["panel"], egress)
+            next_page = {"page": None, "panel": extract_video_id(urls[-1])} if urls else None
+        else:
+            if page["page"] is None:
+                initial_data = fetch_through(egress, lambda: source.initial_data)
+                items, next_token = source._extract_videos(initial_data)
+                visitor_data = source._visitor_data
+            else:
+                response = fetch_through(egress, lambda: InnerTube('WEB').browse(continuation=page["page"], visitor_data=visitor_data))
+                items, next_token = source._extract_videos(response)
+            urls = list(listing_urls(source, items))
+            last_url = urls[-1] if urls else last_url
+            next_page = {"page": next_token, "panel": None} if next_token else None
+            if not next_token and watch_panel and last_url and start + len(urls) >= WATCH_PANEL_MIN_ENTRIES:
+                next_page = {"page": None, "panel": extract_video_id(last_url)}
+        listing_stats["pages"] += 1
+        yield page, urls, next_page, visitor_data
+        start += len(urls)
+        page = next_page
+
+def run_listing(source, position, limit, resolve, concurrency, deadline, egress, watch_panel=False):
+    """Yield NDJSON metadata for up to limit entries of a playlist or channel, from position on.
+
+    Pages are fetched through egress only as extraction slots free up, so memory does not
+    grow with the size of the listing. Each line carries the cursor to resume
+    from if the response is cut short; the last line gives next_cursor (null
+    once the listing is exhausted).
+    """
+    first = position["index"]
+    pages = []  # (index of its first entry, page, size, next_page, visitor_data) of each page fetched
+
+    def entries():
+        start = first - position["skip"]
+        page = {"page": position["page"], "panel": position.get("panel")}
+        for page, urls, next_page, visitor_data in listing_pages(source, page, position["visitor"], egress, start,
+                                                                  watch_panel):
+            pages.append((start, page, len(urls), next_page, visitor_data))
+            for index, url in enumerate(urls, start):
+                if index >= first + limit:
+                    return
+                if index >= first:
+                    yield (index, extract_video_id(url)), url
+            start += len(urls)
+            if start >= first + limit:
+                return
+
+    def cursor_at(index):
+        """The cursor of entry index, or None past the end of the listing."""
+        for start, page, size, next_page, visitor_data in reversed(pages):
+            if start <= index < start + size:
+                return encode_listing_cursor(dict(page, skip=index - start, index=index, visitor=visitor_data))
+            if index == start + size:
+                if not next_page:
+                    return None
+                return encode_listing_cursor(dict(next_page, skip=0, index=index, visitor=visitor_data))
+        return encode_listing_cursor(position)
+
+    resume_at = first  # every entry before this has been sent
+    finished = set()
+    timed_out = False
+    try:
+        for (index, video_id), result, error in resolve_concurrently(entries(), resolve, concurrency, deadline):
+            if result is None and error is None:
+                timed_out = True
+                continue
+            finished.add(index)
+            while resume_at in finished:
+                finished.remove(resume_at)
+                resume_at += 1
+            listing_stats["entries"] += 1
+            line = {"index": index, "id": video_id, "cursor": cursor_at(resume_at)}
+            if error:
+                listing_stats["errors"] += 1
+                line["error"] = error
+            else:
+                line["result"] = result
+            yield listing_line(line)
     except Exception as e:
+        # Paging failed part way through; the client can retry from the cursor.
         sentry_sdk.capture_exception(e)
-        return None, f"({type(e).__name__}): {str(e)}", None
+        yield listing_line({"error": f"({type(e).__name__}): {str(e)}", "next_cursor": cursor_at(resume_at)})
+        return
+
+    if timed_out or resume_at == first + limit:
+        next_cursor = cursor_at(resume_at)
+    else:
+        next_cursor = None
+    yield listing_line({"next_cursor": next_cursor, "count": resume_at - first})
+
+def listing_response(make_source, is_valid, kind):
+    """Shared body of /playlist and /channel."""
+    data = request.get_json(silent=True) or {}
+    url = data.get('url')
+
+    if not url:
+        return jsonify({"error": "Missing 'url' parameter in the request body."}), 400
+
+    if not isinstance(url, str) or not is_valid(url):
+        return jsonify({"error": f"Invalid YouTube {kind} URL."}), 400
 
-def get_best_stream(url):
-    yt, error = get_youtube_object(url)
-    if not yt:
-        return None, error, None
-    
     try:
-        # Try progressive first (has audio)
-        stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
-        if stream:
-            return stream, None, None
-        
-        # Fall back to best adaptive (video-only, needs audio merge)
-        video_stream = yt.streams.filter(adaptive=True, file_extension='mp4').order_by('resolution').desc().first()
-        if video_stream:
-            # Prefer m4a/mp4 audio, fall back to webm if needed
-            audio_stream = yt.streams.filter(adaptive=True, only_audio=True, file_extension='mp4').order_by('abr').desc().first()
-            if not audio_stream:
-                audio_stream = yt.streams.filter(adaptive=True, only_audio=True).order_by('abr').desc().first()
-            return video_stream, None, audio_stream
-        
-        return None, "No MP4 streams found for this video.", None
-    except Exception as e:
-        sentry_sdk.capture_exception(e)
-        return None, f"({type(e).__name__}): {str(e)}", None
+        position = decode_listing_cursor(data.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid 'cursor'. Use a cursor from an earlier response."}), 400
 
-def get_thumbnail_data(url):
-    yt, error = get_youtube_object(url)
-    if not yt:
-        return None, error
-    
     try:
-        thumbnail_url = yt.thumbnail_url
-        
-        # Fetch the image data
-        with urlopen(thumbnail_url) as response:
-            image_data = response.read()
-            
-        return BytesIO(image_data), None
-    except Exception as e:
-        sentry_sdk.capture_exception(e)
-        return None, f"({type(e).__name__}): {str(e)}"
-def get_video_info(url):
-    yt, error = get_youtube_object(url)
-    if not yt:
-        return None, error
-    
+        limit = max(1, min(int(data.get('limit', PLAYLIST_PAGE_SIZE)), PLAYLIST_MAX_PAGE_SIZE))
+        concurrency, deadline = get_batch_limits(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'limit', 'concurrency' and 'deadline' must be numbers."}), 400
+
+    # Every page of the listing goes out the same way, like one video's extraction
+    egress = egress_pool.choose()
     try:
-        video_info = {
-            "title": yt.title,
-            "author": yt.author,
-            "length": yt.length,
-            "views": yt.views,
-            "description": yt.description,
-            "publish_date": yt.publish_date,
-            "thumbnail_url": yt.thumbnail_url
-        }
-        return video_info, None
+        source = make_source(url)
+        if position["page"] is None and not position.get("panel"):
+            # Fetch the first page now, so an unknown listing fails with a status code
+            fetch_through(egress, lambda: source.html)
+    except AdmissionRejected:
+        raise
     except Exception as e:
         sentry_sdk.capture_exception(e)
-        return None, f"({type(e).__name__}): {str(e)}"
-
-def is_valid_youtube_url(url):
-    # Supports youtube.com/watch?v=... and youtu.be/...
-    pattern = r"^(https?://)?(www\.)?(youtube\.com/watch\?v=|youtu\.be/)[\w-]+([?&]\S*)?$"
-    return re.match(pattern, url) is not None
+        return jsonify({"error": f"({type(e).__name__}): {str(e)}"}), 500
 
-def stream_with_ffmpeg_merge(video_url, audio_url):
-    """Merge video and audio streams using ffmpeg and yield chunks."""
-    process = subprocess.Popen(
-        [
-            'ffmpeg', '-y',
-            '-reconnect', '1',
-            '-reconnect_streamed', '1',
-            '-reconnect_delay_max', '5',
-            '-i', video_url,
-            '-reconnect', '1',
-            '-reconnect_streamed', '1', 
-            '-reconnect_delay_max', '5',
-            '-i', audio_url,
-            '-map', '0:v:0',
-            '-map', '1:a:0',
-            '-c:v', 'copy',
-            '-c:a', 'aac',
-            '-b:a', '192k',
-            '-shortest',
-            '-movflags', 'frag_keyframe+empty_moov',
-            '-f', 'mp4',
-            'pipe:1'
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    try:
-        while True:
-            chunk = process.stdout.read(8192)
-            if not chunk:
-                break
-            yield chunk
-    finally:
-        process.wait()
+    listing_stats["listings"] += 1
+    listing = run_listing(source, position, limit, get_video_info, concurrency, deadline, egress,
+                          watch_panel=kind == 'playlist')
+    return Response(listing, mimetype='application/x-ndjson')
 
-@app.route('/download/<resolution>', methods=['POST'])
+@app.route('/jobs', methods=['POST'])
 @require_api_key
-def download_by_resolution(resolution):
-    data = request.get_json()
+def submit_job():
+    data = request.get_json(silent=True) or {}
     url = data.get('url')
-    
+
     if not url:
         return jsonify({"error": "Missing 'url' parameter in the request body."}), 400
 
-    if not is_valid_youtube_url(url):
+    if not isinstance(url, str) or not is_valid_youtube_url(url):
         return jsonify({"error": "Invalid YouTube URL."}), 400
-    
-    # Attempt to acquire a download slot
-    acquired = download_semaphore.acquire(blocking=True, timeout=5)
-    if not acquired:
-        return jsonify({"error": "Server busy: Too many concurrent downloads. Please try again in a minute."}), 503
 
-    # Ensure release happens even if get_stream_object or urlopen fails
-    semaphore_released = False
-    try:
-        stream, error_message, audio_stream = get_stream_object(url, resolution)
-        
-        if stream:
-            try:
-                video_url = stream.url
-                title = stream.title
-                safe_title = quote(title)
-                
-                # Check if this is an adaptive stream (needs audio merge)
-                if audio_stream:
-                    if not FFMPEG_AVAILABLE:
-                        return jsonify({"error": "This resolution requires ffmpeg for audio merging. Install ffmpeg or use a progressive resolution (360p/720p)."}), 500
-                    
-                    audio_url = audio_stream.url
-                    
-                    def generate():
-                        try:
-                            yield from stream_with_ffmpeg_merge(video_url, audio_url)
-                        finally:
-                            download_semaphore.release()
-                    
-                    semaphore_released = True
-                    return Response(
-                        stream_with_context(generate()),
-                        headers={
-                            "Content-Disposition": f"attachment; filename*=UTF-8''{safe_title}_{resolution}.mp4",
-                            "Content-Type": "video/mp4",
-                        }
-                    )
-                else:
-                    # Progressive stream - direct streaming
-                    req = urlopen(video_url)
-                    
-                    def generate():
-                        try:
-                            while True:
-                                chunk = req.read(4096)
-                                if not chunk:
-                                    break
-                                yield chunk
-                        finally:
-                            download_semaphore.release()
-
-                    semaphore_released = True
-                    return Response(
-                        stream_with_context(generate()),
-                        headers={
-                            "Content-Disposition": f"attachment; filename*=UTF-8''{safe_title}.mp4",
-                            "Content-Type": "video/mp4",
-                        }
-                    )
-            except Exception as e:
-                sentry_sdk.capture_exception(e)
-                return jsonify({"error": f"Error streaming video: {str(e)}"}), 500
-        else:
-            return jsonify({"error": error_message}), 500
-    finally:
-        if not semaphore_released:
-            download_semaphore.release()
+    resolution = data.get('resolution') or 'best'
+    if not isinstance(resolution, str) or (resolution != 'best' and not re.match(r"^\d+p$", resolution)):
+        return jsonify({"error": "Invalid 'resolution'. Use e.g. '720p' or 'best'."}), 400
 
-@app.route('/download/best', methods=['POST'])
-@require_api_key
-def download_best_quality():
-    data = request.get_json()
-    url = data.get('url')
-    
-    if not url:
-        return jsonify({"error": "Missing 'url' parameter in the request body."}), 400
+    profile = data.get('profile') or DEFAULT_PROFILE
+    if not isinstance(profile, str) or profile not in OUTPUT_PROFILES:
+        return jsonify({"error": f"Invalid 'profile'. Choose one of: {', '.join(OUTPUT_PROFILES)}."}), 400
 
-    if not is_valid_youtube_url(url):
-        return jsonify({"error": "Invalid YouTube URL."}), 400
-    
-    # Attempt to acquire a download slot
-    acquired = download_semaphore.acquire(blocking=True, timeout=5)
-    if not acquired:
-        return jsonify({"error": "Server busy: Too many concurrent downloads. Please try again in a minute."}), 503
+    priority = data.get('priority') or 'normal'
+    if not isinstance(priority, str) or priority not in JOB_PRIORITIES:
+        return jsonify({"error": f"Invalid 'priority'. Choose one of: {', '.join(JOB_PRIORITIES)}."}), 400
+
+    job = Job(get_job_owner(), url, resolution, profile, priority)
+    if not job_queue.submit(job):
+        return jsonify({"error": "Job queue is full. Please try again later."}), 503, {"Retry-After": "60"}
+    return jsonify(job_status(job.to_dict())), 202
 
-    semaphore_released = False
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_job(job_id):
     try:
-        stream, error_message, audio_stream = get_best_stream(url)
-        
-        if stream:
-            try:
-                video_url = stream.url
-                title = stream.title
-                resolution = stream.resolution
-                safe_title = quote(title)
-                
-                # Check if this is an adaptive stream (needs audio merge)
-                if audio_stream:
-                    if not FFMPEG_AVAILABLE:
-                        return jsonify({"error": "Best quality requires ffmpeg for audio merging. Install ffmpeg or use /download/720p."}), 500
-                    
-                    audio_url = audio_stream.url
-                    
-                    def generate():
-                        try:
-                            yield from stream_with_ffmpeg_merge(video_url, audio_url)
-                        finally:
-                            download_semaphore.release()
-                    
-                    semaphore_released = True
-                    return Response(
-                        stream_with_context(generate()),
-                        headers={
-                            "Content-Disposition": f"attachment; filename*=UTF-8''{safe_title}_{resolution}.mp4",
-                            "Content-Type": "video/mp4",
-                        }
-                    )
-                else:
-                    # Progressive stream - direct streaming
-                    req = urlopen(video_url)
-                    
-                    def generate():
-                        try:
-                            while True:
-                                chunk = req.read(4096)
-                                if not chunk:
-                                    break
-                                yield chunk
-                        finally:
-                            download_semaphore.release()
-
-                    semaphore_released = True
-                    return Response(
-                        stream_with_context(generate()),
-                        headers={
-                            "Content-Disposition": f"attachment; filename*=UTF-8''{safe_title}_{resolution}.mp4",
-                            "Content-Type": "video/mp4",
-                        }
-                    )
-            except Exception as e:
-                sentry_sdk.capture_exception(e)
-                return jsonify({"error": f"Error streaming video: {str(e)}"}), 500
-        else:
-            return jsonify({"error": error_message}), 500
-    finally:
-        if not semaphore_released:
-            download_semaphore.release()
+        wait = max(0.0, min(float(request.args.get('wait', 0)), JOB_MAX_WAIT))
+    except ValueError:
+        return jsonify({"error": "'wait' must be a number of seconds."}), 400
+
+    data = get_owned_job(job_id, wait)
+    if not data:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job_status(data)), 200
+
+@app.route('/jobs/<job_id>/file', methods=['GET'])
+@require_api_key
+def get_job_file(job_id):
+    data = get_owned_job(job_id)
+    if not data:
+        return jsonify({"error": "Job not found."}), 404
+    if data["state"] == 'failed':
+        return jsonify({"error": data["error"]}), 500
+    if data["state"] != 'done':
+        return jsonify({"error": "Job is not finished yet."}), 409
+    if not os.path.exists(data["path"]):
+        if data.get("host", JOB_HOST) != JOB_HOST:
+            # Job states are shared through the cache backend, files are not
+            return jsonify({"error": f"Job file is stored on host {data['host']}; fetch it from there.",
+                            "host": data["host"]}), 421
+        return jsonify({"error": "Job file has expired."}), 410
+    return send_file(
+        data["path"],
+        mimetype=data["mimetype"],
+        as_attachment=True,
+        download_name=data["filename"],
+        conditional=True,
+    )
 
 @app.route('/video_info', methods=['POST'])
 @require_api_key
@@ -365,7 +4373,11 @@ def video_info():
     if not is_valid_youtube_url(url):
         return jsonify({"error": "Invalid YouTube URL."}), 400
     
-    video_info, error_message = get_video_info(url)
+    fields, error_message = get_info_fields(data.get('fields'))
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    
+    video_info, error_message = get_video_info(url, fields)
     
     if video_info:
         return jsonify(video_info), 200
@@ -385,34 +4397,37 @@ def available_resolutions():
     if not is_valid_youtube_url(url):
         return jsonify({"error": "Invalid YouTube URL."}), 400
     
-    yt, error = get_youtube_object(url)
-    if not yt:
-        return jsonify({"error": error}), 500
-    
-    try:
-        progressive_resolutions = list(set([
-            stream.resolution 
-            for stream in yt.streams.filter(progressive=True, file_extension='mp4')
-            if stream.resolution
-        ]))
-        all_resolutions = list(set([
-            stream.resolution 
-            for stream in yt.streams.filter(file_extension='mp4')
-            if stream.resolution
-        ]))
-        # Get audio streams info
-        audio_streams = yt.streams.filter(adaptive=True, only_audio=True)
-        audio_info = [{"abr": s.abr, "mime": s.mime_type, "ext": s.subtype} for s in audio_streams]
-        
-        return jsonify({
-            "progressive": sorted(progressive_resolutions),
-            "all": sorted(all_resolutions),
-            "audio_streams": audio_info,
-            "ffmpeg_available": FFMPEG_AVAILABLE
-        }), 200
-    except Exception as e:
-        sentry_sdk.capture_exception(e)
-        return jsonify({"error": f"({type(e).__name__}): {str(e)}"}), 500
+    resolutions, error_message = get_available_resolutions(url)
+
+    if resolutions:
+        return jsonify(resolutions), 200
+    else:
+        return jsonify({"error": error_message}), 500
+
+@app.route('/video_info/batch', methods=['POST'])
+@require_api_key
+def video_info_batch():
+    fields, error_message = get_info_fields((request.get_json(silent=True) or {}).get('fields'))
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    return batch_response(lambda url: get_video_info(url, fields))
+
+@app.route('/available_resolutions/batch', methods=['POST'])
+@require_api_key
+def available_resolutions_batch():
+    return batch_response(get_available_resolutions)
+
+@app.route('/playlist', methods=['POST'])
+@require_api_key
+def playlist_info():
+    from pytubefix import Playlist
+    return listing_response(Playlist, is_valid_playlist_url, 'playlist')
+
+@app.route('/channel', methods=['POST'])
+@require_api_key
+def channel_info():
+    from pytubefix import Channel
+    return listing_response(Channel, is_valid_channel_url, 'channel')
 
 @app.route('/download_thumbnail', methods=['POST'])
 @require_api_key
@@ -425,19 +4440,103 @@ def download_thumbnail():
 
     if not is_valid_youtube_url(url):
         return jsonify({"error": "Invalid YouTube URL."}), 400
+
+    width, height, image_format, error_message = get_thumbnail_options(data)
+    if error_message:
+        return jsonify({"error": error_message}), 400
     
-    image_io, error_message = get_thumbnail_data(url)
+    thumbnail, error_message = get_thumbnail(url, width, height, image_format)
     
-    if image_io:
-        return send_file(
-            image_io,
-            mimetype='image/jpeg',
-            as_attachment=True,
-            download_name='thumbnail.jpg'
-        )
+    if thumbnail:
+        return thumbnail_response(thumbnail, 'thumbnail.webp' if image_format == 'webp' else 'thumbnail.jpg')
     else:
         return jsonify({"error": error_message}), 500
 
+@app.route('/thumbnail/<video_id>', methods=['GET'])
+@require_api_key
+def thumbnail_image(video_id):
+    # Same as /download_thumbnail, but a plain GET so CDNs and browsers can cache it
+    if not re.match(r"^[\w-]{11}$", video_id):
+        return jsonify({"error": "Invalid video ID."}), 400
+
+    width, height, image_format, error_message = get_thumbnail_options(request.args)
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    thumbnail, error_message = get_thumbnail(f"https://www.youtube.com/watch?v={video_id}", width, height, image_format)
+    if thumbnail:
+        return thumbnail_response(thumbnail)
+    else:
+        return jsonify({"error": error_message}), 500
+
+@app.route('/admin/warmup', methods=['GET', 'POST', 'DELETE'])
+@require_api_key
+def admin_warmup():
+    """GET lists the warm-up list and the hot videos; POST adds videos to the
+    warm-up list and DELETE removes them.
+    """
+    if request.method == 'GET':
+        now = time.time()
+        warmup = {video_id: round(until - now) for video_id, until in prefetcher.warmup_list().items()}
+        return jsonify({"warmup": warmup, "hot": prefetcher.stats()["hot"]}), 200
+
+    data = request.get_json(silent=True) or {}
+    items = data.get('urls')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing 'urls' list in the request body."}), 400
+
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many URLs: at most {BATCH_MAX_ITEMS} per request."}), 400
+
+    video_ids, invalid = [], []
+    for item in items:
+        url = normalize_batch_item(item)
+        video_id = extract_video_id(url) if url else None
+        if video_id and VIDEO_ID_PATTERN.match(video_id):
+            video_ids.append(video_id)
+        else:
+            invalid.append(item)
+
+    if request.method == 'DELETE':
+        prefetcher.cancel(video_ids)
+        return jsonify({"removed": video_ids, "invalid": invalid}), 200
+
+    prefetcher.warm_up(video_ids)
+    return jsonify({"accepted": video_ids, "invalid": invalid, "expires_in": PREFETCH_WARMUP_TTL}), 202
+
+@app.route('/stats', methods=['GET'])
+@require_api_key
+def stats():
+    return jsonify({
+        "video_cache": video_cache.stats(),
+        "shared_cache": dict(shared_cache_stats, backend=shared_cache.name),
+        "singleflight": extraction_flight.stats(),
+        "clients": client_health.stats(),
+        "upstream_pool": upstream_pool.stats(),
+        "egress": egress_pool.stats(),
+        "media_cache": media_cache.stats(),
+        "merge_broadcasts": merge_broadcasts.stats(),
+        "thumbnails": thumbnail_cache.stats(),
+        "prefetch": prefetcher.stats(),
+        "startup": dict(startup_stats, player_js={k: v for k, v in player_js_stats.items() if k != "checked"}),
+        "segments": dict(segment_stats, connections=SEGMENT_CONNECTIONS, segment_size=SEGMENT_SIZE),
+        "batches": dict(batch_stats, pool_size=BATCH_POOL_SIZE),
+        "listings": listing_stats,
+        "jobs": job_queue.stats(),
+        "admission": admission.stats(),
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Left unauthenticated for scrapers, like /check-connection; it exposes
+    # only counters and timings, never URLs or keys
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
 @app.route('/check-connection', methods=['GET'])
 def check_connection():
     return "200 OK - API is running!", 200
@@ -466,12 +4565,13 @@ def api_help():
             {
                 "path": "/video_info",
                 "method": "POST",
-                "description": "Retrieves comprehensive metadata about a YouTube video.",
+                "description": "Retrieves comprehensive metadata about a YouTube video, without resolving its streams. 'fields' limits the response to the listed fields.",
                 "auth_required": True,
                 "request_schema": {
                     "type": "object",
                     "properties": {
-                        "url": {"type": "string", "description": "A valid YouTube URL (youtube.com or youtu.be)"}
+                        "url": {"type": "string", "description": "A valid YouTube URL (youtube.com or youtu.be)"},
+                        "fields": {"type": "array", "items": {"type": "string", "enum": list(INFO_FIELDS)}, "description": "Or a comma-separated string; default all"}
                     },
                     "required": ["url"]
                 },
@@ -508,10 +4608,91 @@ def api_help():
                     }
                 }
             },
+            {
+                "path": "/video_info/batch",
+                "method": "POST",
+                "description": "Resolves many videos in one call. Accepts URLs or video IDs (duplicates are resolved once) and streams one NDJSON line per video as it finishes: {input, id, result} or {input, id, error}. 'concurrency' and 'deadline' (seconds) may be lowered per batch, up to BATCH_CONCURRENCY and BATCH_DEADLINE.",
+                "auth_required": True,
+                "request_schema": {
+                    "type": "object",
+                    "properties": {
+                        "urls": {"type": "array", "items": {"type": "string"}, "maxItems": BATCH_MAX_ITEMS},
+                        "concurrency": {"type": "integer", "default": BATCH_CONCURRENCY},
+                        "deadline": {"type": "number", "default": BATCH_DEADLINE},
+                        "fields": {"type": "array", "items": {"type": "string", "enum": list(INFO_FIELDS)}}
+                    },
+                    "required": ["urls"]
+                },
+                "response_schema": {
+                    "type": "ndjson",
+                    "content_type": "application/x-ndjson"
+                }
+            },
+            {
+                "path": "/available_resolutions/batch",
+                "method": "POST",
+                "description": "Batch variant of /available_resolutions, with the same request and NDJSON response format as /video_info/batch.",
+                "auth_required": True,
+                "request_schema": {
+                    "type": "object",
+                    "properties": {
+                        "urls": {"type": "array", "items": {"type": "string"}, "maxItems": BATCH_MAX_ITEMS},
+                        "concurrency": {"type": "integer", "default": BATCH_CONCURRENCY},
+                        "deadline": {"type": "number", "default": BATCH_DEADLINE}
+                    },
+                    "required": ["urls"]
+                },
+                "response_schema": {
+                    "type": "ndjson",
+                    "content_type": "application/x-ndjson"
+                }
+            },
+            {
+                "path": "/playlist",
+                "method": "POST",
+                "description": "Streams metadata for the videos of a playlist as NDJSON: {index, id, result|error, cursor} per video as it is resolved, then a final {next_cursor, count} line. Pass next_cursor back as 'cursor' to continue; it is null once the playlist is exhausted.",
+                "auth_required": True,
+                "request_schema": {
+                    "type": "object",
+                    "properties": {
+                        "url": {"type": "string", "example": "https://www.youtube.com/playlist?list=PLAYLIST_ID"},
+                        "cursor": {"type": "string", "description": "Opaque; copied from next_cursor or a line's cursor. Omit to start from the beginning. A legacy integer entry offset is still accepted."},
+                        "limit": {"type": "integer", "default": PLAYLIST_PAGE_SIZE, "maximum": PLAYLIST_MAX_PAGE_SIZE},
+                        "concurrency": {"type": "integer", "default": BATCH_CONCURRENCY},
+                        "deadline": {"type": "number", "default": BATCH_DEADLINE}
+                    },
+                    "required": ["url"]
+                },
+                "response_schema": {
+                    "type": "ndjson",
+                    "content_type": "application/x-ndjson"
+                }
+            },
+            {
+                "path": "/channel",
+                "method": "POST",
+                "description": "Same as /playlist, for the videos of a channel (youtube.com/@handle, /channel/ID, /c/NAME or /user/NAME).",
+                "auth_required": True,
+                "request_schema": {
+                    "type": "object",
+                    "properties": {
+                        "url": {"type": "string", "example": "https://www.youtube.com/@handle"},
+                        "cursor": {"type": "string", "description": "Opaque; copied from next_cursor or a line's cursor. Omit to start from the beginning. A legacy integer entry offset is still accepted."},
+                        "limit": {"type": "integer", "default": PLAYLIST_PAGE_SIZE, "maximum": PLAYLIST_MAX_PAGE_SIZE},
+                        "concurrency": {"type": "integer", "default": BATCH_CONCURRENCY},
+                        "deadline": {"type": "number", "default": BATCH_DEADLINE}
+                    },
+                    "required": ["url"]
+                },
+                "response_schema": {
+                    "type": "ndjson",
+                    "content_type": "application/x-ndjson"
+                }
+            },
             {
                 "path": "/download/<resolution>",
                 "method": "POST",
-                "description": "Streams the video file directly. Limited to 6 concurrent downloads.",
+                "description": "Streams the video file directly. Downloads are admitted by host-wide admission control and wait up to ADMISSION_QUEUE_TIMEOUT seconds for room, else get 503 with Retry-After. Also accepts GET/HEAD with a 'url' query parameter; progressive resolutions honour Range requests (206 Partial Content) so downloads can be resumed. 'profile' selects the output: mp4 (default), mkv, webm, m4a, opus, mp3 or wav.",
                 "auth_required": True,
                 "parameters": {
                     "resolution": {"type": "string", "example": "720p"}
@@ -519,7 +4700,8 @@ def api_help():
                 "request_schema": {
                     "type": "object",
                     "properties": {
-                        "url": {"type": "string"}
+                        "url": {"type": "string"},
+                        "profile": {"type": "string", "enum": list(OUTPUT_PROFILES), "default": DEFAULT_PROFILE}
                     },
                     "required": ["url"]
                 },
@@ -528,21 +4710,129 @@ def api_help():
                     "content_type": "video/mp4"
                 }
             },
+            {
+                "path": "/download/audio",
+                "method": "POST",
+                "description": "Streams only the audio track, without fetching any video. m4a (default) relays YouTube's AAC track as-is with Range support; opus, mp3 and wav (16 kHz mono, for speech recognition) go through ffmpeg. 'bitrate' (kbps) re-encodes the audio. Also accepts GET/HEAD with query parameters.",
+                "auth_required": True,
+                "request_schema": {
+                    "type": "object",
+                    "properties": {
+                        "url": {"type": "string"},
+                        "format": {"type": "string", "enum": AUDIO_FORMATS, "default": "m4a"},
+                        "bitrate": {"type": "integer", "minimum": AUDIO_BITRATES[0], "maximum": AUDIO_BITRATES[1]}
+                    },
+                    "required": ["url"]
+                },
+                "response_schema": {
+                    "type": "binary",
+                    "content_type": "audio/mp4, audio/ogg, audio/mpeg or audio/wav"
+                }
+            },
+            {
+                "path": "/jobs",
+                "method": "POST",
+                "description": "Queues a download and returns its job (202). Jobs are scheduled by priority, round-robin between API keys, and produced in the background. Returns 503 with Retry-After when the queue is full.",
+                "auth_required": True,
+                "request_schema": {
+                    "type": "object",
+                    "properties": {
+                        "url": {"type": "string"},
+                        "resolution": {"type": "string", "default": "best", "example": "1080p"},
+                        "profile": {"type": "string", "enum": list(OUTPUT_PROFILES), "default": DEFAULT_PROFILE},
+                        "priority": {"type": "string", "enum": list(JOB_PRIORITIES), "default": "normal"}
+                    },
+                    "required": ["url"]
+                },
+                "response_schema": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "state": {"type": "string", "description": "queued, running, done or failed"},
+                        "stage": {"type": "string", "description": "queued, resolving, waiting_ffmpeg, admission, merging, downloading or finished"},
+                        "progress": {"type": "number", "description": "Fraction of the expected size written so far"},
+                        "durations": {"type": "object", "description": "Seconds spent in each finished stage"},
+                        "status_url": {"type": "string"},
+                        "file_url": {"type": "string"}
+                    }
+                }
+            },
+            {
+                "path": "/jobs/<job_id>",
+                "method": "GET",
+                "description": f"Returns a job's status. With ?wait=SECONDS (up to {JOB_MAX_WAIT}), waits for the job to finish first.",
+                "auth_required": True
+            },
+            {
+                "path": "/jobs/<job_id>/file",
+                "method": "GET",
+                "description": "Downloads a finished job's file, with Range support. Returns 409 while the job is still running and 410 once the file has expired.",
+                "auth_required": True,
+                "response_schema": {
+                    "type": "binary"
+                }
+            },
             {
                 "path": "/download_thumbnail",
                 "method": "POST",
-                "description": "Downloads the high-quality thumbnail image.",
+                "description": "Downloads the high-quality thumbnail image, optionally resized or as WebP. Supports If-None-Match and If-Modified-Since.",
                 "auth_required": True,
                 "request_schema": {
                     "type": "object",
                     "properties": {
-                        "url": {"type": "string"}
+                        "url": {"type": "string"},
+                        "width": {"type": "integer", "maximum": THUMBNAIL_MAX_SIZE},
+                        "height": {"type": "integer", "maximum": THUMBNAIL_MAX_SIZE},
+                        "format": {"type": "string", "enum": list(THUMBNAIL_FORMATS), "default": "jpeg"}
                     },
                     "required": ["url"]
                 },
                 "response_schema": {
                     "type": "binary",
-                    "content_type": "image/jpeg"
+                    "content_type": "image/jpeg or image/webp"
+                }
+            },
+            {
+                "path": "/thumbnail/<video_id>",
+                "method": "GET",
+                "description": "Same as /download_thumbnail for a video ID, as a cacheable GET. Query parameters: width, height, format.",
+                "auth_required": True,
+                "response_schema": {
+                    "type": "binary",
+                    "content_type": "image/jpeg or image/webp"
+                }
+            },
+            {
+                "path": "/admin/warmup",
+                "method": "GET, POST, DELETE",
+                "description": "Keep videos' metadata and stream URLs fresh in the cache, so their downloads start without an extraction. POST adds videos to the warm-up list for PREFETCH_WARMUP_TTL seconds, DELETE removes them, GET lists them with the hottest videos.",
+                "auth_required": True,
+                "request_body": {
+                    "urls": "array of strings (required for POST and DELETE) - YouTube URLs or video IDs"
+                },
+                "response_schema": {
+                    "accepted": "array - video IDs added (POST)",
+                    "removed": "array - video IDs removed (DELETE)",
+                    "invalid": "array - entries that are not YouTube URLs or video IDs",
+                    "expires_in": "integer - seconds the videos are kept fresh (POST)",
+                    "warmup": "object - video ID to seconds left (GET)",
+                    "hot": "array - hottest videos with their decayed request count and seconds until their cache entry expires (GET)"
+                }
+            },
+            {
+                "path": "/stats",
+                "method": "GET",
+                "description": "Returns internal statistics: cache hits/misses, coalesced extractions, the learned client order and per-egress health.",
+                "auth_required": True
+            },
+            {
+                "path": "/metrics",
+                "method": "GET",
+                "description": "Prometheus metrics: request counts and latency, extraction time per client, stream selection, upstream time-to-first-byte, ffmpeg time-to-first-chunk, admission wait, bytes and throughput per resolution bucket, outbound requests per egress, and in-flight gauges.",
+                "auth_required": False,
+                "response_schema": {
+                    "type": "string",
+                    "content_type": "text/plain"
                 }
             },
             {
@@ -561,7 +4851,11 @@ def api_help():
         "error_codes": {
             "400": "Bad Request - Missing or invalid parameters.",
             "401": "Unauthorized - Invalid or missing API Key.",
-            "503": "Service Unavailable - Concurrent download limit reached (max 6).",
+            "404": "Not Found - Unknown job ID.",
+            "409": "Conflict - Job is not finished yet.",
+            "410": "Gone - Job file has expired.",
+            "416": "Range Not Satisfiable - Requested byte range is outside the file.",
+            "503": "Service Unavailable - The host is at capacity (see Retry-After), or the job queue is full.",
             "500": "Internal Server Error - Unexpected failure or YouTube parsing error."
         }
     }